@@ -1,10 +1,16 @@
+from array import array
+from collections import OrderedDict
 from io import TextIOWrapper
-from typing import Mapping, Sequence, List, Dict
+from typing import Mapping, Sequence, List, Dict, Callable, Optional, Union, Tuple, Iterator, Iterable
+import numpy as np
 import pandas as pd
 
 COLUMNTYPE = {'NO': int, 'TRAVTM': float, 'VOL': int, 'FROMNODE': int,
               'TONODE': int, 'CURITERIDX': int, 'NUMCONVSIMRUNS': int, 'EVALINT': int}
 
+# column types of downcast timevol_table outputs, the same for every file so tables concatenate without upcasting
+TIMEVOL_DTYPES = {'NO': np.int32, 'Period': np.int16, 'TRAVTMNEW': np.float32, 'VOLNEW': np.int32}
+
 
 def colu_to_type(name: str):
     """
@@ -38,7 +44,7 @@ def tonumeric(instr: str) -> [int, float, str]:
             return instr
 
 
-def timevol_table(frame: pd.DataFrame) -> pd.DataFrame:
+def timevol_table(frame: pd.DataFrame, downcast: bool = True) -> pd.DataFrame:
     """
     This function takes a dynamic assignment time volume table in the format described here:
 
@@ -48,41 +54,113 @@ def timevol_table(frame: pd.DataFrame) -> pd.DataFrame:
 
     NO | VehType | Period | TRAVTMNEW | VOLNEW
 
+    The (period,vehtype) column headers are parsed once and the long table is built by reshaping the value arrays, rows
+    are ordered by NO, VehType and Period. Edges are only sorted if the input is not ordered by NO already.
+
     :param frame: the dataframe from dynamic_assignment_file_read to be transformed
-    :param interval: the dynamic assignment interval length used in the simulation
-    :return: dataframe of transformed data
-    """
-
-    def pick_no_and_cols_melt(data, col_name_start):
-        # pick out relevant columns by names
-        columns = list(frame.columns.values)
-        columns = [col for col in columns if col.startswith(col_name_start)]
-        data: pd.DataFrame = data[['NO'] + columns]
-        # replace word in column name so only period and vehicle type is contained
-        columns = dict(zip(columns, [col.split('(')[-1].strip(')') for col in columns]))
-        data = data.rename(index=str, columns=columns)
-        # melt the data frame along the value columns
-        data = data.melt(id_vars=['NO'], var_name='TEMP', value_name=col_name_start)
-        # Split the temp column
-        new_columns = data['TEMP'].str.split(',', n=1, expand=True)
-        data.drop(columns=['TEMP'], inplace=True)
-        data['Period'] = new_columns[0].astype(int)
-        data['VehType'] = new_columns[1]
-        data.sort_values(by=['NO', 'VehType', 'Period'], inplace=True)
-        return data
-
-    out_frame = pick_no_and_cols_melt(frame, 'TRAVTMNEW')
-    out_frame['VOLNEW'] = pick_no_and_cols_melt(frame, 'VOLNEW')['VOLNEW']
-    out_frame = out_frame[['NO', 'VehType', 'Period', 'TRAVTMNEW', 'VOLNEW']]
-    return out_frame
-
-
-def dynamic_assignment_file_read(file: [str, TextIOWrapper]) -> Dict[str, pd.DataFrame]:
+    :param downcast: whether the columns use the compact types of TIMEVOL_DTYPES instead of int64 and float64
+    :return: dataframe of transformed data with categorical VehType, concatenate several with concat_timevol_tables
+    """
+
+    def header_keys(col_name_start):
+        # parse the (period,vehtype) part of the column names
+        columns = [col for col in frame.columns if col.startswith(col_name_start)]
+        keys = [col.split('(')[-1].strip(')').split(',', 1) for col in columns]
+        return OrderedDict(((key[1], int(key[0])), col) for key, col in zip(keys, columns))
+
+    travel_time_cols = header_keys('TRAVTMNEW')
+    volume_cols = header_keys('VOLNEW')
+    keys = sorted(set(travel_time_cols) | set(volume_cols))
+
+    if not frame['NO'].is_monotonic_increasing:
+        frame = frame.sort_values(by='NO', kind='stable')
+    edge_nos = frame['NO'].to_numpy()
+
+    def long_values(cols, dtype):
+        # edges by keys matrix read row by row is the long table order, missing keys are empty
+        values = np.empty((frame.shape[0], len(keys)), dtype=dtype)
+        for position, key in enumerate(keys):
+            if key in cols:
+                values[:, position] = frame[cols[key]].to_numpy()
+            else:
+                values[:, position] = np.nan if np.issubdtype(dtype, np.floating) else 0
+        return values.ravel()
+
+    veh_types = sorted(set(veh_type for veh_type, _ in keys))
+    code_type = np.int8 if downcast and len(veh_types) < 128 else int
+    veh_type_codes = np.array([veh_types.index(veh_type) for veh_type, _ in keys], dtype=code_type)
+    columns = OrderedDict([
+        ('NO', np.repeat(edge_nos, len(keys))),
+        ('VehType', pd.Categorical.from_codes(np.tile(veh_type_codes, len(edge_nos)), veh_types)),
+        ('Period', np.tile(np.array([period for _, period in keys]), len(edge_nos))),
+        ('TRAVTMNEW', long_values(travel_time_cols, np.float32 if downcast else np.float64)),
+        ('VOLNEW', long_values(volume_cols, np.int64)),
+    ])
+    if downcast:
+        for col in ('NO', 'Period', 'VOLNEW'):
+            columns[col] = columns[col].astype(TIMEVOL_DTYPES[col], copy=False)
+    # the arrays are new, build the frame on them without copies
+    return pd.DataFrame(columns, copy=False)
+
+
+def concat_timevol_tables(tables: Iterable[pd.DataFrame], **kwargs) -> pd.DataFrame:
+    """
+    This function concatenates timevol_table outputs, such as the tables of several cost files. Categorical VehType
+    columns are set to the union of the vehicle types of all tables first, which pd.concat would otherwise turn into
+    object columns.
+    :param tables: dataframes from timevol_table
+    :param kwargs: other arguments of pd.concat
+    :return: concatenated dataframe
+    """
+    tables = list(tables)
+    if tables and all(isinstance(table['VehType'].dtype, pd.CategoricalDtype) for table in tables):
+        veh_types = pd.CategoricalDtype(sorted(set().union(*(table['VehType'].cat.categories for table in tables))))
+        tables = [table.assign(VehType=table['VehType'].astype(veh_types)) for table in tables]
+    return pd.concat(tables, **kwargs)
+
+
+def column_converter(name: str) -> Callable[[str], Union[int, float, str]]:
+    """
+    This function returns the function converting a single cell of the given dynamic assignment column from its text
+
+    Empty cells become 0 in int columns and NaN in float columns, as in the tables built by
+    dynamic_assignment_file_read.
+
+    :param name: str of field name
+    :return: function converting the text of one cell
+    """
+    coltype = colu_to_type(name)
+    if coltype is int:
+        def convert(value: str) -> int:
+            if not value:
+                return 0
+            try:
+                return int(value)
+            except ValueError:
+                return int(float(value))
+        return convert
+    if coltype is float:
+        def convert(value: str) -> float:
+            return float(value) if value else float('nan')
+        return convert
+    return str
+
+
+BUFFERTYPE = {int: ('q', np.int64), float: ('d', np.float64)}
+
+
+def dynamic_assignment_file_read(file: [str, TextIOWrapper],
+                                 tables: Optional[Sequence[str]] = None) -> Dict[str, pd.DataFrame]:
     """
     This function reads a VISSIM dynamic assignment file with extension bew or weg and converts all the contained tables
     to dataframes
 
+    The file is streamed one line at a time. Each cell is converted to its column type as it is read into a typed
+    column buffer, and every table's dataframe is built once at the end of the file.
+
     :param file: either a str path to the file or a file wrapper it self.
+    :param tables: names of the tables to return, e.g. ['VolTime'], all tables are returned if None. Rows of the other
+    tables are skipped without being converted.
     :return: a dictionary of dataframes referenced by their table content from VISSIM file
     """
 
@@ -92,42 +170,237 @@ def dynamic_assignment_file_read(file: [str, TextIOWrapper]) -> Dict[str, pd.Dat
         fileIO: TextIOWrapper = file
 
     tablenames = ["DynAsnAttr", "EdgeAttr", "VolTime"]
-    output_dict: Dict[str, pd.DataFrame] = {}
+    wanted = set(tablenames if tables is None else tables)
+    columns: Dict[str, Sequence[str]] = {}
+    buffers: Dict[str, list] = {}
+    converters: Sequence[Callable] = []
+    current_buffers: list = []
     current_table: str = ""
-    attributes: Sequence[str] = []
 
-    for line in fileIO.readlines():
+    for line in fileIO:
         # add tablename
         if line[:8] == "* Table:":
-            current_table = tablenames[0]
-            tablenames = tablenames[1:]
+            if wanted.issubset(buffers):
+                # every requested table is complete
+                break
+            current_table = tablenames.pop(0) if tablenames else ""
 
-        # create table dataframe
-        elif line[0] == '$' and current_table:
-            if current_table not in output_dict:
+        # create table column buffers
+        elif line[0] == '$' and current_table in wanted:
+            if current_table not in buffers:
                 attributes = line.strip().strip('\n').split(':')[1].split(';')
-                output_dict[current_table] = pd.DataFrame(columns=attributes)
+                columns[current_table] = attributes
+                converters = [column_converter(attr) for attr in attributes]
+                coltypes = [colu_to_type(attr) for attr in attributes]
+                current_buffers = [array(BUFFERTYPE[coltype][0]) if coltype in BUFFERTYPE else []
+                                   for coltype in coltypes]
+                buffers[current_table] = current_buffers
 
-        # append datarow to dataframe
+        # convert datarow into the column buffers
         split_line = line.strip().strip('\n').split(';')
-        if str.isdigit(split_line[0]) and current_table in output_dict:
-            split_line = [tonumeric(value) for value in split_line]
-            output_dict[current_table] = output_dict[current_table] \
-                .append(dict(zip(attributes, split_line)), ignore_index=True)
-
-    # cast each column to the correct type
-    for frame in output_dict.values():
-        for col in frame.columns.values:
-            coltype = colu_to_type(col)
-            if coltype is int:
-                frame[col] = frame[col].fillna(0)
-            frame[col] = frame[col].astype(coltype)
+        if current_table in buffers and str.isdigit(split_line[0]):
+            if len(split_line) < len(current_buffers):
+                split_line += [''] * (len(current_buffers) - len(split_line))
+            for buffer, convert, value in zip(current_buffers, converters, split_line):
+                buffer.append(convert(value))
 
     if type(file) is str:
         fileIO.close()
 
+    # build each dataframe once from its column buffers
+    output_dict: Dict[str, pd.DataFrame] = {}
+    for table, attributes in columns.items():
+        frame_columns = OrderedDict()
+        for attr, buffer in zip(attributes, buffers[table]):
+            coltype = colu_to_type(attr)
+            if coltype in BUFFERTYPE:
+                frame_columns[attr] = np.array(buffer, dtype=BUFFERTYPE[coltype][1])
+            else:
+                frame_columns[attr] = np.array(buffer, dtype=object)
+        output_dict[table] = pd.DataFrame(frame_columns, columns=attributes)
+
     return output_dict
 
+
+def _digits_to_int(data: np.ndarray, starts: np.ndarray, ends: np.ndarray) -> np.ndarray:
+    """
+    This function converts the decimal numbers in the byte ranges of data to integers all at once
+    :param data: uint8 array of text
+    :param starts: first byte of every number
+    :param ends: byte after every number
+    :return: int64 array of the numbers
+    """
+    lengths = ends - starts
+    width = int(lengths.max()) if len(lengths) else 0
+    digit = np.arange(width)
+    digits = data[np.minimum(starts[:, None] + digit, len(data) - 1)].astype(np.int64) - 48
+    powers = 10 ** np.maximum(lengths[:, None] - 1 - digit, 0)
+    return np.where(digit < lengths[:, None], digits * powers, 0).sum(axis=1)
+
+
+class PathFileIndex:
+    """
+    This class indexes the paths of a VISSIM dynamic assignment path file (.weg) by their parking lots
+
+    The path table is the table whose header has FROMPARKLOT, TOPARKLOT and EDGESEQ columns, its EDGESEQ cells are
+    comma separated edge numbers. The file is read in blocks and the lots of all rows of a block are parsed at once
+    with numpy, only the file offset of every path is kept. The edge sequence is read for the first path of every lot,
+    to find its first or last edge, and for the paths of a lot pair the first time they are asked for, so the python
+    work of building the index grows with the number of lots rather than the number of paths.
+    """
+    PATH_COLUMNS = ('FROMPARKLOT', 'TOPARKLOT', 'EDGESEQ')
+
+    def __init__(self, file_path: str, block_size: int = 2 ** 24):
+        """
+        :param file_path: path to the .weg file
+        :param block_size: number of bytes read at a time
+        """
+        self.file_path = file_path
+        self.first_edge: Dict[int, int] = OrderedDict()
+        self.last_edge: Dict[int, int] = OrderedDict()
+        # position of EDGESEQ in the rows of the path table
+        self.edge_seq_column: Optional[int] = None
+        self._edges: Dict[Tuple[int, int], List[np.ndarray]] = {}
+
+        keys, offsets = [], []
+        columns = None
+        base = 0
+        rest = b''
+        with open(file_path, 'rb') as file:
+            while True:
+                block = file.read(block_size)
+                text = rest + block
+                # blocks end on a full line, the last partial line is carried to the next block
+                cut = text.rfind(b'\n') + 1 if block else len(text)
+                text, rest = text[:cut], text[cut:]
+                if text:
+                    columns = self._read_block(text, base, columns, keys, offsets)
+                base += cut
+                if not block:
+                    break
+
+        keys = np.concatenate(keys) if keys else np.empty(0, dtype=np.int64)
+        offsets = np.concatenate(offsets) if offsets else np.empty(0, dtype=np.int64)
+        order = np.argsort(keys, kind='stable')
+        # offsets grouped by lot pair in file order, the paths of a pair are offsets[bounds[i]:bounds[i + 1]]
+        self.offsets = offsets[order]
+        self.pair_keys, bounds = np.unique(keys[order], return_index=True)
+        self.bounds = np.r_[bounds, len(keys)]
+        self.path_count = len(keys)
+
+    def _read_block(self, text: bytes, base: int, columns: Optional[List[int]], keys: List[np.ndarray],
+                    offsets: List[np.ndarray]) -> Optional[List[int]]:
+        # index the path rows of a block of full lines starting at file offset base, columns are the positions of the
+        # path columns in the current table and are returned as they are at the end of the block
+        data = np.frombuffer(text, dtype=np.uint8)
+        ends = np.flatnonzero(data == 10)
+        if len(ends) == 0 or ends[-1] != len(data) - 1:
+            ends = np.r_[ends, len(data)]
+        starts = np.r_[0, ends[:-1] + 1]
+        first_bytes = data[np.minimum(starts, len(data) - 1)]
+        headers = np.flatnonzero(first_bytes == ord('$'))
+        semicolons = np.flatnonzero(data == ord(';'))
+
+        for segment_start, segment_end, header in zip(np.r_[0, headers + 1], np.r_[headers, len(starts)],
+                                                      np.r_[-1, headers]):
+            if header >= 0:
+                line = text[starts[header]:ends[header]].strip()
+                attributes = line.split(b':', 1)[-1].decode('latin-1').upper().split(';')
+                columns = [attributes.index(col) for col in self.PATH_COLUMNS] \
+                    if set(self.PATH_COLUMNS).issubset(attributes) else None
+                if columns is not None:
+                    self.edge_seq_column = columns[2]
+            if columns is None:
+                continue
+            rows = segment_start + np.flatnonzero((first_bytes[segment_start:segment_end] >= ord('0')) &
+                                                  (first_bytes[segment_start:segment_end] <= ord('9')))
+            if len(rows) == 0:
+                continue
+
+            row_starts, row_ends = starts[rows], ends[rows]
+            # drop the carriage return of windows line ends
+            row_ends = row_ends - (data[np.maximum(row_ends - 1, 0)] == 13)
+            first_semicolon = np.searchsorted(semicolons, row_starts)
+            semicolon_count = np.searchsorted(semicolons, row_ends) - first_semicolon
+            if (semicolon_count < max(columns)).any():
+                raise ValueError("\"{}\" has path rows with fewer than {} cells"
+                                 .format(self.file_path, max(columns) + 1))
+
+            def cell(column):
+                cell_starts = row_starts if column == 0 else semicolons[first_semicolon + column - 1] + 1
+                last = column >= semicolon_count
+                cell_ends = np.where(last, row_ends,
+                                     semicolons[np.minimum(first_semicolon + column, len(semicolons) - 1)])
+                return cell_starts, cell_ends
+
+            from_lots = _digits_to_int(data, *cell(columns[0]))
+            to_lots = _digits_to_int(data, *cell(columns[1]))
+            keys.append(from_lots << 32 | to_lots)
+            offsets.append(base + row_starts)
+
+            # only the first path of a lot not seen before is looked at
+            seq_starts, seq_ends = cell(columns[2])
+            for lots, lot_edge, first in ((from_lots, self.first_edge, True), (to_lots, self.last_edge, False)):
+                lot_values, lot_rows = np.unique(lots, return_index=True)
+                for lot, row in zip(lot_values.tolist(), lot_rows.tolist()):
+                    if lot not in lot_edge:
+                        edge_seq = text[seq_starts[row]:seq_ends[row]]
+                        lot_edge[lot] = int(edge_seq.partition(b',')[0] if first else edge_seq.rpartition(b',')[2])
+        return columns
+
+    def _pair_position(self, from_lot: int, to_lot: int) -> int:
+        key = int(from_lot) << 32 | int(to_lot)
+        position = int(np.searchsorted(self.pair_keys, key))
+        return position if position < len(self.pair_keys) and self.pair_keys[position] == key else -1
+
+    def __len__(self) -> int:
+        return len(self.pair_keys)
+
+    def __contains__(self, lot_pair: Tuple[int, int]) -> bool:
+        return self._pair_position(*lot_pair) >= 0
+
+    def __iter__(self) -> Iterator[Tuple[int, int]]:
+        return ((key >> 32, key & 0xFFFFFFFF) for key in self.pair_keys.tolist())
+
+    def __getitem__(self, lot_pair: Tuple[int, int]) -> List[np.ndarray]:
+        return self.paths(*lot_pair)
+
+    def origin_edges(self) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        :return: arrays of the origin parking lots and the first edge of their paths
+        """
+        return np.fromiter(self.first_edge.keys(), dtype=np.int64, count=len(self.first_edge)), \
+            np.fromiter(self.first_edge.values(), dtype=np.int64, count=len(self.first_edge))
+
+    def destination_edges(self) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        :return: arrays of the destination parking lots and the last edge of their paths
+        """
+        return np.fromiter(self.last_edge.keys(), dtype=np.int64, count=len(self.last_edge)), \
+            np.fromiter(self.last_edge.values(), dtype=np.int64, count=len(self.last_edge))
+
+    def paths(self, from_lot: int, to_lot: int) -> List[np.ndarray]:
+        """
+        This function reads the paths between two parking lots from the file
+        :param from_lot: origin parking lot number
+        :param to_lot: destination parking lot number
+        :return: list of edge number arrays in file order, empty if the file has no path between the lots
+        """
+        lot_pair = (int(from_lot), int(to_lot))
+        edges = self._edges.get(lot_pair)
+        if edges is None:
+            edges = []
+            position = self._pair_position(*lot_pair)
+            if position >= 0:
+                with open(self.file_path, 'rb') as file:
+                    for offset in self.offsets[self.bounds[position]:self.bounds[position + 1]].tolist():
+                        file.seek(offset)
+                        cells = file.readline().rstrip(b'\r\n').split(b';')
+                        edges.append(np.array(cells[self.edge_seq_column].split(b','), dtype=np.int64))
+            self._edges[lot_pair] = edges
+        return edges
+
+
 if __name__ == "__main__":
     file = r"C:\Users\ollie\OneDrive\Documents\University Documents\Thesis\Urban Freeway Dyn Assign Redmond.US\Sim 3\ref_tsm.bew"
     tables = dynamic_assignment_file_read(file)
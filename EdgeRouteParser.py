@@ -1,15 +1,21 @@
-from typing import Sequence
-from os import path, walk, getenv
+from typing import Sequence, Optional, Iterable, Iterator, Tuple, List
+from os import path, walk, getenv, makedirs
+import hashlib
+import logging
+import re
 import pathos.multiprocessing as mp
-from DynFileFuncs import dynamic_assignment_file_read, timevol_table
+from DynFileFuncs import dynamic_assignment_file_read, timevol_table, concat_timevol_tables
+from TimeVolCache import TimeVolCache, write_columnar, read_columnar
+import numpy as np
 import pandas as pd
 
-def files_by_ext(parent_dir: str, ext: str) -> Sequence[str]:
+
+def iter_files_by_ext(parent_dir: str, ext: str) -> Iterator[str]:
     """
-    This function finds all files with the provided extension under the provided parent_dir
+    This function lazily finds all files with the provided extension under the provided parent_dir
     :param parent_dir: a folder string path to search
     :param ext: a file extension
-    :return: a list of full string paths
+    :return: generator of full string paths, yielded as the folders are walked
     """
     parent_dir = parent_dir.strip('"').strip("'")
     if not path.isdir(parent_dir):
@@ -19,13 +25,23 @@ def files_by_ext(parent_dir: str, ext: str) -> Sequence[str]:
     if not ext:
         raise ValueError(ext + " is not a valid extension to search")
 
-    file_paths = []
-    for root, directories, files in walk(parent_dir):
-        for file in files:
-            if file.endswith('.' + ext):
-                file_paths.append(path.join(root, file))
+    def walk_files():
+        for root, directories, files in walk(parent_dir):
+            for file in files:
+                if file.endswith('.' + ext):
+                    yield path.join(root, file)
 
-    return file_paths
+    return walk_files()
+
+
+def files_by_ext(parent_dir: str, ext: str) -> Sequence[str]:
+    """
+    This function finds all files with the provided extension under the provided parent_dir
+    :param parent_dir: a folder string path to search
+    :param ext: a file extension
+    :return: a list of full string paths
+    """
+    return list(iter_files_by_ext(parent_dir, ext))
 
 
 def functions_expansion(*args):
@@ -36,26 +52,144 @@ def functions_expansion(*args):
     return map_func
 
 
-# gather list of route files
-if __name__ == "__main__":
-    def read_edge_vol_delay(in_files: Sequence[str]) -> pd.DataFrame:
+logger = logging.getLogger(__name__)
+
+ITERATION_PATTERN = re.compile(r'_(\d+)$')
+DEMAND_PATTERN = re.compile(r'^Vol(\d+(?:\.\d+)?)per$')
+
+
+def scenario_metadata(file_path: str) -> Tuple[int, float]:
+    """
+    This function reads the iteration number and demand level of a cost file from its path, such as
+    Vol80per/costs_012.bew for iteration 12 at 80 % demand. Windows and POSIX separators are both accepted.
+    :param file_path: path to a .bew file
+    :return: iteration number and demand as a fraction
+    """
+    parts = re.split(r'[\\/]+', file_path)
+    iteration = ITERATION_PATTERN.search(parts[-1].split('.')[0])
+    demand = [DEMAND_PATTERN.match(folder) for folder in reversed(parts[:-1])]
+    demand = next((match for match in demand if match), None)
+    if iteration is None or demand is None:
+        raise ValueError("\"{}\" is not named as <name>_<iteration> in a Vol<percent>per folder".format(file_path))
+    return int(iteration.group(1)), float(demand.group(1)) / 100
+
+
+def parse_scenario_file(file_path: str) -> Tuple[str, pd.DataFrame]:
+    """
+    This function parses the edge volume and travel time table of a cost file and adds its ITR and Demand columns. It
+    is the worker of the ingestion pool.
+    :param file_path: path to a .bew file
+    :return: file path and dataframe of timevol_table rows with ITR and Demand columns
+    """
+    itr, demand = scenario_metadata(file_path)
+    table = timevol_table(dynamic_assignment_file_read(file_path, ['VolTime'])['VolTime'])
+    table['ITR'] = np.int16(itr)
+    table['Demand'] = np.float32(demand)
+    return file_path, table
+
+
+def read_edge_vol_delay(in_files: Sequence[str], cache: Optional[TimeVolCache] = None) -> pd.DataFrame:
+    """
+    This function reads the edge volume and travel time tables of dynamic assignment cost files
+    :param in_files: paths to .bew files named with their iteration number and stored in folders named by demand level
+    :param cache: parsed file cache, only files missing from it are parsed
+    :return: dataframe of timevol_table rows from all files with ITR and Demand columns
+    """
+    tables = [None] * len(in_files)
+    to_parse = list(range(len(in_files)))
+    if cache is not None:
+        to_parse = [index for index, fr in enumerate(in_files) if cache.lookup(fr) is None]
+        for index in set(range(len(in_files))) - set(to_parse):
+            # text columns come back categorical like freshly parsed tables
+            tables[index] = cache.get(in_files[index], categorical=True)
+
+    if to_parse:
         with mp.Pool() as pool:
-            tables = pool.map(functions_expansion(dynamic_assignment_file_read,
+            parsed = pool.map(functions_expansion(dynamic_assignment_file_read,
                                                   lambda tbd: tbd['VolTime'],
                                                   timevol_table
-                                                  ), in_files)
-
-        sim_itr = [int(path.basename(fr).split('.')[0].split('_')[-1]) for fr in in_files]
-        for itr, table in zip(sim_itr, tables):
-            table['ITR'] = itr
-
-        sim_dem = [float(path.split(path.split(fr)[0])[-1].replace('Vol','').replace('per','')) / 100 for fr in in_files]
-        for dem, table in zip(sim_dem, tables):
-            table['Demand'] = dem
-
-        return pd.concat(tables)
-    
-    files = files_by_ext(path.abspath(r"..\Urban Freeway Dyn Assign Redmond.US"), 'bew')
-    files = [file for file in files if '_' in path.split(file)[-1]]
-    funcs = functions_expansion(dynamic_assignment_file_read, lambda tbd: tbd['VolTime'], timevol_table)
-    edge_volume_time = read_edge_vol_delay(files)
+                                                  ), [in_files[index] for index in to_parse])
+        for index, table in zip(to_parse, parsed):
+            tables[index] = table
+            if cache is not None:
+                cache.store(in_files[index], table)
+
+    for fr, table in zip(in_files, tables):
+        itr, demand = scenario_metadata(fr)
+        table['ITR'] = np.int16(itr)
+        table['Demand'] = np.float32(demand)
+
+    return concat_timevol_tables(tables)
+
+
+def partition_name(file_path: str) -> str:
+    """
+    :param file_path: path to a cost file
+    :return: file name of the dataset partition holding the file's table
+    """
+    itr, demand = scenario_metadata(file_path)
+    path_hash = hashlib.sha1(path.abspath(file_path).encode()).hexdigest()[:10]
+    return "Vol{:g}per_{:03d}_{}.npz".format(demand * 100, itr, path_hash)
+
+
+def ingest_edge_vol_delay(in_files: Iterable[str], dataset_dir: str, processes: Optional[int] = None,
+                          chunksize: int = 4) -> List[str]:
+    """
+    This function parses cost files into an on disk dataset with one columnar partition per file. Files are taken
+    lazily from in_files and parsed in a process pool, and each table is written as soon as its file is done, so at
+    most a few tables are held in memory however many files there are. Files whose partition is newer than the file
+    are skipped, as are files not named as scenario_metadata expects, with a logged warning.
+    :param in_files: paths to .bew files named with their iteration number and stored in folders named by demand level,
+        such as a generator from iter_files_by_ext
+    :param dataset_dir: folder the partitions are written to
+    :param processes: number of worker processes, defaults to the number of cores
+    :param chunksize: number of files sent to a worker at a time
+    :return: paths of the partitions written
+    """
+    if not path.isdir(dataset_dir):
+        makedirs(dataset_dir)
+
+    def outdated(file_path):
+        try:
+            partition = path.join(dataset_dir, partition_name(file_path))
+        except ValueError as error:
+            logger.warning("Skipping %s", error)
+            return False
+        return not path.exists(partition) or path.getmtime(partition) < path.getmtime(file_path)
+
+    written = []
+    with mp.Pool(processes) as pool:
+        for file_path, table in pool.imap_unordered(parse_scenario_file, filter(outdated, in_files), chunksize):
+            partition = path.join(dataset_dir, partition_name(file_path))
+            write_columnar(table, partition)
+            written.append(partition)
+    return written
+
+
+def iter_dataset(dataset_dir: str, categorical: bool = True) -> Iterator[pd.DataFrame]:
+    """
+    This function reads the partitions of a dataset written by ingest_edge_vol_delay one at a time
+    :param dataset_dir: dataset folder
+    :param categorical: whether VehType is returned as categorical
+    :return: generator of partition dataframes in file name order
+    """
+    for name in sorted(name for name in next(walk(dataset_dir))[2] if name.endswith('.npz')):
+        yield read_columnar(path.join(dataset_dir, name), categorical=categorical)
+
+
+def read_dataset(dataset_dir: str, categorical: bool = True) -> pd.DataFrame:
+    """
+    This function reads a whole dataset written by ingest_edge_vol_delay
+    :param dataset_dir: dataset folder
+    :param categorical: whether VehType is returned as categorical
+    :return: dataframe in the read_edge_vol_delay layout
+    """
+    return concat_timevol_tables(iter_dataset(dataset_dir, categorical), ignore_index=True)
+
+
+# gather list of route files
+if __name__ == "__main__":
+    files = iter_files_by_ext(path.abspath(r"..\Urban Freeway Dyn Assign Redmond.US"), 'bew')
+    files = (file for file in files if '_' in path.split(file)[-1])
+    logging.basicConfig(format='%(levelname)s: %(message)s')
+    ingest_edge_vol_delay(files, getenv('EDGE_VOL_DELAY_DATASET', path.abspath('edge_vol_delay')))
@@ -1,34 +1,136 @@
 import pandas as pd
 import numpy as np
-from collections import OrderedDict
+from typing import Sequence, Optional, Tuple
 
 
-class EdgeModel:
+class NetworkModel:
     """
-    This class will provide fitting and be a callable object to estimate marginal cost
+    This model fits and computes the travel time and marginal travel time for all edges in a dynamic assignment graph
+    for vissim
+
+    Every edge follows a BPR style volume delay curve
+
+        t(v) = t0 + a * v ** b
+
+    which is the BPR function t0 * (1 + alpha * (v / c) ** b) with a = t0 * alpha / c ** b. The parameters of all edges
+    are stored as arrays in the order of the edge table and fitted at once by least squares from timevol_table output.
+    The marginal cost of an edge is the delay one more vehicle adds to the vehicles already on it, v * dt/dv, so the
+    system optimal weight of an edge is its travel time plus its marginal cost.
     """
 
-    def __init__(self, data: [pd.DataFrame, None] = None):
-        """7
-        Class init method,
-        :param data:
+    def __init__(self, vis_edges: pd.DataFrame, free_flow_time: Optional[Sequence[float]] = None):
         """
-        if data:
-            # Run model fitting algorithm
+        :param vis_edges: VISSIM edge table indexed by edge number, as VissimRoadNet.visedges
+        :param free_flow_time: travel time of every edge without volume used for edges without data, defaults to the
+            edge length at 35 mph
+        """
+        self.edges = vis_edges
+        if free_flow_time is None:
+            free_flow_time = vis_edges['Length'].values / 51.3333  # ft/s or 35 mph
+        self.free_flow_time = np.array(free_flow_time, dtype=float)
+        self.scale = np.zeros(vis_edges.shape[0])
+        self.power = np.full(vis_edges.shape[0], 4.)
+        self.observations = np.zeros(vis_edges.shape[0], dtype=np.int64)
+        self.sse = np.zeros(vis_edges.shape[0])
 
-            pass
+    def fit(self, timevol: pd.DataFrame, powers: Sequence[float] = (1., 2., 3., 4., 5., 6.),
+            min_observations: int = 3) -> 'NetworkModel':
+        """
+        This function fits the volume delay curves of all edges to travel times and volumes of dynamic assignment
+        periods. Vehicle types are combined per edge and period, with travel times weighted by volume. For every
+        power the free flow time and scale of all edges are solved at once from per edge sums, and each edge keeps
+        the power with the smallest squared error. Edges with fewer than min_observations periods keep a flat curve.
+        :param timevol: dataframe with NO, VehType, Period, TRAVTMNEW and VOLNEW columns from timevol_table, or the
+            output of read_edge_vol_delay holding periods of several simulations
+        :param powers: candidate values of the power b
+        :param min_observations: least number of periods needed to fit the curve of an edge
+        :return: this model
+        """
+        data = timevol[(timevol['TRAVTMNEW'] > 0).values & np.isfinite(timevol['VOLNEW'].values)]
+        position = self.edges.index.get_indexer(data['NO'])
+        data = data.assign(Position=position, WeightedTime=data['TRAVTMNEW'] * data['VOLNEW'])[position >= 0]
 
+        # combine vehicle types of the same edge and period, other columns such as ITR and Demand tell simulations apart
+        keys = ['Position', 'Period'] + [col for col in timevol.columns
+                                         if col not in ('NO', 'Period', 'VehType', 'TRAVTMNEW', 'VOLNEW')]
+        periods = data.groupby(keys, sort=False) \
+            .agg({'TRAVTMNEW': 'mean', 'WeightedTime': 'sum', 'VOLNEW': 'sum'}).reset_index()
+        volume = periods['VOLNEW'].values.astype(float)
+        time = np.where(volume > 0, periods['WeightedTime'].values / np.where(volume > 0, volume, 1.),
+                        periods['TRAVTMNEW'].values)
+        position = periods['Position'].values
+        edges = self.edges.shape[0]
 
-class NetworkModel:
-    """
-    This model fits and computes the travel time and marginal travel time for all edges in a dynamic assignment graph
-    for vissim
-    """
+        def edge_sum(values):
+            return np.bincount(position, weights=values, minlength=edges)
 
-    def __init__(self, vis_edges: pd.DataFrame):
-        self.edges = vis_edges
+        count = np.bincount(position, minlength=edges)
+        sum_t, sum_tt = edge_sum(time), edge_sum(time * time)
+        min_t = np.full(edges, np.inf)
+        np.minimum.at(min_t, position, time)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean_t = sum_t / count
+
+        best_sse = np.full(edges, np.inf)
+        best_t0 = np.where(count > 0, mean_t, self.free_flow_time)
+        best_scale = np.zeros(edges)
+        best_power = np.full(edges, 4.)
+        for power in powers:
+            x = volume ** power
+            sum_x, sum_xx, sum_xt = edge_sum(x), edge_sum(x * x), edge_sum(x * time)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                scale = (count * sum_xt - sum_x * sum_t) / (count * sum_xx - sum_x * sum_x)
+                t0 = (sum_t - scale * sum_x) / count
+                # travel time can not fall with volume, and free flow time lies between 0 and the fastest period
+                flat = ~np.isfinite(scale) | (scale < 0)
+                scale[flat] = 0.
+                t0[flat] = mean_t[flat]
+                bounded = (t0 > min_t) | (t0 < 0)
+                t0[bounded] = np.clip(t0[bounded], 0., min_t[bounded])
+                scale[bounded] = np.maximum((sum_xt[bounded] - t0[bounded] * sum_x[bounded]) / sum_xx[bounded], 0.)
+            scale[~np.isfinite(scale)] = 0.
+            sse = sum_tt - 2 * t0 * sum_t - 2 * scale * sum_xt + count * t0 ** 2 + 2 * t0 * scale * sum_x \
+                + scale ** 2 * sum_xx
+            better = (count >= min_observations) & (sse < best_sse)
+            best_sse[better] = sse[better]
+            best_t0[better] = t0[better]
+            best_scale[better] = scale[better]
+            best_power[better] = power
+
+        fitted = count > 0
+        self.free_flow_time[fitted] = best_t0[fitted]
+        self.scale = np.where(count >= min_observations, best_scale, 0.)
+        self.power = best_power
+        self.observations = count
+        self.sse = np.where(np.isfinite(best_sse), best_sse, 0.)
+        return self
+
+    def evaluate(self, volume: Sequence[float]) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        This function computes travel time and marginal cost of every edge
+        :param volume: volume of every edge in edge table order, in the units of the fitted VOLNEW
+        :return: arrays of travel time and marginal cost
+        """
+        delay = self.scale * np.asarray(volume, dtype=float) ** self.power
+        return self.free_flow_time + delay, self.power * delay
+
+    def travel_time(self, volume: Sequence[float]) -> np.ndarray:
+        """
+        :param volume: volume of every edge in edge table order
+        :return: travel time of every edge
+        """
+        return self.evaluate(volume)[0]
 
-        # generate dictionary to store the models
-        models = [None] * vis_edges.shape[0]
-        models = zip(vis_edges.index, models)
-        self.models = OrderedDict(models)
+    def marginal_cost(self, volume: Sequence[float]) -> np.ndarray:
+        """
+        :param volume: volume of every edge in edge table order
+        :return: delay one more vehicle adds to the vehicles on every edge
+        """
+        return self.evaluate(volume)[1]
+
+    def parameters(self) -> pd.DataFrame:
+        """
+        :return: dataframe of the fitted free flow time, scale, power, number of periods and squared error by edge
+        """
+        return pd.DataFrame({'FreeFlowTime': self.free_flow_time, 'Scale': self.scale, 'Power': self.power,
+                             'Observations': self.observations, 'SSE': self.sse}, index=self.edges.index)
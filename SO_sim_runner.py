@@ -1,2 +1,325 @@
-import win32com.client as com
+"""
+System optimal routing control loop for VISSIM dynamic assignment simulations
 
+The loop reroutes every departed vehicle on the least costly path of the VissimRoadNet weights, which are refreshed
+every dynamic assignment evaluation interval. Pass a StepProfiler to run_so or run_so_pipelined to record where the
+time of every step goes.
+
+run_so_pipelined runs the same loop with the route searches of a step computed by a worker process while the following
+steps are simulated, and the routes assigned lookahead steps later.
+"""
+from collections import deque
+from concurrent.futures import Executor, Future, ProcessPoolExecutor
+from math import ceil
+from time import perf_counter
+from typing import List, Tuple, Optional
+
+from VISSIM_helpers import VissimRoadNet, StepProfiler, VissimPathRegistry, com_error, remove_loops_batch
+
+# routing copy of the graph in a route worker, set by start_route_worker
+_route_graph = None
+
+
+def current_period(vissim) -> int:
+    """
+    :param vissim: VISSIM application object
+    :return: number of the current dynamic assignment evaluation interval
+    """
+    return int(ceil(vissim.Simulation.SimulationSecond / vissim.Net.DynamicAssignment.AttValue('EvalInt')))
+
+
+def _path_adder(vis_net, network_graph: VissimRoadNet, reuse_paths: bool):
+    # function adding the VISSIM path of a route, raising com_error if VISSIM rejects it. Paths and path edges of
+    # earlier runs are not reused, as their path numbers may belong to another simulation
+    network_graph.path_edges = {}
+    if reuse_paths:
+        network_graph.vissim_paths = VissimPathRegistry()
+
+    def add_path(origin_lot, destination_lot, node_path):
+        if reuse_paths:
+            vis_path = network_graph.vissim_paths.path(vis_net, origin_lot, destination_lot, node_path)
+            if vis_path is None:
+                raise com_error("VISSIM rejected the path")
+            return vis_path
+        return vis_net.Paths.AddPath(origin_lot, destination_lot, [str(node) for node in node_path])
+    return add_path
+
+
+def start_route_worker(graph: VissimRoadNet) -> None:
+    """
+    This function keeps the graph a route worker computes routes on, as the initializer of its executor
+    :param graph: routing copy of the network graph, see VissimRoadNet.routing_copy
+    """
+    global _route_graph
+    _route_graph = graph
+
+
+def route_worker_pool(network_graph: VissimRoadNet, max_workers: int = 1) -> ProcessPoolExecutor:
+    """
+    This function starts worker processes computing routes for run_so_pipelined on a routing copy of the graph
+    :param network_graph: VissimRoadNet of the loaded network
+    :param max_workers: number of worker processes, routes are only the same in every run with a single worker
+    :return: executor of the route workers
+    """
+    return ProcessPoolExecutor(max_workers=max_workers, initializer=start_route_worker,
+                               initargs=(network_graph.routing_copy(),))
+
+
+def worker_routes(weights, lot_pairs: List[Tuple[int, int]]) -> Tuple[list, list]:
+    """
+    This function computes the routes of parking lot pairs in a route worker on the weights of a step, with the cost
+    matrix recomputed when the weights change, as update_weights does
+    :param weights: default vehicle class weight of every edge in graph edge order
+    :param lot_pairs: sequence of (origin lot, destination lot) numbers as defined in VISSIM
+    :return: node number sequences and edge number sequences, one per lot pair in input order
+    """
+    _route_graph.set_weights(weights)
+    if _route_graph.lot_costs is None or _route_graph.lot_costs.generation != _route_graph.weight_generation:
+        _route_graph.update_lot_costs()
+    return _route_graph.parking_lot_routes_batch(lot_pairs)
+
+
+def _no_clock() -> float:
+    return 0.
+
+
+def run_so(vissim, network_graph: VissimRoadNet, end_second: float = 4499, warmup_periods: int = 1,
+           profiler: Optional[StepProfiler] = None, remove_node_loops: bool = False,
+           reuse_paths: bool = True) -> List[Tuple]:
+    """
+    This function runs the SO control loop until end_second, rerouting departed vehicles every time step
+    :param vissim: VISSIM application object with a loaded network
+    :param network_graph: VissimRoadNet of the loaded network
+    :param end_second: simulation second after which the loop stops
+    :param warmup_periods: evaluation intervals simulated on the VISSIM assigned paths before rerouting starts
+    :param profiler: StepProfiler recording the time of every loop phase, written to its file_path at the end of the
+        run if it has one
+    :param remove_node_loops: whether loops in the node sequences of the routes, which pass a VISSIM node more than
+        once, are removed before the paths are added
+    :param reuse_paths: whether routes are added to VISSIM once and reused through network_graph.vissim_paths,
+        which also skips node sequences VISSIM rejected before, instead of adding a path for every vehicle. The
+        registry is replaced at the start of the run.
+    :return: list of (node sequence, edge sequence) of paths VISSIM rejected
+    """
+    vis_net = vissim.Net
+    simulation = vissim.Simulation
+    add_path = _path_adder(vis_net, network_graph, reuse_paths)
+    # without a profiler the phases are timed with a clock that always reads 0
+    clock = perf_counter if profiler is not None else _no_clock
+
+    def run_single_step():
+        start = clock()
+        simulation.RunSingleStep()
+        if profiler is not None:
+            profiler.record('run_single_step', clock() - start)
+
+    network_graph.profiler = profiler
+    try:
+        # let VISSIM assign paths until the first travel times are recorded
+        simulation.RunSingleStep()
+        while current_period(vissim) <= warmup_periods:
+            if profiler is not None:
+                profiler.start_step(simulation.SimulationSecond)
+            network_graph.update_volume(vis_net)
+            run_single_step()
+            if profiler is not None:
+                profiler.end_step()
+
+        bad_paths = []
+        while True:
+            if profiler is not None:
+                profiler.start_step(simulation.SimulationSecond)
+            network_graph.update_weights(vis_net)
+            new_vehs = vis_net.Vehicles.GetDeparted().GetAll()
+            lot_pairs = [(int(veh.AttValue('OrigParkLot')), int(veh.AttValue('DestParkLot'))) for veh in new_vehs]
+            node_paths, edge_paths = network_graph.parking_lot_routes_batch(lot_pairs)
+            if remove_node_loops:
+                node_paths = remove_loops_batch(node_paths)
+            add_path_s = assign_path_s = 0.
+            for veh, (origin_lot, destination_lot), node_path, edge_path in zip(new_vehs, lot_pairs, node_paths,
+                                                                                edge_paths):
+                try:
+                    start = clock()
+                    vis_path = add_path(origin_lot, destination_lot, node_path)
+                    added = clock()
+                    add_path_s += added - start
+                    veh.AssignPath(vis_path)
+                    assign_path_s += clock() - added
+                except com_error:
+                    bad_paths.append((node_path, edge_path))
+            if profiler is not None:
+                profiler.record('add_path', add_path_s, len(new_vehs))
+                profiler.record('assign_path', assign_path_s, len(new_vehs))
+            network_graph.update_volume(vis_net)
+            if simulation.SimulationSecond > end_second:
+                if profiler is not None:
+                    profiler.end_step(len(new_vehs))
+                break
+            run_single_step()
+            if profiler is not None:
+                profiler.end_step(len(new_vehs))
+    finally:
+        network_graph.profiler = None
+
+    if profiler is not None and profiler.file_path:
+        profiler.save()
+    return bad_paths
+
+
+def run_so_pipelined(vissim, network_graph: VissimRoadNet, end_second: float = 4499, warmup_periods: int = 1,
+                     lookahead: int = 1, executor: Optional[Executor] = None, profiler: Optional[StepProfiler] = None,
+                     remove_node_loops: bool = False, reuse_paths: bool = True) -> Tuple[List[Tuple], List[int]]:
+    """
+    This function runs the SO control loop until end_second with route computation overlapped with simulation. Every
+    step the departed vehicles are read in bulk and their routes are computed by worker_routes on the weights of the
+    step, in a worker process as igraph searches hold the interpreter lock. The routes of a step are assigned in step
+    order lookahead steps later, so with a single worker the routes and assignments are the same in every run.
+    Vehicles still on the first edge of their path are moved to the new path and their edge volumes are moved with
+    them. Vehicles that arrived or left their first edge before their route was ready keep their path and are returned
+    apart from the rejected paths. With a lookahead of 0 routes are computed on network_graph and assigned in the step
+    the vehicles departed, as in run_so, and no worker is started.
+
+    Overlapping only pays off when VISSIM steps take longer than the route searches and a core is free for the worker.
+    On the stand-in with one core it was slower than run_so with and without step latency, so compare the profiles of
+    both loops before using it. The profiler records the time spent submitting and waiting for routes as
+    parking_lot_routes.
+    :param vissim: VISSIM application object with a loaded network
+    :param network_graph: VissimRoadNet of the loaded network
+    :param end_second: simulation second after which the loop stops
+    :param warmup_periods: evaluation intervals simulated on the VISSIM assigned paths before rerouting starts
+    :param lookahead: number of steps simulated while the routes of a step are computed
+    :param executor: executor computing the routes, whose workers were started by start_route_worker, defaults to a
+        route_worker_pool of one process shut down at the end of the run
+    :param profiler: StepProfiler recording the time of every loop phase, written to its file_path at the end of the
+        run if it has one
+    :param remove_node_loops: whether loops in the node sequences of the routes are removed before the paths are added
+    :param reuse_paths: whether routes are added to VISSIM once and reused through network_graph.vissim_paths,
+        which is replaced at the start of the run
+    :return: list of (node sequence, edge sequence) of paths VISSIM rejected, as in run_so, and list of numbers of
+        the vehicles whose route was ready too late to be assigned
+    """
+    vis_net = vissim.Net
+    simulation = vissim.Simulation
+    add_path = _path_adder(vis_net, network_graph, reuse_paths)
+    # without a profiler the phases are timed with a clock that always reads 0
+    clock = perf_counter if profiler is not None else _no_clock
+    own_executor = executor is None and lookahead > 0
+    if own_executor:
+        executor = route_worker_pool(network_graph)
+
+    bad_paths = []
+    late_vehicles = []
+    # (step, vehicles, vehicle numbers, lot pairs, future routes) of the steps waiting for their routes
+    pending = deque()
+
+    def run_single_step():
+        start = clock()
+        simulation.RunSingleStep()
+        if profiler is not None:
+            profiler.record('run_single_step', clock() - start)
+
+    def assign_routes(step, vehs, veh_nos, lot_pairs, routes, recorded):
+        start = clock()
+        node_paths, edge_paths = routes.result()
+        if profiler is not None and recorded:
+            profiler.record('parking_lot_routes', clock() - start, 0)
+        if remove_node_loops:
+            node_paths = remove_loops_batch(node_paths)
+        add_path_s = assign_path_s = 0.
+        moved_vehs, moved_paths = [], []
+        for veh, veh_no, (origin_lot, destination_lot), node_path, edge_path in zip(vehs, veh_nos, lot_pairs,
+                                                                                    node_paths, edge_paths):
+            if recorded and veh_no not in network_graph.veh_paths:
+                late_vehicles.append(veh_no)  # arrived before its route was ready
+                continue
+            try:
+                start = clock()
+                vis_path = add_path(origin_lot, destination_lot, node_path)
+                added = clock()
+                add_path_s += added - start
+            except com_error:
+                bad_paths.append((node_path, edge_path))
+                continue
+            try:
+                veh.AssignPath(vis_path)
+                assign_path_s += clock() - added
+            except com_error:
+                if recorded:
+                    late_vehicles.append(veh_no)  # left its first edge before its route was ready
+                else:
+                    bad_paths.append((node_path, edge_path))
+                continue
+            if recorded:
+                moved_vehs.append(veh_no)
+                moved_paths.append(network_graph.path_edge_seq(vis_net, vis_path.AttValue('No')))
+        if profiler is not None:
+            profiler.record('add_path', add_path_s, len(vehs))
+            profiler.record('assign_path', assign_path_s, len(vehs))
+        network_graph.reassign_volumes(moved_vehs, moved_paths)
+
+    network_graph.profiler = profiler
+    try:
+        # let VISSIM assign paths until the first travel times are recorded
+        simulation.RunSingleStep()
+        while current_period(vissim) <= warmup_periods:
+            if profiler is not None:
+                profiler.start_step(simulation.SimulationSecond)
+            network_graph.update_volume(vis_net)
+            run_single_step()
+            if profiler is not None:
+                profiler.end_step()
+
+        step = 0
+        while True:
+            if profiler is not None:
+                profiler.start_step(simulation.SimulationSecond)
+            network_graph.update_weights(vis_net)
+            departed = vis_net.Vehicles.GetDeparted()
+            new_vehs = departed.GetAll()
+            attributes = departed.GetMultipleAttributes(['No', 'OrigParkLot', 'DestParkLot'])
+            veh_nos = [int(veh_no) for veh_no, _, _ in attributes]
+            lot_pairs = [(int(origin_lot), int(destination_lot)) for _, origin_lot, destination_lot in attributes]
+            if lookahead > 0:
+                start = clock()
+                routes = executor.submit(worker_routes, network_graph._weights, lot_pairs)
+                if profiler is not None:
+                    profiler.record('parking_lot_routes', clock() - start)
+            else:
+                routes = Future()
+                routes.set_result(network_graph.parking_lot_routes_batch(lot_pairs))
+            pending.append((step, new_vehs, veh_nos, lot_pairs, routes))
+            while len(pending) > lookahead:
+                entry = pending.popleft()
+                assign_routes(*entry, recorded=entry[0] < step)
+            network_graph.update_volume(vis_net)
+            if simulation.SimulationSecond > end_second:
+                if profiler is not None:
+                    profiler.end_step(len(new_vehs))
+                break
+            run_single_step()
+            if profiler is not None:
+                profiler.end_step(len(new_vehs))
+            step += 1
+
+        while pending:
+            assign_routes(*pending.popleft(), recorded=True)
+    finally:
+        network_graph.profiler = None
+        for entry in pending:
+            entry[-1].cancel()
+        if own_executor:
+            executor.shutdown()
+
+    if profiler is not None and profiler.file_path:
+        profiler.save()
+    return bad_paths, late_vehicles
+
+if __name__ == "__main__":
+    import win32com.client as com
+    from os.path import abspath
+
+    Vissim = com.gencache.EnsureDispatch("Vissim.Vissim")
+    Vissim.LoadNet(abspath(r"..\SO sim files\Vol100per.inpx"))
+    Vissim.Simulation.SetAttValue('UseMaxSimSpeed', True)
+    bad_paths = run_so(Vissim, VissimRoadNet(Vissim.Net))
+    print("{} paths rejected by VISSIM".format(len(bad_paths)))
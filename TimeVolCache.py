@@ -0,0 +1,310 @@
+"""
+On disk cache of parsed dynamic assignment cost files
+
+Parsed timevol_table outputs are stored as compressed columnar numpy archives, one per distinct file content. The cache
+index remembers the path, size, modification time and content hash of every file it has seen, so repeat runs only parse
+new or changed files. Several processes can share a cache folder, the index is changed under a lock file.
+
+Inspect or clear the cache from the command line with:
+
+    python TimeVolCache.py info [--cache-dir DIR]
+    python TimeVolCache.py trim [--cache-dir DIR] [--max-bytes BYTES]
+    python TimeVolCache.py clear [--cache-dir DIR]
+"""
+import argparse
+import hashlib
+import json
+import os
+import tempfile
+import time
+from contextlib import contextmanager
+from os import path, getenv
+from typing import Dict, Callable, Optional, Iterator
+
+import numpy as np
+import pandas as pd
+
+from DynFileFuncs import dynamic_assignment_file_read, timevol_table
+
+DEFAULT_CACHE_DIR = getenv('TIMEVOL_CACHE_DIR', path.join(path.expanduser('~'), '.timevol_cache'))
+DEFAULT_MAX_BYTES = int(getenv('TIMEVOL_CACHE_MAX_BYTES', 2 * 1024 ** 3))
+# seconds after which a lock file left by a crashed process is removed
+LOCK_TIMEOUT = 60.
+
+INDEX_COLUMN = '__index__'
+CATEGORIES_SUFFIX = '__categories__'
+
+
+def write_columnar(frame: pd.DataFrame, file_path: str) -> None:
+    """
+    This function writes a dataframe to a compressed numpy archive with one array per column
+
+    Text and categorical columns are stored as integer codes plus their categories. The index is stored as well.
+
+    :param frame: dataframe with numeric, text or categorical columns
+    :param file_path: path of the .npz file to write
+    """
+    arrays = {INDEX_COLUMN: frame.index.values}
+    for col in frame.columns:
+        column = frame[col]
+        if not pd.api.types.is_numeric_dtype(column.dtype):
+            column = column.astype('category')
+            arrays[col] = column.cat.codes.values
+            arrays[col + CATEGORIES_SUFFIX] = np.array(column.cat.categories.astype(str), dtype=str)
+        else:
+            arrays[col] = column.values
+
+    # write to a temporary file first so readers never see a partial file
+    folder, name = path.split(path.abspath(file_path))
+    handle, temp_path = tempfile.mkstemp(suffix='.npz', dir=folder)
+    with os.fdopen(handle, 'wb') as temp_file:
+        np.savez_compressed(temp_file, **arrays)
+    os.replace(temp_path, file_path)
+
+
+def read_columnar(file_path: str, categorical: bool = False) -> pd.DataFrame:
+    """
+    This function reads a dataframe written by write_columnar
+    :param file_path: path of the .npz file
+    :param categorical: whether text columns are returned as categorical instead of str columns
+    :return: dataframe with the stored columns and index
+    """
+    with np.load(file_path, allow_pickle=False) as archive:
+        names = [name for name in archive.files if name != INDEX_COLUMN and not name.endswith(CATEGORIES_SUFFIX)]
+        columns = {}
+        for name in names:
+            if name + CATEGORIES_SUFFIX in archive.files:
+                column = pd.Categorical.from_codes(archive[name], archive[name + CATEGORIES_SUFFIX])
+                columns[name] = column if categorical else np.asarray(column, dtype=object)
+            else:
+                columns[name] = archive[name]
+        return pd.DataFrame(columns, columns=names, index=archive[INDEX_COLUMN])
+
+
+def file_hash(file_path: str, block_size: int = 1024 ** 2) -> str:
+    """
+    This function computes the sha1 hash of a file's content
+    :param file_path: path of the file
+    :param block_size: number of bytes read at a time
+    :return: hex digest
+    """
+    digest = hashlib.sha1()
+    with open(file_path, 'rb') as file:
+        for block in iter(lambda: file.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def parse_voltime(file_path: str) -> pd.DataFrame:
+    """
+    This function parses the VolTime table of a dynamic assignment cost file into a timevol_table
+    :param file_path: path to a .bew file
+    :return: dataframe from timevol_table
+    """
+    return timevol_table(dynamic_assignment_file_read(file_path, ['VolTime'])['VolTime'])
+
+
+class TimeVolCache:
+    """
+    This class caches timevol_table outputs of dynamic assignment cost files on disk
+
+    Entries are looked up by path, size and modification time first, then by content hash, so a touched or copied
+    file is not parsed again. The least recently used entries are evicted once the cache grows over max_bytes, checked
+    every time a table is stored or read from the cache and by trim.
+
+    Every change of the index is made holding the index.lock file of the cache folder, on the index as last written
+    by any process, so processes sharing the folder do not lose each other's entries. Files are parsed without the
+    lock.
+    """
+
+    def __init__(self, cache_dir: str = DEFAULT_CACHE_DIR, max_bytes: int = DEFAULT_MAX_BYTES,
+                 parser: Callable[[str], pd.DataFrame] = parse_voltime):
+        """
+        :param cache_dir: folder holding the cached tables and the index
+        :param max_bytes: largest total size of the cached tables
+        :param parser: function parsing a file path into the table to cache
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.parser = parser
+        self.index_path = path.join(cache_dir, 'index.json')
+        self.lock_path = path.join(cache_dir, 'index.lock')
+        self._lock_depth = 0
+        if not path.isdir(cache_dir):
+            os.makedirs(cache_dir, exist_ok=True)
+        self.index = self._read_index()
+
+    @contextmanager
+    def _locked(self) -> Iterator[None]:
+        # hold the lock file and reload the index, nested calls share the lock of the outermost one
+        if self._lock_depth:
+            self._lock_depth += 1
+            try:
+                yield
+            finally:
+                self._lock_depth -= 1
+            return
+        while True:
+            try:
+                os.close(os.open(self.lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                break
+            except FileExistsError:
+                try:
+                    if time.time() - path.getmtime(self.lock_path) > LOCK_TIMEOUT:
+                        os.remove(self.lock_path)
+                except OSError:
+                    pass  # released in the meantime
+                time.sleep(0.01)
+        self._lock_depth = 1
+        try:
+            self.index = self._read_index()
+            yield
+        finally:
+            self._lock_depth = 0
+            os.remove(self.lock_path)
+
+    def _read_index(self) -> Dict[str, dict]:
+        if not path.exists(self.index_path):
+            return {'files': {}, 'tables': {}}
+        with open(self.index_path, 'r') as index_file:
+            return json.load(index_file)
+
+    def _write_index(self) -> None:
+        handle, temp_path = tempfile.mkstemp(suffix='.json', dir=self.cache_dir)
+        with os.fdopen(handle, 'w') as temp_file:
+            json.dump(self.index, temp_file)
+        os.replace(temp_path, self.index_path)
+
+    def _table_path(self, content_hash: str) -> str:
+        return path.join(self.cache_dir, content_hash + '.npz')
+
+    def lookup(self, file_path: str) -> Optional[str]:
+        """
+        This function finds the content hash of a cached table for the file, if there is one
+        :param file_path: path to the parsed file
+        :return: content hash of the cached table or None if the file has not been cached
+        """
+        file_path = path.abspath(file_path)
+        stat = os.stat(file_path)
+        with self._locked():
+            entry = self.index['files'].get(file_path)
+            if entry and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime \
+                    and entry['hash'] in self.index['tables']:
+                return entry['hash']
+
+        # the file is new or was modified, check if its content was seen before
+        content_hash = file_hash(file_path)
+        with self._locked():
+            self.index['files'][file_path] = {'size': stat.st_size, 'mtime': stat.st_mtime, 'hash': content_hash}
+            self._write_index()
+            if content_hash in self.index['tables'] and path.exists(self._table_path(content_hash)):
+                return content_hash
+        return None
+
+    def get(self, file_path: str, categorical: bool = False) -> pd.DataFrame:
+        """
+        This function returns the parsed table of the file, parsing and caching it if needed
+        :param file_path: path to the file
+        :param categorical: whether text columns are returned as categorical
+        :return: parsed dataframe
+        """
+        content_hash = self.lookup(file_path)
+        if content_hash is not None:
+            with self._locked():
+                if content_hash in self.index['tables']:
+                    self.index['tables'][content_hash]['used'] = time.time()
+                    self.evict()
+                    self._write_index()
+            try:
+                return read_columnar(self._table_path(content_hash), categorical=categorical)
+            except FileNotFoundError:
+                pass  # evicted by another process since the lookup
+        table = self.parser(file_path)
+        self.store(file_path, table)
+        return table
+
+    def store(self, file_path: str, table: pd.DataFrame) -> None:
+        """
+        This function adds the parsed table of the file to the cache and evicts old tables if the cache is too large
+        :param file_path: path to the parsed file
+        :param table: parsed dataframe
+        """
+        with self._locked():
+            entry = self.index['files'].get(path.abspath(file_path))
+            if entry is None:
+                self.lookup(file_path)
+                entry = self.index['files'][path.abspath(file_path)]
+            content_hash = entry['hash']
+            if content_hash not in self.index['tables'] or not path.exists(self._table_path(content_hash)):
+                write_columnar(table, self._table_path(content_hash))
+                self.index['tables'][content_hash] = {'bytes': path.getsize(self._table_path(content_hash))}
+            self.index['tables'][content_hash]['used'] = time.time()
+            self.evict()
+            self._write_index()
+
+    def evict(self) -> None:
+        """
+        This function removes the least recently used tables until the cache fits in max_bytes
+        """
+        tables = self.index['tables']
+        total = sum(table['bytes'] for table in tables.values())
+        for content_hash in sorted(tables, key=lambda ch: tables[ch]['used']):
+            if total <= self.max_bytes:
+                break
+            total -= tables.pop(content_hash)['bytes']
+            if path.exists(self._table_path(content_hash)):
+                os.remove(self._table_path(content_hash))
+        # forget files whose tables are gone
+        self.index['files'] = {file_path: entry for file_path, entry in self.index['files'].items()
+                               if entry['hash'] in tables}
+
+    def trim(self) -> None:
+        """
+        This function evicts the least recently used tables until the cache fits in max_bytes, for a cache that grew
+        over a smaller max_bytes than it was filled with
+        """
+        with self._locked():
+            self.evict()
+            self._write_index()
+
+    def info(self) -> dict:
+        """
+        This function summarizes the cache content
+        :return: dictionary with the cache folder, number of files and tables, and total and maximum size in bytes
+        """
+        self.index = self._read_index()
+        return {
+            'cache_dir': self.cache_dir,
+            'files': len(self.index['files']),
+            'tables': len(self.index['tables']),
+            'bytes': sum(table['bytes'] for table in self.index['tables'].values()),
+            'max_bytes': self.max_bytes,
+        }
+
+    def clear(self) -> None:
+        """
+        This function removes every cached table and the index
+        """
+        with self._locked():
+            for content_hash in self.index['tables']:
+                if path.exists(self._table_path(content_hash)):
+                    os.remove(self._table_path(content_hash))
+            self.index = {'files': {}, 'tables': {}}
+            self._write_index()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspect, trim or clear the parsed cost file cache")
+    parser.add_argument('command', choices=['info', 'trim', 'clear'])
+    parser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR)
+    parser.add_argument('--max-bytes', type=int, default=DEFAULT_MAX_BYTES,
+                        help="largest total size of the cached tables kept by trim")
+    args = parser.parse_args()
+
+    cache = TimeVolCache(args.cache_dir, args.max_bytes)
+    if args.command == 'trim':
+        cache.trim()
+    elif args.command == 'clear':
+        cache.clear()
+    for key, value in cache.info().items():
+        print("{}: {}".format(key, value))
@@ -21,6 +21,7 @@ import win32com.client as com
 from win32com.client import constants as c
 
 from EdgeRouteParser import files_by_ext
+from VISSIM_helpers import IMatrix_to_numpy, set_IMatrix_from_numpy
 
 ipclient = ipp.Client()
 
@@ -112,36 +113,6 @@ Sim_Parameters = dict(
 )
 
 
-# Define functions to convert to and from VISSIM Demand Matrix
-
-
-# for VISSIM matrix, the row number denotes the origin, the column number denotes the destination
-
-def IMatrix_to_numpy(matrix):
-    assert type(matrix).__name__ == 'IMatrix'
-    rows = matrix.RowCount
-    columns = matrix.ColCount
-
-    out = np.zeros((rows, columns), dtype=float)
-    for row in range(rows):
-        for col in range(columns):
-            out[row, col] = int(matrix.GetValue(row + 1, col + 1))
-
-    return out
-
-
-def set_IMatrix_from_numpy(matrix, np_matrix: np.ndarray):
-    assert type(matrix).__name__ == 'IMatrix'
-    assert matrix.RowCount == np_matrix.shape[0]
-    assert matrix.ColCount == np_matrix.shape[1]
-    np_matrix = np.around(np_matrix, 0).astype(int)
-    rows = matrix.RowCount
-    columns = matrix.ColCount
-    for row in range(rows):
-        for col in range(columns):
-            matrix.SetValue(row + 1, col + 1, np_matrix[row, col])
-
-
 # We start by opening the network to be tested and adjust its settings
 
 
@@ -172,20 +143,29 @@ zones_NOs = [zn[1] for zn in Vissim.Net.Zones.GetMultiAttValues('No')]
 
 working_folder = abspath(r"../Urban Freeway Dyn Assign Redmond.US")
 
-# create dictionary of sim working folder names and assiciated OD demand matricies
-Volumes = {}
-for multiple in np.arange(0.1, 1.6, 0.1):
-    Volumes["Vol{:}per".format(int(multiple * 100))] = [np.around(dm * multiple, 0) for dm in demand_matrices]
+
+def scaled_demands(demand_matrices, multiples):
+    """
+    This function generates the sim working folder name and scaled OD demand matrices of one scenario at a time
+    :param demand_matrices: list of demand matrices as numpy arrays
+    :param multiples: traffic volume multiples of the scenarios
+    :return: generator of (folder name, list of scaled matrices)
+    """
+    for multiple in multiples:
+        yield "Vol{:}per".format(int(multiple * 100)), [np.around(dm * multiple, 0) for dm in demand_matrices]
+
 
 signal_files = files_by_ext(Vissim.AttValue('WorkingFolder'), '.sig')
+demands = DynamicAssignment.DynAssignDemands.GetAll()
 
-# set OD demand matricies and save as to working folder
+# set OD demand matricies and save as to working folder, keeping the file name of every scenario
+Volumes = {}
 Vissim.SuspendUpdateGUI()
-for volname in Volumes.keys():
+for volname, volume_matrices in scaled_demands(demand_matrices, np.arange(0.1, 1.6, 0.1)):
 
     # Set OD matrix
-    for index, demand in enumerate(DynamicAssignment.DynAssignDemands.GetAll()):
-        set_IMatrix_from_numpy(demand.Matrix, Volumes[volname][index])
+    for demand, matrix in zip(demands, volume_matrices):
+        set_IMatrix_from_numpy(demand.Matrix, matrix)
 
     # Save file to folder
     sim_folder = ptjoin(working_folder, volname)
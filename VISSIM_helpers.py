@@ -1,31 +1,898 @@
 import igraph
-import win32com.client as com
 import pandas as pd
 import numpy as np
-import itertools
-from typing import Sequence, List, Tuple
+import json
+import os
+import sys
+from collections import OrderedDict
+from typing import Sequence, List, Tuple, Hashable, Optional, Callable, Dict, Iterable
 from itertools import groupby
+from functools import wraps
 from math import ceil
+from numbers import Integral
+from time import perf_counter
+from DynFileFuncs import PathFileIndex, dynamic_assignment_file_read, timevol_table
+
+try:
+    from pythoncom import com_error
+except ImportError:  # pywin32 is only available on Windows, VissimStandIn raises this instead
+    class com_error(Exception):
+        """
+        Stand-in for pythoncom.com_error, raised by failed COM calls
+        """
+
+
+
+def graph_distances(graph: igraph.Graph, source: Sequence[int], weights: Sequence[float], mode=igraph.OUT) -> list:
+    """
+    This function computes the least cost from source vertices to every vertex with Graph.distances, which replaced
+    Graph.shortest_paths in python-igraph 0.10, or with Graph.shortest_paths on the pinned python-igraph 0.7
+    :param graph: graph to search
+    :param source: source vertex ids
+    :param weights: weight of every edge in graph edge order
+    :param mode: igraph.OUT, igraph.IN or igraph.ALL
+    :return: list of the costs to every vertex, one list per source
+    """
+    distances = graph.distances if hasattr(graph, 'distances') else graph.shortest_paths
+    return distances(source=source, weights=weights, mode=mode)
+
+
+def remove_loops(sequence: Sequence[int]) -> Sequence[int]:
+    """
+    This function takes in a sequence of numbers and removes the loops between duplicates, keeping each item once by
+    jumping from its first to its last occurrence. It runs in linear time. Sequences without duplicates, as most routes
+    are, are only checked with a set.
+    :param sequence: list or integer array of node or edge numbers
+    :return: list of numbers, or integer array if sequence is an array
+    """
+    is_array = isinstance(sequence, np.ndarray)
+    items = sequence.tolist() if is_array else list(sequence)
+    if len(set(items)) == len(items):
+        return np.array(sequence) if is_array else items
+    last_index = {item: index for index, item in enumerate(items)}
+    keep = []
+    index = 0
+    while index < len(items):
+        keep.append(index)
+        index = last_index[items[index]] + 1
+
+    if is_array:
+        return np.asarray(sequence)[keep]
+    return [items[index] for index in keep]
+
+
+def remove_loops_batch(sequences: Sequence[Sequence[int]]) -> List[Sequence[int]]:
+    """
+    This function removes the loops of many sequences, such as all routes of a simulation step, with remove_loops.
+    Routes are short and mostly loop free, so the set check of remove_loops is faster on them than processing the
+    flattened batch with numpy, which also did not win on long random sequences.
+    :param sequences: node or edge number sequences
+    :return: list of loop free sequences in input order, integer arrays for arrays and lists otherwise
+    """
+    return [remove_loops(sequence) for sequence in sequences]
+
+
+# for VISSIM matrix, the row number denotes the origin, the column number denotes the destination
+
+def IMatrix_to_numpy(matrix) -> np.ndarray:
+    """
+    This function reads a VISSIM matrix into a numpy array, all values in one COM call when the matrix supports
+    GetValues and cell by cell otherwise. Values are truncated to integers.
+    :param matrix: win32com IMatrix object
+    :return: array of rows and columns
+    """
+    assert type(matrix).__name__ == 'IMatrix'
+    rows = matrix.RowCount
+    columns = matrix.ColCount
+
+    try:
+        out = np.array(matrix.GetValues(), dtype=float).reshape(rows, columns)
+    except (AttributeError, com_error):
+        out = np.zeros((rows, columns), dtype=float)
+        for row in range(rows):
+            for col in range(columns):
+                out[row, col] = matrix.GetValue(row + 1, col + 1)
+
+    return np.trunc(out)
+
+
+def set_IMatrix_from_numpy(matrix, np_matrix: np.ndarray) -> None:
+    """
+    This function writes a numpy array rounded to integers into a VISSIM matrix, all values in one COM call when the
+    matrix supports SetValues and cell by cell otherwise
+    :param matrix: win32com IMatrix object
+    :param np_matrix: array with the shape of the matrix
+    """
+    assert type(matrix).__name__ == 'IMatrix'
+    assert matrix.RowCount == np_matrix.shape[0]
+    assert matrix.ColCount == np_matrix.shape[1]
+    np_matrix = np.around(np_matrix, 0).astype(int)
+    try:
+        matrix.SetValues(tuple(map(tuple, np_matrix.tolist())))
+    except (AttributeError, com_error):
+        values = np_matrix.tolist()
+        for row in range(matrix.RowCount):
+            for col in range(matrix.ColCount):
+                matrix.SetValue(row + 1, col + 1, values[row][col])
+
+
+class RouteCache:
+    """
+    This class is a least recently used cache of parking lot routes tagged with the weight generation they were
+    computed under. Looking up a route under a newer generation empties the cache.
+    """
+
+    def __init__(self, maxsize: int = 10000):
+        """
+        :param maxsize: largest number of lot pairs kept in the cache
+        """
+        self.maxsize = maxsize
+        self.generation = 0
+        self.routes = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.searches = 0
+        self.invalidations = 0
+        self.carry_overs = 0
+
+    def _check_generation(self, generation: int) -> None:
+        if generation != self.generation:
+            if self.routes:
+                self.invalidations += 1
+            self.routes.clear()
+            self.generation = generation
+
+    def get(self, key: Hashable, generation: int):
+        """
+        This function returns the cached route for key, or None if it is missing or was computed on older weights
+        :param key: (origin lot, destination lot)
+        :param generation: current weight generation of the graph
+        :return: cached route or None
+        """
+        self._check_generation(generation)
+        route = self.routes.get(key)
+        if route is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.routes.move_to_end(key)
+        return route
+
+    def put(self, key: Hashable, generation: int, route) -> None:
+        """
+        This function adds a route computed under the given weight generation to the cache
+        :param key: (origin lot, destination lot)
+        :param generation: weight generation the route was computed under
+        :param route: route to cache
+        """
+        self._check_generation(generation)
+        self.routes[key] = route
+        self.routes.move_to_end(key)
+        while len(self.routes) > self.maxsize:
+            self.routes.popitem(last=False)
+
+    def carry_over(self, generation: int, keep: Callable[[object], bool]) -> None:
+        """
+        This function moves the cached routes to a new weight generation, dropping the routes keep rejects. It is only
+        safe when the kept routes are still least costly under the new weights, such as routes avoiding every edge
+        whose weight increased when no weight decreased.
+        :param generation: new weight generation
+        :param keep: function returning whether a cached route is still valid
+        """
+        for key in [key for key, route in self.routes.items() if not keep(route)]:
+            del self.routes[key]
+        self.generation = generation
+        self.carry_overs += 1
+
+    def clear(self) -> None:
+        self.routes.clear()
+
+    def stats(self) -> dict:
+        """
+        :return: dictionary of hit, miss, single source search, invalidation and carry over counts, hit rate and cache
+            size
+        """
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.,
+            'searches': self.searches,
+            'invalidations': self.invalidations,
+            'carry_overs': self.carry_overs,
+            'size': len(self.routes),
+        }
+
+
+class WeightSet:
+    """
+    This class is the path search weights of one vehicle class of a VissimRoadNet, kept as a named edge attribute of
+    the shared graph, with the weight generation and route cache of the class
+    """
+
+    def __init__(self, attribute: str, route_cache_size: int = 10000,
+                 weight_function: Optional[Callable[['VissimRoadNet'], np.ndarray]] = None):
+        """
+        :param attribute: name of the graph edge attribute holding the weights
+        :param route_cache_size: number of parking lot pair routes kept between weight updates
+        :param weight_function: function computing the weights of the class from the graph in update_weights, None to
+            only write them with set_weights. It is pickled with the graph, so it should be a module level function.
+        """
+        self.attribute = attribute
+        self.weight_function = weight_function
+        self.weights = None
+        # generation is increased on every weight write that changes a weight to invalidate cached routes
+        self.generation = 0
+        self.changed_edges = np.zeros(0, dtype=np.int64)
+        self.route_cache = RouteCache(route_cache_size)
+
+
+class LotCostMatrix:
+    """
+    This class holds the least cost from every origin parking lot to every destination parking lot of a VissimRoadNet,
+    with the shortest path tree of every origin to rebuild the routes, for the weight generation it was computed under
+
+    All origins are searched in one batched distance computation. The tree edge of a vertex is an edge reaching it at
+    its least cost from a vertex closer to the origin, so the trees are found from the distances without a second
+    search.
+    """
+
+    def __init__(self, graph: 'VissimRoadNet'):
+        """
+        :param graph: graph with parking lots and weights
+        """
+        lots = graph.parking_lots
+        self.generation = graph.weight_generation
+        self.origin_lots = lots.index[(lots['Type'] == 'origin').values].values
+        self.destination_lots = lots.index[(lots['Type'] == 'destination').values].values
+        vertex_ids = {name: vertex for vertex, name in enumerate(graph.vs['name'])}
+        self.origin_vertices = np.array([vertex_ids[name] for name in
+                                         lots.loc[self.origin_lots, 'VertexName']], dtype=np.int64)
+        self.destination_vertices = np.array([vertex_ids[name] for name in
+                                              lots.loc[self.destination_lots, 'VertexName']], dtype=np.int64)
+        self.origin_row = {lot: row for row, lot in enumerate(self.origin_lots.tolist())}
+        self.destination_column = {lot: column for column, lot in enumerate(self.destination_lots.tolist())}
+
+        weights = np.asarray(graph.es['weight'] if graph._weights is None else graph._weights, dtype=float)
+        self.edge_source, edge_target = np.array(graph.get_edgelist(), dtype=np.int64).reshape(-1, 2).T
+        distance = np.array(graph_distances(graph, self.origin_vertices.tolist(), weights.tolist()),
+                            dtype=float).reshape(len(self.origin_vertices), graph.vcount())
+        self.costs = distance[:, self.destination_vertices]
+        # node number at the end of every edge, to turn the tree paths into node sequences
+        self.edge_target_node = np.asarray(graph.vs['node'])[edge_target]
+
+        source_distance = distance[:, self.edge_source]
+        tight = (source_distance + weights == distance[:, edge_target]) & \
+            (source_distance < distance[:, edge_target])
+        rows, edges = np.nonzero(tight)
+        self.tree_edge = np.full(distance.shape, -1, dtype=np.int64)
+        self.tree_edge[rows, edge_target[edges]] = edges
+
+    def cost(self, origin_lot: int, destination_lot: int) -> float:
+        """
+        :param origin_lot: origin parking lot number
+        :param destination_lot: destination parking lot number
+        :return: least cost between the lots, inf if the destination can not be reached
+        """
+        return float(self.costs[self.origin_row[origin_lot], self.destination_column[destination_lot]])
+
+    def edge_path(self, origin_lot: int, destination_lot: int) -> Optional[List[int]]:
+        """
+        This function rebuilds the least costly path between two lots from the origin's shortest path tree
+        :param origin_lot: origin parking lot number
+        :param destination_lot: destination parking lot number
+        :return: edge positions of the path, empty if the destination can not be reached, None if a lot is not in
+            the matrix
+        """
+        row = self.origin_row.get(origin_lot)
+        column = self.destination_column.get(destination_lot)
+        if row is None or column is None:
+            return None
+        if not np.isfinite(self.costs[row, column]):
+            return []
+        tree_edge = self.tree_edge[row]
+        origin = self.origin_vertices[row]
+        vertex = self.destination_vertices[column]
+        edges = []
+        while vertex != origin:
+            edge = tree_edge[vertex]
+            if edge < 0:
+                # only reached at the same cost over zero weight edges, which the tree leaves out
+                return None
+            edges.append(int(edge))
+            vertex = self.edge_source[edge]
+        edges.reverse()
+        return edges
+
+    def to_frame(self) -> pd.DataFrame:
+        """
+        :return: dataframe of the least costs with origin lots as index and destination lots as columns
+        """
+        return pd.DataFrame(self.costs, index=pd.Index(self.origin_lots, name='Origin'),
+                            columns=pd.Index(self.destination_lots, name='Destination'))
 
 
-def remove_loops(sequence: List[int]) -> List[int]:
+class LandmarkIndex:
     """
-    This function takes in a list of numbers, finds any with duplicates, and all longest sequence between duplicates
-    :param sequence:
-    :return: list of numbers
+    This class holds landmark distances of a VissimRoadNet for goal directed (ALT) A* search between two vertices
+
+    The distances from and to a few landmarks are computed once on lower bounds of the edge travel times, such as the
+    free flow times. By the triangle inequality they bound the cost between any two vertices from below. The bounds
+    are scaled by the smallest ratio of weight to lower bound over all edges, so the estimate never overestimates
+    and searches return least costly paths under any weights, even where a weight is below its free flow time.
+
+    A* only pays off while the weights stay close to the lower bounds. On the shipped network it settles a sixth of
+    the vertices Dijkstra settles and runs in two thirds of its time on free flow weights, but on congested weights
+    the bounds loosen and the Python heuristic makes it up to 1.5 times slower than Dijkstra. The search needs
+    Graph.get_shortest_path_astar of python-igraph 0.10 or later.
+    """
+
+    def __init__(self, graph: 'VissimRoadNet', lower_bounds: Sequence[float], count: int = 16):
+        """
+        :param graph: graph the landmarks are chosen in
+        :param lower_bounds: positive lower bound of every edge weight in graph edge order
+        :param count: number of landmarks
+        """
+        if not hasattr(graph, 'get_shortest_path_astar'):
+            raise NotImplementedError("Landmark A* search needs python-igraph 0.10 or later, {} is installed"
+                                      .format(igraph.__version__))
+        self.graph = graph
+        self.lower_bounds = np.asarray(lower_bounds, dtype=float)
+        bounds = self.lower_bounds.tolist()
+
+        # landmarks are picked one by one as the vertex farthest from the landmarks picked so far
+        count = min(count, graph.vcount())
+        first = np.array(graph_distances(graph, [0], bounds, igraph.ALL), dtype=float)[0]
+        nearest = np.full(graph.vcount(), np.inf)
+        landmarks = [int(np.argmax(np.where(np.isfinite(first), first, -1.)))]
+        while len(landmarks) < count:
+            distance = np.array(graph_distances(graph, landmarks[-1:], bounds, igraph.ALL), dtype=float)[0]
+            nearest = np.minimum(nearest, distance)
+            farthest = int(np.argmax(np.where(np.isfinite(nearest), nearest, -1.)))
+            if nearest[farthest] <= 0:
+                break
+            landmarks.append(farthest)
+        self.landmarks = np.array(landmarks, dtype=np.int64)
+        self.from_landmark = np.array(graph_distances(graph, landmarks, bounds, igraph.OUT), dtype=float)
+        self.to_landmark = np.array(graph_distances(graph, landmarks, bounds, igraph.IN), dtype=float)
+
+        self._scale_generation = None
+        self.scale = 0.
+        # scaled estimates by target vertex for the current weight generation
+        self._estimates = {}
+        # calls of the heuristic, once for every vertex pushed to the search queue rather than settled
+        self.heuristic_calls = 0
+        self.searches = 0
+
+    def _update_scale(self) -> None:
+        if self._scale_generation != self.graph.weight_generation:
+            weights = np.asarray(self.graph.es['weight'] if self.graph._weights is None else self.graph._weights,
+                                 dtype=float)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                ratio = weights / self.lower_bounds
+            ratio = ratio[np.isfinite(ratio)]
+            self.scale = max(float(ratio.min()), 0.) if len(ratio) else 0.
+            self._scale_generation = self.graph.weight_generation
+            self._estimates.clear()
+
+    def estimates(self, target: int) -> np.ndarray:
+        """
+        This function bounds the least cost from every vertex to the target from below
+        :param target: target vertex id
+        :return: array of lower bounds by vertex id, a large number for vertices that can not reach the target
+        """
+        self._update_scale()
+        with np.errstate(invalid='ignore'):
+            bounds = np.concatenate([self.from_landmark[:, [target]] - self.from_landmark,
+                                     self.to_landmark - self.to_landmark[:, [target]]])
+        # no landmark path to either vertex tells nothing, inf means the target can not be reached
+        bounds = np.where(np.isnan(bounds), 0., bounds).max(axis=0)
+        bounds = np.minimum(np.maximum(bounds, 0.) * self.scale, np.finfo(float).max / 4)
+        return bounds
+
+    def edge_path(self, source: int, target: int) -> List[int]:
+        """
+        This function finds the least costly path between two vertices by A* search with the landmark bounds
+        :param source: source vertex id
+        :param target: target vertex id
+        :return: edge positions of the path
+        """
+        self._update_scale()
+        estimates = self._estimates.get(target)
+        if estimates is None:
+            estimates = self._estimates[target] = self.estimates(target).tolist()
+        self.searches += 1
+
+        def heuristic(graph, vertex, goal):
+            self.heuristic_calls += 1
+            return estimates[vertex]
+
+        return self.graph.get_shortest_path_astar(source, target, heuristic, weights='weight', output='epath')
+
+
+class TravelTimeStore:
     """
-    # make list copy
-    sequence = [item for item in sequence]
+    This class stores the travel time of every edge in every dynamic assignment period
+
+    Travel times are kept in a preallocated edges by periods array in column major order, so the travel times of a
+    period are one contiguous column returned as a view. Periods are numbered from 1 as in VISSIM, and the array grows
+    when a later period is recorded. Edges without a travel time in a period are NaN.
+    """
+
+    def __init__(self, edge_nos: Sequence[int], periods: int = 8):
+        """
+        :param edge_nos: VISSIM edge numbers in graph edge order
+        :param periods: number of periods allocated up front
+        """
+        self.edge_nos = pd.Index(edge_nos)
+        self.times = np.full((len(self.edge_nos), max(periods, 1)), np.nan, order='F')
+        # whether travel times were recorded for every period
+        self.filled = np.zeros(self.times.shape[1], dtype=bool)
+
+    @property
+    def periods(self) -> int:
+        """
+        :return: last period with recorded travel times, 0 if none
+        """
+        filled = np.flatnonzero(self.filled)
+        return int(filled[-1]) + 1 if len(filled) else 0
+
+    def _grow(self, period: int) -> None:
+        columns = self.times.shape[1]
+        while columns < period:
+            columns *= 2
+        if columns > self.times.shape[1]:
+            times = np.full((self.times.shape[0], columns), np.nan, order='F')
+            times[:, :self.times.shape[1]] = self.times
+            self.times = times
+            self.filled = np.r_[self.filled, np.zeros(columns - len(self.filled), dtype=bool)]
+
+    def _writable(self) -> None:
+        # travel times memory mapped from a snapshot are copied on the first write
+        if not self.times.flags.writeable:
+            self.times = np.array(self.times, order='F')
+        if not self.filled.flags.writeable:
+            self.filled = self.filled.copy()
+
+    def record(self, period: int, travel_times: Sequence[float], positions: Optional[Sequence[int]] = None) -> None:
+        """
+        This function writes the travel times of a period
+        :param period: period number, from 1
+        :param travel_times: travel times of the edges at positions, or of every edge if positions is None
+        :param positions: edge positions of the travel times
+        """
+        if period < 1:
+            raise ValueError("Periods are numbered from 1, got {}".format(period))
+        self._grow(period)
+        self._writable()
+        if positions is None:
+            self.times[:, period - 1] = travel_times
+        else:
+            self.times[np.asarray(positions, dtype=np.int64), period - 1] = travel_times
+        self.filled[period - 1] = True
+
+    def period(self, period: int) -> np.ndarray:
+        """
+        :param period: period number, from 1
+        :return: read only view of the travel times of every edge in the period
+        """
+        if not 1 <= period <= self.times.shape[1]:
+            raise IndexError("Period {} is not in the store".format(period))
+        times = self.times[:, period - 1]
+        times.flags.writeable = False
+        return times
+
+    def load_cost_file(self, file_path: str) -> List[int]:
+        """
+        This function records the periods of a dynamic assignment cost file, overwriting periods already recorded.
+        Vehicle types are combined per edge and period with their travel times weighted by volume, and edges without a
+        travel time in the file are NaN.
+        :param file_path: path to a .bew file
+        :return: period numbers read
+        """
+        table = timevol_table(dynamic_assignment_file_read(file_path, ['VolTime'])['VolTime'])
+        positions = self.edge_nos.get_indexer(table['NO'].to_numpy())
+        time = table['TRAVTMNEW'].to_numpy(dtype=float)
+        keep = (positions >= 0) & (time > 0)
+        periods = table['Period'].to_numpy()
+        period_numbers = np.unique(periods)
+        if len(period_numbers) == 0:
+            return []
+        self._grow(int(period_numbers.max()))
+        self._writable()
 
-    item_set = set(sequence)
-    if len(sequence) != len(item_set):
-        for item in item_set:
-            if sequence.count(item) > 1:
-                last_index = sequence[::-1].index(item)
-                first_index = sequence.index(item)
-                del sequence[first_index + 1:last_index * -1]
+        # one bin per edge and period in column major order
+        cells = periods[keep].astype(np.int64) - 1
+        cells = cells * self.times.shape[0] + positions[keep]
+        time = time[keep]
+        volume = table['VOLNEW'].to_numpy(dtype=float)[keep]
+        size = self.times.size
+        count = np.bincount(cells, minlength=size)
+        volume_sum = np.bincount(cells, weights=volume, minlength=size)
+        weighted = np.bincount(cells, weights=time * volume, minlength=size)
+        plain = np.bincount(cells, weights=time, minlength=size)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            combined = np.where(volume_sum > 0, weighted / volume_sum, plain / count)
 
-    return sequence
+        times = self.times.reshape(-1, order='F')
+        for period in period_numbers.tolist():
+            column = slice((period - 1) * self.times.shape[0], period * self.times.shape[0])
+            times[column] = combined[column]
+            self.filled[period - 1] = True
+        return period_numbers.tolist()
+
+
+class VehiclePathRegistry:
+    """
+    This class records the path of every vehicle in the network. Identical edge sequences are stored once as shared
+    integer arrays, found through a hash of the sequence and compared with the stored paths of that hash, and the path
+    id of each vehicle is kept in a fixed width table indexed by vehicle number offset by the oldest vehicle still in
+    the network. Entries are freed when vehicles arrive.
+    """
+
+    def __init__(self):
+        self.paths: List[Optional[np.ndarray]] = []
+        # path ids of the stored paths by hash of their edge sequence
+        self.path_ids: Dict[int, List[int]] = {}
+        self.path_refs = np.zeros(0, dtype=np.int32)
+        self.free_path_ids = []
+        # path id of vehicle number base + i at position i, -1 for vehicles not in the network
+        self.base = 0
+        self.table = np.zeros(0, dtype=np.int32)
+        self.live_vehicles = 0
+
+    @staticmethod
+    def _path_key(edge_seq: np.ndarray) -> int:
+        return hash(edge_seq.tobytes())
+
+    def _add_path(self, edge_seq: Sequence[int]) -> int:
+        edge_seq = np.asarray(edge_seq, dtype=np.int32)
+        key = self._path_key(edge_seq)
+        path_ids = self.path_ids.setdefault(key, [])
+        path_id = next((path_id for path_id in path_ids if np.array_equal(self.paths[path_id], edge_seq)), None)
+        if path_id is None:
+            if self.free_path_ids:
+                path_id = self.free_path_ids.pop()
+                self.paths[path_id] = edge_seq
+            else:
+                path_id = len(self.paths)
+                self.paths.append(edge_seq)
+                if path_id >= len(self.path_refs):
+                    self.path_refs = np.r_[self.path_refs, np.zeros(max(len(self.path_refs), 16), dtype=np.int32)]
+            path_ids.append(path_id)
+        self.path_refs[path_id] += 1
+        return path_id
+
+    def _release_path(self, path_id: int) -> None:
+        self.path_refs[path_id] -= 1
+        if not self.path_refs[path_id]:
+            key = self._path_key(self.paths[path_id])
+            path_ids = self.path_ids[key]
+            path_ids.remove(path_id)
+            if not path_ids:
+                del self.path_ids[key]
+            self.paths[path_id] = None
+            self.free_path_ids.append(path_id)
+
+    def _position(self, veh_no: int) -> int:
+        position = veh_no - self.base
+        if position < 0 or position >= len(self.table) or self.table[position] < 0:
+            raise KeyError(veh_no)
+        return position
+
+    def __setitem__(self, veh_no: int, edge_seq: Sequence[int]) -> None:
+        """
+        This function records the path of a vehicle, replacing the path it had before
+        :param veh_no: VISSIM vehicle number
+        :param edge_seq: edge numbers of the vehicle path
+        """
+        veh_no = int(veh_no)
+        if veh_no in self:
+            self.pop(veh_no)
+        if not self.live_vehicles:
+            self.base = veh_no
+            self.table = np.full(16, -1, dtype=np.int32)
+        elif veh_no < self.base:
+            self.table = np.r_[np.full(self.base - veh_no, -1, dtype=np.int32), self.table]
+            self.base = veh_no
+        position = veh_no - self.base
+        if position >= len(self.table):
+            # drop the free entries in front of the oldest vehicle still in the network, then grow if still needed
+            first_live = int(np.argmax(self.table >= 0))
+            span = len(self.table) - first_live
+            position -= first_live
+            resized = np.full(max(2 * span, position + 1, 16), -1, dtype=np.int32)
+            resized[:span] = self.table[first_live:]
+            self.table = resized
+            self.base += first_live
+        self.table[position] = self._add_path(edge_seq)
+        self.live_vehicles += 1
+
+    def __getitem__(self, veh_no: int) -> np.ndarray:
+        """
+        :param veh_no: VISSIM vehicle number
+        :return: edge numbers of the vehicle path
+        """
+        return self.paths[self.table[self._position(int(veh_no))]]
+
+    def __contains__(self, veh_no: int) -> bool:
+        position = int(veh_no) - self.base
+        return 0 <= position < len(self.table) and self.table[position] >= 0
+
+    def __len__(self) -> int:
+        return self.live_vehicles
+
+    def pop(self, veh_no: int) -> np.ndarray:
+        """
+        This function removes a vehicle that left the network, its path is freed once no vehicle uses it
+        :param veh_no: VISSIM vehicle number
+        :return: edge numbers of the vehicle path
+        """
+        position = self._position(int(veh_no))
+        path_id = self.table[position]
+        edge_seq = self.paths[path_id]
+        self.table[position] = -1
+        self._release_path(path_id)
+        self.live_vehicles -= 1
+        return edge_seq
+
+    def vehicles(self) -> np.ndarray:
+        """
+        :return: numbers of the vehicles in the network in increasing order
+        """
+        return self.base + np.flatnonzero(self.table >= 0)
+
+    def memory_footprint(self) -> dict:
+        """
+        :return: dictionary of live vehicle and distinct path counts and the bytes used by paths, the hash index of
+            the paths and tables
+        """
+        path_bytes = sum(path.nbytes for path in self.paths if path is not None)
+        index_bytes = sys.getsizeof(self.path_ids) + sum(sys.getsizeof(key) + sys.getsizeof(path_ids)
+                                                         for key, path_ids in self.path_ids.items())
+        table_bytes = self.table.nbytes + self.path_refs.nbytes
+        return {
+            'live_vehicles': self.live_vehicles,
+            'paths': len(self.paths) - len(self.free_path_ids),
+            'path_bytes': path_bytes,
+            'index_bytes': index_bytes,
+            'table_bytes': table_bytes,
+            'total_bytes': path_bytes + index_bytes + table_bytes,
+        }
+
+
+class VissimPathRegistry:
+    """
+    This class keeps the VISSIM path objects added by the SO loop, keyed by origin lot, destination lot and node
+    sequence, so a route already added is assigned again without another AddPath call. Node sequences VISSIM rejected
+    are remembered and not tried again. Path objects belong to the VISSIM network they were added to, so the registry
+    should be cleared when a new simulation starts.
+    """
+
+    def __init__(self):
+        self.paths = {}
+        self.rejected = set()
+        self.hits = 0
+        self.misses = 0
+        self.rejected_hits = 0
+
+    def path(self, vis_net, origin_lot: int, destination_lot: int, node_seq: Sequence[int]):
+        """
+        This function returns the VISSIM path through the node sequence between two lots, adding it to VISSIM the
+        first time it is asked for
+        :param vis_net: VISSIM INet object
+        :param origin_lot: origin parking lot number
+        :param destination_lot: destination parking lot number
+        :param node_seq: VISSIM node numbers of the route
+        :return: VISSIM path object, or None if VISSIM rejected the node sequence
+        """
+        nodes = tuple(int(node) for node in node_seq)
+        key = (int(origin_lot), int(destination_lot), nodes)
+        path = self.paths.get(key)
+        if path is not None:
+            self.hits += 1
+            return path
+        if key in self.rejected:
+            self.rejected_hits += 1
+            return None
+
+        self.misses += 1
+        try:
+            path = vis_net.Paths.AddPath(origin_lot, destination_lot, [str(node) for node in nodes])
+        except com_error:
+            self.rejected.add(key)
+            return None
+        self.paths[key] = path
+        return path
+
+    def clear(self) -> None:
+        self.paths.clear()
+        self.rejected.clear()
+
+    def stats(self) -> dict:
+        """
+        :return: dictionary of lookups, reused paths, paths added, lookups of rejected sequences, hit rate counting
+            both kinds of reuse, and the number of kept paths and rejected sequences
+        """
+        lookups = self.hits + self.misses + self.rejected_hits
+        return {
+            'lookups': lookups,
+            'hits': self.hits,
+            'adds': self.misses,
+            'rejected_hits': self.rejected_hits,
+            'hit_rate': (self.hits + self.rejected_hits) / lookups if lookups else 0.,
+            'paths': len(self.paths),
+            'rejected_sequences': len(self.rejected),
+        }
+
+
+def _save_table(frame: pd.DataFrame, file_path: str) -> dict:
+    """
+    This function saves the index and columns of a table as fields of one structured .npy array that can be memory
+    mapped. Text and categorical columns are stored as integer codes, as in write_columnar, with their categories kept
+    in the description.
+    :return: description of the columns for _load_table
+    """
+    fields = []
+    columns = OrderedDict()
+    for name, column in [('__index__', frame.index.to_series())] + list(frame.items()):
+        if pd.api.types.is_numeric_dtype(column.dtype) or pd.api.types.is_bool_dtype(column.dtype):
+            columns[name] = 'numeric'
+            values = column.to_numpy()
+        else:
+            categorical = isinstance(column.dtype, pd.CategoricalDtype)
+            column = column.astype('category')
+            categories = column.cat.categories.astype(str).tolist()
+            columns[name] = categories if categorical else {'text': categories}
+            values = column.cat.codes.values
+        fields.append((name, values))
+    table = np.empty(frame.shape[0], dtype=[(name, values.dtype) for name, values in fields])
+    for name, values in fields:
+        table[name] = values
+    np.save(file_path, table)
+    return {'index_name': frame.index.name, 'columns': columns}
+
+
+def _load_table(file_path: str, description: dict, mmap_mode: Optional[str]) -> pd.DataFrame:
+    """
+    This function loads a table saved by _save_table
+    """
+    table = np.load(file_path, mmap_mode=mmap_mode)
+    columns = OrderedDict()
+    for name, kind in description['columns'].items():
+        if kind == 'numeric':
+            columns[name] = table[name]
+        elif isinstance(kind, dict):
+            # missing text has code -1, which takes the trailing None
+            columns[name] = np.array(kind['text'] + [None], dtype=object)[table[name]]
+        else:
+            columns[name] = pd.Categorical.from_codes(table[name], kind)
+    index = pd.Index(columns.pop('__index__'), name=description['index_name'])
+    return pd.DataFrame(columns, index=index, copy=False)
+
+
+class StepProfiler:
+    """
+    This class records the wall time of every simulation step of the SO control loop and the time, call count and
+    vehicles routed of each loop phase into preallocated arrays, which grow by doubling if the run is longer than
+    expected. Phases of VissimRoadNet methods are recorded through the profiled decorator once the profiler is set
+    as the graph profiler.
+    """
+    PHASES = ('update_weights', 'parking_lot_routes', 'add_path', 'assign_path', 'update_volume', 'run_single_step')
+
+    def __init__(self, max_steps: int = 4500, phases: Sequence[str] = PHASES, file_path: Optional[str] = None):
+        """
+        :param max_steps: number of steps allocated up front
+        :param phases: names of the timed phases
+        :param file_path: .npz file the time series is written to when the run is closed, None to not write it
+        """
+        self.phases = list(phases)
+        self.phase_index = {phase: index for index, phase in enumerate(self.phases)}
+        self.file_path = file_path
+        self.step = -1
+        self.step_start = 0.
+        self.simulation_second = np.zeros(max_steps)
+        self.wall_time = np.zeros(max_steps)
+        self.vehicles = np.zeros(max_steps, dtype=np.int32)
+        self.phase_time = np.zeros((max_steps, len(self.phases)))
+        self.phase_calls = np.zeros((max_steps, len(self.phases)), dtype=np.int32)
+
+    def _grow(self) -> None:
+        size = 2 * len(self.wall_time)
+        for name in ('simulation_second', 'wall_time', 'vehicles', 'phase_time', 'phase_calls'):
+            array = getattr(self, name)
+            grown = np.zeros((size,) + array.shape[1:], dtype=array.dtype)
+            grown[:len(array)] = array
+            setattr(self, name, grown)
+
+    def start_step(self, simulation_second: float) -> None:
+        """
+        This function starts recording a new simulation step
+        :param simulation_second: simulation second of the step
+        """
+        self.step += 1
+        if self.step == len(self.wall_time):
+            self._grow()
+        self.simulation_second[self.step] = simulation_second
+        self.step_start = perf_counter()
+
+    def record(self, phase: str, seconds: float, calls: int = 1) -> None:
+        """
+        This function adds the run time of a phase to the current step
+        :param phase: phase name
+        :param seconds: wall time spent in the phase
+        :param calls: number of calls the time covers
+        """
+        position = self.phase_index[phase]
+        self.phase_time[self.step, position] += seconds
+        self.phase_calls[self.step, position] += calls
+
+    def end_step(self, vehicles: int = 0) -> None:
+        """
+        This function closes the current simulation step
+        :param vehicles: number of vehicles routed in the step
+        """
+        self.wall_time[self.step] = perf_counter() - self.step_start
+        self.vehicles[self.step] = vehicles
+
+    def to_frame(self) -> pd.DataFrame:
+        """
+        :return: dataframe of the recorded steps with the simulation second, wall time, vehicles routed and the time
+            and calls of every phase
+        """
+        steps = self.step + 1
+        frame = pd.DataFrame({'SimulationSecond': self.simulation_second[:steps], 'WallTime': self.wall_time[:steps],
+                              'Vehicles': self.vehicles[:steps]})
+        for position, phase in enumerate(self.phases):
+            frame[phase + ' time'] = self.phase_time[:steps, position]
+            frame[phase + ' calls'] = self.phase_calls[:steps, position]
+        return frame
+
+    def save(self, file_path: Optional[str] = None) -> None:
+        """
+        This function writes the recorded steps to a compressed numpy archive
+        :param file_path: .npz file, defaults to the file_path given on construction
+        """
+        steps = self.step + 1
+        np.savez_compressed(file_path or self.file_path, phases=np.array(self.phases),
+                            simulation_second=self.simulation_second[:steps], wall_time=self.wall_time[:steps],
+                            vehicles=self.vehicles[:steps], phase_time=self.phase_time[:steps],
+                            phase_calls=self.phase_calls[:steps])
+
+    @staticmethod
+    def load(file_path: str) -> pd.DataFrame:
+        """
+        This function reads a time series written by save
+        :param file_path: .npz file
+        :return: dataframe in the to_frame layout
+        """
+        with np.load(file_path) as archive:
+            profiler = StepProfiler(max(len(archive['wall_time']), 1), archive['phases'].tolist())
+            profiler.step = len(archive['wall_time']) - 1
+            for name in ('simulation_second', 'wall_time', 'vehicles', 'phase_time', 'phase_calls'):
+                getattr(profiler, name)[:profiler.step + 1] = archive[name]
+        return profiler.to_frame()
+
+
+def profiled(phase: str):
+    """
+    This decorator records the run time of a VissimRoadNet method as a StepProfiler phase. Without a profiler it only
+    costs an attribute lookup.
+    :param phase: phase name
+    """
+    def decorator(method):
+        @wraps(method)
+        def wrapper(self, *args, **kwargs):
+            profiler = self.profiler
+            if profiler is None:
+                return method(self, *args, **kwargs)
+            start = perf_counter()
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                profiler.record(phase, perf_counter() - start)
+        return wrapper
+    return decorator
 
 
 class VissimRoadNet(igraph.Graph):
@@ -34,87 +901,135 @@ class VissimRoadNet(igraph.Graph):
     """
     VISSIM_Edge_Attributes = ['No', 'FromNode', 'ToNode', 'FromEdges', 'ToEdges', 'LinkSeq', 'Length', 'IsTurn', 'Type',
                               'Closed']
+    VISSIM_Vehicle_Attributes = ['No', 'Path']
+    # vehicle class of the 'weight' edge attribute, served by the cost matrix and landmarks
+    DEFAULT_CLASS = 'default'
+    # format version of the folders written by save_snapshot
+    SNAPSHOT_VERSION = 3
+    # StepProfiler recording the run time of the SO loop phases, None when profiling is disabled
+    profiler = None
+    # MaginalCostModel.NetworkModel of the edges, its marginal cost at the current edge volumes is added to the weights
+    cost_model = None
+    # DynFileFuncs.PathFileIndex of the path file the parking lots were read from, None when read over COM
+    path_index = None
+    # LotCostMatrix of the weights of the last update_lot_costs, None before the first one
+    lot_costs = None
+    # LandmarkIndex for A* search of single lot pairs, None when not built
+    landmarks = None
+    # whether parking_lot_routes_batch searches origins with a single destination with A* on the landmarks. A* with a
+    # Python heuristic is slower than Dijkstra on congested weights, so it is off unless set, see LandmarkIndex
+    landmark_search = False
+    # TravelTimeStore of the travel times read in every period, None to not keep them
+    travel_times = None
+    # VissimPathRegistry of the paths added by the SO loop
+    vissim_paths = None
 
-    def __init__(self, net=None, edge_ff='edge_free_flow.pkl.gz', *args, **kwargs):
+    def __init__(self, net=None, edge_ff='edge_free_flow.pkl.gz', route_cache_size=10000, *args, path_file=None,
+                 **kwargs):
         """
         Initializes the VissimRoadNet graph using a VISSIM network
         :param net: win32com.gen_py.[VISSIM COM GUID].INet
 
         VISSIM network object who's dynamic assignment graph will be read
 
+        :param route_cache_size: number of parking lot pair routes kept between weight updates
+        :param path_file: dynamic assignment path file (.weg) the parking lots are placed from, VISSIM's own path file
+            is read over COM if None
         :param args:
         :param kwargs:
 
-        Other arguments will be sent to constructor for parent igraph.Graph class.
+        Other arguments will be sent to constructor for parent igraph.Graph class. A vertex count as first argument
+        is taken as the (n, edges, directed, graph, vertex and edge attributes) igraph passes by position when a graph
+        is unpickled or copied, the pickled attributes of this class are restored after.
         """
-        super(VissimRoadNet, self).__init__(directed=True, *args, **kwargs)
+        if isinstance(net, Integral):
+            args = (net, edge_ff, route_cache_size) + args
+            net, route_cache_size = None, 10000
+            super(VissimRoadNet, self).__init__(*args, **kwargs)
+        else:
+            super(VissimRoadNet, self).__init__(directed=True, *args, **kwargs)
+        # path search weights by vehicle class, all on the topology of this graph
+        self.weight_sets = OrderedDict([(self.DEFAULT_CLASS, WeightSet('weight', route_cache_size))])
         if type(net).__name__ == "INet":
             self.visedges = self.read_vissim_net(net)
             self.vissim_net_to_igraph()
-            self.parking_lots = self.read_parking_lot(net)
+            self.parking_lots = self.read_parking_lot(net, path_file)
 
-            # set initial edge volume
-            self.edge_volume = pd.Series(0, index=self.visedges.index, dtype=int)
-            self.veh_paths = {}
+            # set initial edge volume, counted by edge position in visedges
+            self._edge_volume = np.zeros(self.visedges.shape[0], dtype=np.int64)
+            # vehicles departed in the current dynamic assignment interval on each edge of their path, the flow units
+            # of VOLNEW the cost model is fitted on
+            self._period_flow = np.zeros(self.visedges.shape[0], dtype=np.int64)
+            self.veh_paths = VehiclePathRegistry()
+            self.path_edges = {}
             self.edge_ff = pd.read_pickle(edge_ff)
-            self._traveltime = pd.Series(pd.np.nan, index=self.visedges.index, dtype=float)
-            self._traveltime.loc[self.edge_ff.index] = self.edge_ff['TravelTime mean']
-            empty_traveltime = self._traveltime.index[self._traveltime.isna()]
-            self._traveltime.loc[empty_traveltime] = self.visedges.loc[empty_traveltime, 'Length'] / 51.3333  # ft/s
-            self._traveltimeperiod = 1
+            traveltime = pd.Series(np.nan, index=self.visedges.index, dtype=float)
+            traveltime.loc[self.edge_ff.index] = self.edge_ff['TravelTime mean']
+            empty_traveltime = traveltime.index[traveltime.isna()]
+            traveltime.loc[empty_traveltime] = self.visedges.loc[empty_traveltime, 'Length'] / 51.3333  # ft/s
             # or 35 mph
+            self.travel_time = traveltime
+            self.travel_times = TravelTimeStore(self.visedges.index)
+            self._traveltimeperiod = 1
+            self._closed_positions = np.flatnonzero(self.visedges['Closed'].astype(bool).values)
 
             # set initial weight value for path search
-            self.es['weight'] = self._traveltime.to_list()
+            self.set_weights(self._travel_time)
 
     def vissim_net_to_igraph(self):
         """
-        This function takes in a VISSIM network COM object, then reads it and converts it to a VissimRoadNet object
+        This function converts the VISSIM edge table in visedges to vertices and edges of this graph in bulk
+
+        Every edge has an origin end and a destination end. The destination end of an edge is the same junction as the
+        origin end of every edge in its ToEdges (and vice versa for FromEdges), so the graph vertices are the connected
+        components over these end to end links. Vertices are named after the first edge end that touches them, in edge
+        order, which gives the same OriginVertex and DestinVertex as assigning them edge by edge.
         """
 
         all_edges = self.visedges
+        edge_count = all_edges.shape[0]
+        edge_pos = dict(zip(all_edges.index, range(edge_count)))
 
-        # read each edge into graph, build vertices as we go
-        for index in all_edges.index:
-            if not all_edges.loc[index].OriginVertex:  # fresh edge that doesn't have origin vertices assigned
-                # create and add origin vertex to graph
-                vertex_name = 'visnode.' + str(all_edges.loc[index].FromNode) + '.' + str(index)
-                self.add_vertex(name=vertex_name, node=all_edges.loc[index].FromNode)
-
-                # add this edge's origin vertex as DestinVertex of all edges going into it
-                vertex_enter_edges = all_edges.loc[index].FromEdges
-                if vertex_enter_edges:
-                    vertex_enter_edges = [int(ed) for ed in vertex_enter_edges.split(',')]
-                    all_edges.loc[vertex_enter_edges, 'DestinVertex'] = vertex_name
-                    # add the vertex to the OriginVertex of other edges going to the same edges
-                    vertex_exit_edges = [ed.split(',') for ed in all_edges.loc[vertex_enter_edges].ToEdges]
-                    vertex_exit_edges = [int(ed) for ed in itertools.chain.from_iterable(vertex_exit_edges) if ed]
-                    all_edges.loc[vertex_exit_edges, 'OriginVertex'] = vertex_name
-                else:  # add vertex only to this edge
-                    all_edges.loc[index, 'OriginVertex'] = vertex_name
-
-            if not all_edges.loc[index].DestinVertex:  # fresh edge that doesn't have destination vertices assigned
-                # create and add destination vertex to graph
-                vertex_name = 'visnode.' + str(all_edges.loc[index].ToNode) + '.' + str(index)
-                self.add_vertex(name=vertex_name, node=all_edges.loc[index].ToNode)
-
-                # add this edge's destination vertex as OriginVertex of all edges going from it
-                vertex_exit_edges = all_edges.loc[index].ToEdges
-                if vertex_exit_edges:
-                    vertex_exit_edges = [int(ed) for ed in vertex_exit_edges.split(',')]
-                    all_edges.loc[vertex_exit_edges, 'OriginVertex'] = vertex_name
-                    # add the vertex to the DestinVertex of other edges coming from the same edges
-                    vertex_enter_edges = [ed.split(',') for ed in all_edges.loc[vertex_exit_edges].FromEdges]
-                    vertex_enter_edges = [int(ed) for ed in itertools.chain.from_iterable(vertex_enter_edges) if ed]
-                    all_edges.loc[vertex_enter_edges, 'DestinVertex'] = vertex_name
-                else:  # add vertex only to this edge
-                    all_edges.loc[index, 'DestinVertex'] = vertex_name
-
-            # add this edge to the graph
-            # if not all_edges.loc[index, 'Closed']: # TODO apply closed status during edge cost analysis
-            self.add_edge(all_edges.loc[index, 'OriginVertex'],
-                          all_edges.loc[index, 'DestinVertex'],
-                          name="visedge." + str(index))
+        # origin end of the edge at position p is 2p, destination end is 2p + 1
+        end_links = []
+        for pos, (from_edges, to_edges) in enumerate(zip(all_edges.FromEdges, all_edges.ToEdges)):
+            end_links.extend((2 * pos, 2 * edge_pos[int(ed)] + 1) for ed in from_edges.split(',') if ed)
+            end_links.extend((2 * pos + 1, 2 * edge_pos[int(ed)]) for ed in to_edges.split(',') if ed)
+        end_links = np.array(end_links, dtype=np.int64).reshape(-1, 2)
+
+        # label every end with the smallest end in its component, which is the end that creates the vertex
+        labels = np.arange(2 * edge_count, dtype=np.int64)
+        while True:
+            joined = np.minimum(labels[end_links[:, 0]], labels[end_links[:, 1]])
+            new_labels = labels.copy()
+            np.minimum.at(new_labels, end_links[:, 0], joined)
+            np.minimum.at(new_labels, end_links[:, 1], joined)
+            new_labels = new_labels[new_labels]
+            if np.array_equal(new_labels, labels):
+                break
+            labels = new_labels
+
+        creators, end_vertex = np.unique(labels, return_inverse=True)
+        creator_pos = creators // 2
+        creator_is_origin = creators % 2 == 0
+        vertex_nodes = np.where(creator_is_origin,
+                                all_edges.FromNode.values[creator_pos],
+                                all_edges.ToNode.values[creator_pos])
+        vertex_names = ['visnode.' + str(node) + '.' + str(edge_no)
+                        for node, edge_no in zip(vertex_nodes, all_edges.index.values[creator_pos])]
+
+        end_vertex = end_vertex.reshape(-1, 2)
+        all_edges['OriginVertex'] = [vertex_names[vertex] for vertex in end_vertex[:, 0]]
+        all_edges['DestinVertex'] = [vertex_names[vertex] for vertex in end_vertex[:, 1]]
+
+        # add all vertices and edges to the graph in one call each
+        first_vertex = self.vcount()
+        first_edge = self.ecount()
+        self.add_vertices(vertex_names)
+        self.vs[first_vertex:]['node'] = vertex_nodes.tolist()
+        # if not all_edges.loc[index, 'Closed']: # TODO apply closed status during edge cost analysis
+        self.add_edges((end_vertex + first_vertex).tolist())
+        self.es[first_edge:]['name'] = ['visedge.' + str(index) for index in all_edges.index]
 
         return all_edges
 
@@ -144,11 +1059,125 @@ class VissimRoadNet(igraph.Graph):
         all_edges.set_index('No', inplace=True, verify_integrity=True, drop=True)
         return all_edges
 
-    def read_parking_lot(self, vissim_net) -> pd.DataFrame:
+    def save_snapshot(self, folder: str) -> None:
+        """
+        This function saves the graph, edge and parking lot tables, travel time vectors, travel times of every period,
+        weights of every vehicle class and paths of the vehicles in the network as flat .npy arrays in a folder, which
+        from_snapshot loads without VISSIM. Weight functions of vehicle classes are not saved.
+        :param folder: snapshot folder, created if needed
+        """
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        vertices = np.empty(self.vcount(), dtype=[('name', np.array(self.vs['name'], dtype=str).dtype),
+                                                  ('node', np.int64)])
+        vertices['name'] = self.vs['name']
+        vertices['node'] = self.vs['node']
+        edge_names = np.array(self.es['name'], dtype=str)
+        edges = np.empty(self.ecount(), dtype=[('name', edge_names.dtype), ('source', np.int32), ('target', np.int32),
+                                               ('travel_time', float), ('weight', float), ('volume', np.int64),
+                                               ('period_flow', np.int64)])
+        edges['name'] = edge_names
+        edges['source'], edges['target'] = np.array(self.get_edgelist(), dtype=np.int32).reshape(-1, 2).T
+        edges['travel_time'] = self._travel_time
+        edges['weight'] = self._weights
+        edges['volume'] = self._edge_volume
+        edges['period_flow'] = self._period_flow
+        np.save(os.path.join(folder, 'vertices.npy'), vertices)
+        np.save(os.path.join(folder, 'edges.npy'), edges)
+
+        # weights of the vehicle classes other than the default, one column per class
+        classes = [(name, weight_set) for name, weight_set in self.weight_sets.items() if name != self.DEFAULT_CLASS]
+        class_weights = np.empty((self.ecount(), len(classes)), order='F')
+        for column, (name, weight_set) in enumerate(classes):
+            class_weights[:, column] = weight_set.weights
+        np.save(os.path.join(folder, 'class_weights.npy'), class_weights)
+        # paths of the vehicles in the network as their concatenated edge numbers
+        veh_nos = self.veh_paths.vehicles()
+        veh_paths = [self.veh_paths[veh_no] for veh_no in veh_nos.tolist()]
+        vehicles = np.empty(len(veh_nos), dtype=[('no', np.int64), ('end', np.int64)])
+        vehicles['no'] = veh_nos
+        vehicles['end'] = np.cumsum([len(path) for path in veh_paths], dtype=np.int64)
+        np.save(os.path.join(folder, 'vehicles.npy'), vehicles)
+        np.save(os.path.join(folder, 'vehicle_edges.npy'),
+                np.concatenate(veh_paths).astype(np.int32) if veh_paths else np.empty(0, dtype=np.int32))
+        travel_times = self.travel_times if self.travel_times is not None else TravelTimeStore(self.visedges.index)
+        np.save(os.path.join(folder, 'period_travel_times.npy'), travel_times.times)
+        meta = {
+            'version': self.SNAPSHOT_VERSION,
+            'traveltimeperiod': self._traveltimeperiod,
+            'filled_periods': travel_times.filled.tolist(),
+            'vehicle_classes': [[name, weight_set.route_cache.maxsize] for name, weight_set in classes],
+            'visedges': _save_table(self.visedges, os.path.join(folder, 'visedges.npy')),
+            'parking_lots': _save_table(self.parking_lots, os.path.join(folder, 'parking_lots.npy')),
+        }
+        with open(os.path.join(folder, 'snapshot.json'), 'w') as meta_file:
+            json.dump(meta, meta_file)
+
+    @classmethod
+    def from_snapshot(cls, folder: str, mmap_mode: Optional[str] = 'r', route_cache_size: int = 10000,
+                      weight_functions: Optional[Dict[str, Callable[['VissimRoadNet'], np.ndarray]]] = None
+                      ) -> 'VissimRoadNet':
+        """
+        This function builds a VissimRoadNet from a folder written by save_snapshot, without VISSIM
+        :param folder: snapshot folder
+        :param mmap_mode: numpy memory map mode of the snapshot arrays, None to read them into memory. Period travel
+            times memory mapped read only are copied when a period is recorded.
+        :param route_cache_size: number of parking lot pair routes kept between weight updates
+        :param weight_functions: weight functions of the saved vehicle classes by class name, as given to
+            add_vehicle_class, as they are not saved
+        :return: graph with its edge and parking lot tables, travel times, period travel times, weights of every
+            vehicle class, edge volumes and vehicle paths
+        """
+        with open(os.path.join(folder, 'snapshot.json'), 'r') as meta_file:
+            meta = json.load(meta_file)
+        if meta['version'] != cls.SNAPSHOT_VERSION:
+            raise ValueError("Snapshot version {} is not supported".format(meta['version']))
+
+        graph = cls(route_cache_size=route_cache_size)
+        vertices = np.load(os.path.join(folder, 'vertices.npy'), mmap_mode=mmap_mode)
+        edges = np.load(os.path.join(folder, 'edges.npy'), mmap_mode=mmap_mode)
+        graph.add_vertices(vertices['name'].tolist())
+        graph.vs['node'] = vertices['node'].tolist()
+        graph.add_edges(list(zip(edges['source'].tolist(), edges['target'].tolist())))
+        graph.es['name'] = edges['name'].tolist()
+
+        graph.visedges = _load_table(os.path.join(folder, 'visedges.npy'), meta['visedges'], mmap_mode)
+        graph.parking_lots = _load_table(os.path.join(folder, 'parking_lots.npy'), meta['parking_lots'], mmap_mode)
+
+        # state changed during a simulation is copied out of the files
+        graph._edge_volume = np.array(edges['volume'])
+        graph._period_flow = np.array(edges['period_flow'])
+        graph.veh_paths = VehiclePathRegistry()
+        vehicles = np.load(os.path.join(folder, 'vehicles.npy'))
+        vehicle_edges = np.load(os.path.join(folder, 'vehicle_edges.npy'))
+        for veh_no, start, end in zip(vehicles['no'].tolist(), np.r_[0, vehicles['end'][:-1]].tolist(),
+                                      vehicles['end'].tolist()):
+            graph.veh_paths[veh_no] = vehicle_edges[start:end]
+        graph.path_edges = {}
+        graph.travel_time = edges['travel_time']
+        graph.travel_times = TravelTimeStore(graph.visedges.index, 1)
+        graph.travel_times.times = np.load(os.path.join(folder, 'period_travel_times.npy'), mmap_mode=mmap_mode)
+        graph.travel_times.filled = np.array(meta['filled_periods'], dtype=bool)
+        graph._traveltimeperiod = meta['traveltimeperiod']
+        graph._closed_positions = np.flatnonzero(graph.visedges['Closed'].values)
+        graph.set_weights(edges['weight'])
+        class_weights = np.load(os.path.join(folder, 'class_weights.npy'), mmap_mode=mmap_mode)
+        weight_functions = weight_functions or {}
+        for column, (name, cache_size) in enumerate(meta['vehicle_classes']):
+            graph.add_vehicle_class(name, class_weights[:, column], weight_functions.get(name), cache_size)
+        return graph
+
+    def read_parking_lot(self, vissim_net, path_file: Optional[str] = None) -> pd.DataFrame:
         """
         This function takes in a VISSIM INet object and returns a table with the parkinglot association to
         nodes relationship
+
+        Origin lots are placed at the start of the first edge of their paths and destination lots at the end of the last
+        edge, looked up in visedges for all lots at once. With a path file the paths are streamed from it into
+        path_index, otherwise VISSIM reads its path file and every path is pulled over COM.
+
         :param vissim_net: VISSIM INet object
+        :param path_file: dynamic assignment path file (.weg) to read the paths from instead of VISSIM
         :return: Dataframe with parking lot number, zone number, and node number
         """
 
@@ -158,37 +1187,58 @@ class VissimRoadNet(igraph.Graph):
         parking_lots["Type"] = ""  # switch type to indicate whether the lot is origin or destination
         parking_lots = parking_lots.set_index('No')
         parking_lots["Zone"] = parking_lots["Zone"].astype(int)
-        parking_lots["Node"] = 0
-        parking_lots["VertexName"] = ''
-
-        vissim_net.Paths.ReadDynAssignPathFile()
-        paths = vissim_net.Paths.GetMultipleAttributes(['FromParkLot', 'ToParkLot', 'EdgeSeq'])
-        paths = pd.DataFrame([list(p) for p in paths], columns=['FromParkLot', 'ToParkLot', 'EdgeSeq'])
-        paths[['FromParkLot', 'ToParkLot']] = paths[['FromParkLot', 'ToParkLot']].astype(int, copy=False)
-
-        # filter the path list to reduce run time
-        from_lot_paths = paths.drop_duplicates(subset=['FromParkLot'])
-        to_lot_paths = paths.drop_duplicates(subset=['ToParkLot'])
-        for index, path in from_lot_paths.iterrows():
-            first_edge = int(path.EdgeSeq.split(',')[0])
-            first_node = self.visedges.loc[first_edge, 'FromNode']
-            first_vertex = self.visedges.loc[first_edge, 'OriginVertex']
-            # set origin lot node
-            parking_lots.loc[path.FromParkLot, 'Node'] = first_node
-            parking_lots.loc[path.FromParkLot, 'VertexName'] = first_vertex
-            parking_lots.loc[path.FromParkLot, 'Type'] = 'origin'
-
-        for index, path in to_lot_paths.iterrows():
-            last_edge = int(path.EdgeSeq.split(',')[-1])
-            last_node = self.visedges.loc[last_edge, 'ToNode']
-            last_vertex = self.visedges.loc[last_edge, 'DestinVertex']
-            # set destination lot node
-            parking_lots.loc[path.ToParkLot, 'Node'] = last_node
-            parking_lots.loc[path.ToParkLot, 'VertexName'] = last_vertex
-            parking_lots.loc[path.ToParkLot, 'Type'] = 'destination'
+
+        if path_file is not None:
+            self.path_index = PathFileIndex(path_file)
+            from_lots, first_edges = self.path_index.origin_edges()
+            to_lots, last_edges = self.path_index.destination_edges()
+        else:
+            vissim_net.Paths.ReadDynAssignPathFile()
+            paths = vissim_net.Paths.GetMultipleAttributes(['FromParkLot', 'ToParkLot', 'EdgeSeq'])
+            paths = pd.DataFrame([list(p) for p in paths], columns=['FromParkLot', 'ToParkLot', 'EdgeSeq'])
+            paths[['FromParkLot', 'ToParkLot']] = paths[['FromParkLot', 'ToParkLot']].astype(int)
+
+            # only the first path of every lot is needed
+            from_lot_paths = paths.drop_duplicates(subset=['FromParkLot'])
+            to_lot_paths = paths.drop_duplicates(subset=['ToParkLot'])
+            from_lots = from_lot_paths['FromParkLot'].values
+            first_edges = from_lot_paths['EdgeSeq'].str.partition(',')[0].astype(np.int64).values
+            to_lots = to_lot_paths['ToParkLot'].values
+            last_edges = to_lot_paths['EdgeSeq'].str.rpartition(',')[2].astype(np.int64).values
+
+        node = np.zeros(parking_lots.shape[0], dtype=self.visedges['FromNode'].dtype)
+        vertex_name = np.full(parking_lots.shape[0], '', dtype=object)
+        lot_type = np.full(parking_lots.shape[0], '', dtype=object)
+        # destination is written last, as a lot with paths from and to it was marked before
+        for lots, edges, node_col, vertex_col, end in ((from_lots, first_edges, 'FromNode', 'OriginVertex', 'origin'),
+                                                       (to_lots, last_edges, 'ToNode', 'DestinVertex', 'destination')):
+            rows = parking_lots.index.get_indexer(lots)
+            positions = self.edge_positions(edges[rows >= 0])
+            rows = rows[rows >= 0]
+            node[rows] = self.visedges[node_col].values[positions]
+            vertex_name[rows] = self.visedges[vertex_col].values[positions]
+            lot_type[rows] = end
+        parking_lots["Type"] = lot_type
+        parking_lots["Node"] = node
+        parking_lots["VertexName"] = vertex_name
 
         return parking_lots
 
+    def routing_copy(self) -> 'VissimRoadNet':
+        """
+        This function copies the topology, edge and parking lot tables and default vehicle class weights of this graph
+        into a new graph without vehicles, travel times or VISSIM objects, small enough to be sent to a worker process
+        that computes routes with parking_lot_routes_batch
+        :return: graph with the topology, tables and weights of this graph
+        """
+        graph = VissimRoadNet(self.vcount(), self.get_edgelist(), True, {},
+                              {'name': self.vs['name'], 'node': self.vs['node']}, {'name': self.es['name']})
+        graph.weight_sets[self.DEFAULT_CLASS] = WeightSet('weight', self.route_cache.maxsize)
+        graph.visedges = self.visedges
+        graph.parking_lots = self.parking_lots
+        graph.set_weights(self._weights)
+        return graph
+
     def parking_lot_routes(self,
                           origin_lot: (int, Sequence[int]),
                           destination_lot: (int, Sequence[int])) -> Tuple[list, list]:
@@ -198,6 +1248,9 @@ class VissimRoadNet(igraph.Graph):
         :param destination_lot: The destination parking lot number as defined in VISSIM
         :return: sequence of node numbers as a list
         """
+        if isinstance(origin_lot, Integral) and isinstance(destination_lot, Integral):
+            # single lot pairs are served through the route cache
+            return self.parking_lot_routes_batch([(origin_lot, destination_lot)])
 
         origin_vertex = self.parking_lots.loc[origin_lot, 'VertexName']
         destination_vertex = self.parking_lots.loc[destination_lot, 'VertexName']
@@ -216,13 +1269,258 @@ class VissimRoadNet(igraph.Graph):
         edge_no_seqs = [self.visedges.index[edge_ind_seq] for edge_ind_seq in edge_ind_seqs]
         return node_seqs, edge_no_seqs
 
+    @profiled('parking_lot_routes')
+    def parking_lot_routes_batch(self, lot_pairs: Sequence[Tuple[int, int]], vehicle_class: str = DEFAULT_CLASS
+                                 ) -> Tuple[list, list]:
+        """
+        This function computes the least costly paths for many parking lot pairs, such as all vehicles departed in a
+        simulation step. Pairs found in the route cache are not searched again, the rest are grouped by origin vertex
+        and one single source search is run per origin. Origins with a single destination are searched with A* when
+        landmark_search is set and landmarks are built.
+        :param lot_pairs: sequence of (origin lot, destination lot) numbers as defined in VISSIM
+        :param vehicle_class: name of the vehicle class whose weights and route cache are used
+        :return: node number sequences and edge number sequences, one per lot pair in input order
+        """
+        return self._routes_batch(lot_pairs, vehicle_class)
+
+    @profiled('parking_lot_routes')
+    def class_routes_batch(self, class_lot_pairs: Dict[str, Sequence[Tuple[int, int]]]
+                           ) -> Dict[str, Tuple[list, list]]:
+        """
+        This function computes the least costly paths of the parking lot pairs of several vehicle classes in one pass.
+        The edge lookups and the parking lot vertex lookups that group the requests by origin are done once for all
+        classes, the searches are still run per class and origin on the class weights and route cache.
+        :param class_lot_pairs: dictionary of vehicle class name to sequence of (origin lot, destination lot) numbers
+        :return: dictionary of vehicle class name to node number sequences and edge number sequences, one per lot pair
+            in input order
+        """
+        edge_target_node = None
+        lot_vertices = self._lot_vertices(lot for lot_pairs in class_lot_pairs.values()
+                                          for lot_pair in lot_pairs for lot in lot_pair)
+        routes = OrderedDict()
+        for vehicle_class, lot_pairs in class_lot_pairs.items():
+            if edge_target_node is None and lot_pairs:
+                edge_target_node = self._edge_target_node()
+            routes[vehicle_class] = self._routes_batch(lot_pairs, vehicle_class, edge_target_node, lot_vertices)
+        return routes
+
+    def _edge_target_node(self) -> np.ndarray:
+        # node at the end of every edge
+        return np.asarray(self.vs['node'])[np.asarray(self.get_edgelist(), dtype=int)[:, 1]]
+
+    def _lot_vertices(self, lots: Iterable[int]) -> Dict[int, str]:
+        # vertex name of every parking lot
+        lots = list(set(int(lot) for lot in lots))
+        return dict(zip(lots, self.parking_lots.loc[lots, 'VertexName'].tolist()))
+
+    def _routes_batch(self, lot_pairs: Sequence[Tuple[int, int]], vehicle_class: str,
+                      edge_target_node: Optional[np.ndarray] = None,
+                      lot_vertices: Optional[Dict[int, str]] = None) -> Tuple[list, list]:
+        weight_set = self.weight_sets[vehicle_class]
+        route_cache, generation = weight_set.route_cache, weight_set.generation
+        # the cost matrix and landmarks are built on the default class weights
+        default_class = vehicle_class == self.DEFAULT_CLASS
+        node_seqs = [None] * len(lot_pairs)
+        edge_no_seqs = [None] * len(lot_pairs)
+
+        # find the requests missing from the route cache
+        uncached = OrderedDict()
+        for index, lot_pair in enumerate(lot_pairs):
+            lot_pair = (int(lot_pair[0]), int(lot_pair[1]))
+            route = route_cache.get(lot_pair, generation)
+            if route is not None:
+                node_seqs[index] = list(route[0])
+                edge_no_seqs[index] = route[1]
+            else:
+                uncached.setdefault(lot_pair, []).append(index)
+        if not uncached:
+            return node_seqs, edge_no_seqs
+
+        # look up the node at the end of every edge once for the whole batch
+        if edge_target_node is None:
+            edge_target_node = self._edge_target_node()
+
+        # rebuild the routes of lot pairs in a current cost matrix from its shortest path trees
+        if default_class and self.lot_costs is not None and self.lot_costs.generation == generation:
+            for lot_pair in list(uncached.keys()):
+                edge_ind_seq = self.lot_costs.edge_path(*lot_pair)
+                if edge_ind_seq is not None:
+                    route = self._edge_route(edge_ind_seq, edge_target_node)
+                    route_cache.put(lot_pair, generation, route)
+                    for index in uncached.pop(lot_pair):
+                        node_seqs[index] = list(route[0])
+                        edge_no_seqs[index] = route[1]
+            if not uncached:
+                return node_seqs, edge_no_seqs
+
+        # group the uncached requests by origin vertex
+        if lot_vertices is None:
+            lot_vertices = self._lot_vertices(lot for lot_pair in uncached.keys() for lot in lot_pair)
+        requests = OrderedDict()
+        for lot_pair in uncached.keys():
+            requests.setdefault(lot_vertices[lot_pair[0]], OrderedDict()).setdefault(
+                lot_vertices[lot_pair[1]], []).append(lot_pair)
+
+        for origin, destinations in requests.items():
+            if default_class and self.landmark_search and self.landmarks is not None and len(destinations) == 1:
+                # a single destination is found with goal directed search
+                paths = [self.landmarks.edge_path(self.vs.find(name=origin).index,
+                                                  self.vs.find(name=next(iter(destinations))).index)]
+            else:
+                paths = self.get_shortest_paths(v=origin, to=list(destinations.keys()), weights=weight_set.attribute,
+                                                output='epath')
+            route_cache.searches += 1
+            for lot_pairs_to_destination, edge_ind_seq in zip(destinations.values(), paths):
+                route = self._edge_route(edge_ind_seq, edge_target_node)
+                for lot_pair in lot_pairs_to_destination:
+                    route_cache.put(lot_pair, generation, route)
+                    for index in uncached[lot_pair]:
+                        node_seqs[index] = list(route[0])
+                        edge_no_seqs[index] = route[1]
+
+        return node_seqs, edge_no_seqs
+
+    def _edge_route(self, edge_ind_seq: Sequence[int], edge_target_node: np.ndarray) -> Tuple[tuple, pd.Index]:
+        # route of an edge position path as its node numbers without consecutive duplicates and its edge numbers
+        nodes = edge_target_node[np.asarray(edge_ind_seq[:-1], dtype=np.int64)]
+        nodes = nodes[np.r_[True, nodes[1:] != nodes[:-1]]] if len(nodes) else nodes
+        return tuple(nodes.tolist()), self.visedges.index[edge_ind_seq]
+
+    def build_landmarks(self, count: int = 16, lower_bounds: Optional[Sequence[float]] = None) -> LandmarkIndex:
+        """
+        This function precomputes the landmark distances used to search single parking lot pairs with A*, which
+        parking_lot_routes_batch only does when landmark_search is set. The paths found are least costly under the
+        current weights whatever the lower bounds, closer bounds prune more. Needs python-igraph 0.10 or later.
+        :param count: number of landmarks
+        :param lower_bounds: lower bound of every edge travel time in graph edge order, defaults to the current
+            travel times, which are the free flow times until the first weight update
+        :return: the new landmarks
+        """
+        if lower_bounds is None:
+            lower_bounds = self._travel_time
+        self.landmarks = LandmarkIndex(self, lower_bounds, count)
+        return self.landmarks
+
+    def update_lot_costs(self) -> LotCostMatrix:
+        """
+        This function computes the least cost between every origin and destination parking lot on the current weights
+        in one batched search. Until the weights change, lot_cost and lot_route answer from it without searching and
+        parking_lot_routes_batch rebuilds routes from its shortest path trees.
+        :return: the new lot_costs
+        """
+        self.lot_costs = LotCostMatrix(self)
+        return self.lot_costs
+
+    def _current_lot_costs(self) -> LotCostMatrix:
+        if self.lot_costs is None or self.lot_costs.generation != self.weight_generation:
+            self.update_lot_costs()
+        return self.lot_costs
+
+    def lot_cost(self, origin_lot: int, destination_lot: int) -> float:
+        """
+        This function looks up the least cost between two parking lots, recomputing the cost matrix if the weights
+        changed since it was computed
+        :param origin_lot: origin parking lot number
+        :param destination_lot: destination parking lot number
+        :return: least cost, inf if the destination can not be reached
+        """
+        return self._current_lot_costs().cost(int(origin_lot), int(destination_lot))
+
+    def lot_route(self, origin_lot: int, destination_lot: int) -> Tuple[list, pd.Index]:
+        """
+        This function rebuilds the least costly route between two parking lots from the cost matrix trees,
+        recomputing the cost matrix if the weights changed since it was computed
+        :param origin_lot: origin parking lot number
+        :param destination_lot: destination parking lot number
+        :return: node number sequence and edge number sequence of the route
+        """
+        edge_ind_seq = self._current_lot_costs().edge_path(int(origin_lot), int(destination_lot))
+        if edge_ind_seq is None:
+            node_seqs, edge_no_seqs = self.parking_lot_routes_batch([(origin_lot, destination_lot)])
+            return node_seqs[0], edge_no_seqs[0]
+        nodes, edge_nos = self._edge_route(edge_ind_seq, self.lot_costs.edge_target_node)
+        return list(nodes), edge_nos
+
+    @property
+    def weight_generation(self) -> int:
+        """
+        :return: weight generation of the default vehicle class
+        """
+        return self.weight_sets[self.DEFAULT_CLASS].generation
+
+    @property
+    def route_cache(self) -> RouteCache:
+        """
+        :return: route cache of the default vehicle class
+        """
+        return self.weight_sets[self.DEFAULT_CLASS].route_cache
+
+    @property
+    def _weights(self) -> Optional[np.ndarray]:
+        return self.weight_sets[self.DEFAULT_CLASS].weights
+
+    @property
+    def changed_edges(self) -> np.ndarray:
+        """
+        :return: positions of the edges whose default vehicle class weight changed in the last write
+        """
+        return self.weight_sets[self.DEFAULT_CLASS].changed_edges
+
+    @property
+    def edge_volume(self) -> pd.Series:
+        """
+        Number of vehicles on each edge, indexed by edge number. The series shares memory with the volume counter.
+        """
+        return pd.Series(self._edge_volume, index=self.visedges.index, copy=False)
+
+    @edge_volume.setter
+    def edge_volume(self, volume: Sequence[int]) -> None:
+        self._edge_volume = np.array(volume, dtype=np.int64)
+
+    @property
+    def period_flow(self) -> pd.Series:
+        """
+        Number of vehicles departed in the current dynamic assignment interval on each edge of their path, indexed by
+        edge number. The series shares memory with the flow counter.
+        """
+        return pd.Series(self._period_flow, index=self.visedges.index, copy=False)
+
+    @property
+    def travel_time(self) -> pd.Series:
+        """
+        Last recorded travel time of each edge, indexed by edge number. The series shares memory with the travel time
+        array.
+        """
+        return pd.Series(self._travel_time, index=self.visedges.index, copy=False)
+
+    @travel_time.setter
+    def travel_time(self, travel_time: Sequence[float]) -> None:
+        self._travel_time = np.array(travel_time, dtype=float)
+
+    def edge_positions(self, edge_nos: Sequence[int]) -> np.ndarray:
+        """
+        This function maps VISSIM edge numbers to their positions in visedges and the graph edge sequence
+        :param edge_nos: edge numbers
+        :return: integer array of edge positions
+        """
+        positions = self.visedges.index.get_indexer(np.asarray(edge_nos, dtype=np.int64))
+        if (positions < 0).any():
+            raise KeyError("Edges {} are not in the graph".format(np.asarray(edge_nos)[positions < 0].tolist()))
+        return positions
+
+    def _path_positions(self, edge_no_seqs: Sequence[Sequence[int]]) -> np.ndarray:
+        edge_no_seqs = [np.asarray(edge_no_seq, dtype=np.int64) for edge_no_seq in edge_no_seqs]
+        if not edge_no_seqs:
+            return np.empty(0, dtype=np.int64)
+        return self.edge_positions(np.concatenate(edge_no_seqs))
+
     def add_volume(self, edge_no_seq: Sequence[int]) -> None:
         """
         This function takes in a list of edge no sequence paths and add to their volume counts
         :param edge_no_seq:
         :return:
         """
-        self.edge_volume.loc[edge_no_seq] = self.edge_volume.loc[edge_no_seq] + 1
+        self.add_volumes([edge_no_seq])
 
     def remove_volume(self, edge_no_seq: Sequence[int]) -> None:
         """
@@ -230,41 +1528,190 @@ class VissimRoadNet(igraph.Graph):
         :param edge_no_seq:
         :return:
         """
-        self.edge_volume.loc[edge_no_seq] = self.edge_volume.loc[edge_no_seq] - 1
-        self.edge_volume.clip_lower(0, inplace=True)
+        self.remove_volumes([edge_no_seq])
+
+    def add_volumes(self, edge_no_seqs: Sequence[Sequence[int]]) -> None:
+        """
+        This function adds one vehicle to every edge of every path in the batch, counting edges visited more than
+        once in a path every time
+        :param edge_no_seqs: sequence of edge number paths
+        """
+        np.add.at(self._edge_volume, self._path_positions(edge_no_seqs), 1)
+
+    def remove_volumes(self, edge_no_seqs: Sequence[Sequence[int]]) -> None:
+        """
+        This function removes one vehicle from every edge of every path in the batch, volumes do not go below zero
+        :param edge_no_seqs: sequence of edge number paths
+        """
+        np.subtract.at(self._edge_volume, self._path_positions(edge_no_seqs), 1)
+        np.maximum(self._edge_volume, 0, out=self._edge_volume)
+
+    def reassign_volumes(self, veh_nos: Sequence[int], edge_no_seqs: Sequence[Sequence[int]]) -> None:
+        """
+        This function moves vehicles counted in the edge volumes and the period flow from their recorded paths to new
+        ones, such as vehicles rerouted after update_volume recorded their departure
+        :param veh_nos: vehicle numbers
+        :param edge_no_seqs: edge numbers of the new path of every vehicle
+        """
+        veh_nos = [int(veh_no) for veh_no in veh_nos]
+        old_positions = self._path_positions([self.veh_paths[veh_no] for veh_no in veh_nos if veh_no in self.veh_paths])
+        np.subtract.at(self._edge_volume, old_positions, 1)
+        np.subtract.at(self._period_flow, old_positions, 1)
+        np.maximum(self._edge_volume, 0, out=self._edge_volume)
+        np.maximum(self._period_flow, 0, out=self._period_flow)
+        for veh_no, edge_no_seq in zip(veh_nos, edge_no_seqs):
+            self.veh_paths[veh_no] = edge_no_seq
+        new_positions = self._path_positions(edge_no_seqs)
+        np.add.at(self._edge_volume, new_positions, 1)
+        np.add.at(self._period_flow, new_positions, 1)
 
+    def path_edge_seq(self, vis_net, path_no: int) -> np.ndarray:
+        """
+        This function returns the edge numbers of a VISSIM path, reading and parsing its EdgeSeq only the first time
+        the path is seen. The cache is keyed by path number and cleared by the SO loops at the start of a run.
+        :param vis_net: VISSIM INet object
+        :param path_no: VISSIM path number
+        :return: array of edge numbers
+        """
+        edge_seq = self.path_edges.get(path_no)
+        if edge_seq is None:
+            edge_seq = vis_net.Paths.ItemByKey(path_no).AttValue('EdgeSeq')
+            edge_seq = np.array([int(edge) for edge in edge_seq.split(',')], dtype=np.int32)
+            self.path_edges[path_no] = edge_seq
+        return edge_seq
+
+    @profiled('update_volume')
     def update_volume(self, vis_net):
-        new_vehs = vis_net.Vehicles.GetDeparted().GetAll()
-        for veh in new_vehs:
-            new_path = [int(edge) for edge in veh.Path.AttValue('EdgeSeq').split(',')]
-            self.veh_paths[veh.AttValue('No')] = new_path
-            self.add_volume(new_path)
+        """
+        This function adds the paths of vehicles departed in the last time step to the edge volumes and the period
+        flow and removes the paths of vehicles arrived from the edge volumes. Vehicle attributes are read in bulk, one
+        COM call per container.
+        :param vis_net: VISSIM INet object
+        """
+        new_vehs = vis_net.Vehicles.GetDeparted().GetMultipleAttributes(self.VISSIM_Vehicle_Attributes)
+        new_paths = []
+        for veh_no, path_no in new_vehs:
+            new_path = self.path_edge_seq(vis_net, int(path_no))
+            self.veh_paths[int(veh_no)] = new_path
+            new_paths.append(new_path)
+        positions = self._path_positions(new_paths)
+        np.add.at(self._edge_volume, positions, 1)
+        np.add.at(self._period_flow, positions, 1)
 
-        departed_vehs = vis_net.Vehicles.GetArrived().GetAll()
-        for veh in departed_vehs:
-            old_path = self.veh_paths[veh.AttValue('No')]
-            self.remove_volume(old_path)
+        departed_vehs = vis_net.Vehicles.GetArrived().GetMultipleAttributes(['No'])
+        self.remove_volumes([self.veh_paths.pop(int(veh_no)) for veh_no, in departed_vehs])
 
+    @profiled('update_weights')
     def update_weights(self, vis_net):
+        """
+        This function reads the edge travel times of the last dynamic assignment interval once it is over and writes
+        the new weights. Closed edges get a travel time of 99999. The travel times read are recorded in travel_times,
+        vehicle classes with a weight function get their new weights and the parking lot cost matrix is recomputed on
+        the new default weights. The marginal cost of the cost model is taken at the period flow of the interval, the
+        vehicles departed in it on each edge of their path, as the model is fitted on the VOLNEW flow of an interval,
+        and the period flow starts again from zero.
+        :param vis_net: VISSIM INet object
+        """
         current_DTA_period = ceil(vis_net.Simulation.SimulationSecond / vis_net.DynamicAssignment.AttValue('EvalInt'))
         # update recorded travel time
         if current_DTA_period > self._traveltimeperiod:
             new_travel_times = vis_net.Edges.GetMultiAttValues(f'TravTmRaw({current_DTA_period - 1})')
             # remove edges without recorded travel time
             new_travel_times = [edge for edge in new_travel_times if edge[1]]
-            index, new_travel_times = tuple(zip(*new_travel_times))
-            self._traveltime.loc[index] = list(new_travel_times)
+            if new_travel_times:
+                index, new_travel_times = zip(*new_travel_times)
+                positions = self.edge_positions(index)
+                self._travel_time[positions] = new_travel_times
+                if self.travel_times is not None:
+                    self.travel_times.record(current_DTA_period - 1, new_travel_times, positions)
             self._traveltimeperiod = current_DTA_period
             # increase travel time for closed edges
-            closed_edges = self.visedges['Closed'].astype(bool)
-            self._traveltime.loc[closed_edges] = 99999
+            self._travel_time[self._closed_positions] = 99999
+
+            if self.cost_model is None:
+                self.set_weights(self._travel_time)
+            else:
+                self.set_weights(self._travel_time + self.cost_model.marginal_cost(self._period_flow))
+            self._period_flow[:] = 0
+            for vehicle_class, weight_set in self.weight_sets.items():
+                if weight_set.weight_function is not None:
+                    self.set_weights(weight_set.weight_function(self), vehicle_class)
+            self.update_lot_costs()
+
+    def set_weights(self, weights: Sequence[float], vehicle_class: str = DEFAULT_CLASS) -> None:
+        """
+        This function writes the path search weight of every edge for a vehicle class. All weight writes should go
+        through here.
 
-            # TODO change weights to travel time plus marginal cost instead of just travel time
-            self.es['weight'] = self._traveltime.to_list()
+        Only edges whose weight changed are written to the graph, and their positions are kept in the changed_edges of
+        the class. If any weight changed the weight generation of the class is increased, which invalidates its cached
+        routes. When every change is an increase, cached routes avoiding the changed edges are still least costly and
+        are kept.
+        :param weights: weight of every edge in graph edge order
+        :param vehicle_class: name of the vehicle class, as given to add_vehicle_class
+        """
+        weight_set = self.weight_sets[vehicle_class]
+        weights = np.array(weights, dtype=float)
+        previous = weight_set.weights
+        if previous is None or previous.shape != weights.shape:
+            self.es[weight_set.attribute] = weights.tolist()
+            changed = np.arange(len(weights))
+            increased = False
+        else:
+            changed = np.flatnonzero((weights != previous) & ~(np.isnan(weights) & np.isnan(previous)))
+            if len(changed):
+                self.es[changed.tolist()][weight_set.attribute] = weights[changed].tolist()
+            increased = bool((weights[changed] > previous[changed]).all())
+        weight_set.weights = weights
+        weight_set.changed_edges = changed
+        if len(changed):
+            weight_set.generation += 1
+            if increased and weight_set.route_cache.generation == weight_set.generation - 1:
+                changed_nos = set(self.visedges.index[changed].tolist())
+                weight_set.route_cache.carry_over(weight_set.generation,
+                                                  lambda route: changed_nos.isdisjoint(route[1]))
+
+    def add_vehicle_class(self, vehicle_class: str, weights: Optional[Sequence[float]] = None,
+                          weight_function: Optional[Callable[['VissimRoadNet'], np.ndarray]] = None,
+                          route_cache_size: Optional[int] = None) -> WeightSet:
+        """
+        This function adds a vehicle class routed on its own weights, such as a ride share fleet routed on its own
+        marginal cost. The weights are kept as an edge attribute of this graph, so every class adds one weight per edge
+        and no graph copy.
+        :param vehicle_class: name of the vehicle class
+        :param weights: initial weight of every edge in graph edge order, defaults to weight_function or else the
+            weights of the default class
+        :param weight_function: function computing the weights of the class from this graph, called by update_weights
+            after the travel times are read
+        :param route_cache_size: number of parking lot pair routes of the class kept between weight updates, defaults
+            to the size of the default class cache
+        :return: weight set of the class
+        """
+        if vehicle_class in self.weight_sets:
+            raise ValueError("Vehicle class {} already exists".format(vehicle_class))
+        if route_cache_size is None:
+            route_cache_size = self.route_cache.maxsize
+        weight_set = WeightSet('weight_' + vehicle_class, route_cache_size, weight_function)
+        if weights is None:
+            weights = self._weights if weight_function is None else weight_function(self)
+        self.weight_sets[vehicle_class] = weight_set
+        self.set_weights(weights, vehicle_class)
+        return weight_set
+
+    def remove_vehicle_class(self, vehicle_class: str) -> None:
+        """
+        This function removes a vehicle class added by add_vehicle_class and its edge attribute
+        :param vehicle_class: name of the vehicle class
+        """
+        if vehicle_class == self.DEFAULT_CLASS:
+            raise ValueError("The default vehicle class can not be removed")
+        del self.es[self.weight_sets.pop(vehicle_class).attribute]
 
 
 # Testing code
 if __name__ == "__main__":
+    import win32com.client as com
+
     Vissim = com.gencache.EnsureDispatch("Vissim.Vissim")
     from win32com.client import constants as c
 
@@ -279,4 +1726,3 @@ if __name__ == "__main__":
     road_graph = VissimRoadNet(Net)
     # road_graph.write_svg(r"J:\Thesis\test.svg", width=3000, height=3000)
     Vissim.Exit()
-    com.dynamic.
\ No newline at end of file
@@ -0,0 +1,631 @@
+"""
+Pure Python stand-in for the parts of the VISSIM COM interface used by VISSIM_helpers and SO_sim_runner
+
+The objects mimic the win32com dispatch objects closely enough for VissimRoadNet and the SO control loop to run on them
+without a VISSIM instance, and count every call that would be a COM round trip in COM_CALLS.
+
+Vissim builds a simulated network from the shipped network_graph.pkl.gz, edges_attr.pkl.gz, edge_free_flow.pkl.gz and
+ODZone.pkl files. Vehicles depart from parking lots with Poisson demand drawn from the zone demand matrix, follow their
+assigned path edge by edge and arrive after the sum of their edge travel times, which grow with the number of vehicles
+on each edge.
+"""
+import pickle
+import re
+import gzip
+from collections import Counter, OrderedDict, defaultdict, deque
+from typing import Sequence, Hashable, Iterable, Optional, Dict, List, Tuple
+
+import numpy as np
+import pandas as pd
+
+from VISSIM_helpers import com_error, VissimRoadNet
+
+try:
+    from pandas.compat.pickle_compat import Unpickler
+except ImportError:
+    from pickle import Unpickler
+
+# number of calls per COM method that would cross the process boundary
+COM_CALLS = Counter()
+
+
+class ComObject:
+    """
+    This class is a network object with attributes read and written through AttValue and SetAttValue
+    """
+
+    def __init__(self, **attributes):
+        self.attributes = attributes
+
+    def AttValue(self, attribute: str):
+        COM_CALLS['AttValue'] += 1
+        return self.attributes[attribute]
+
+    def SetAttValue(self, attribute: str, value) -> None:
+        COM_CALLS['SetAttValue'] += 1
+        self.attributes[attribute] = value
+
+
+class Container:
+    """
+    This class is a COM collection of network objects keyed by their 'No' attribute
+    """
+
+    def __init__(self, items: Iterable[ComObject] = ()):
+        self.items = OrderedDict((item.attributes['No'], item) for item in items)
+
+    def __iter__(self):
+        return iter(list(self.items.values()))
+
+    def __len__(self):
+        return len(self.items)
+
+    @property
+    def Count(self) -> int:
+        COM_CALLS['Count'] += 1
+        return len(self.items)
+
+    def add(self, item: ComObject) -> ComObject:
+        self.items[item.attributes['No']] = item
+        return item
+
+    def GetAll(self) -> tuple:
+        COM_CALLS['GetAll'] += 1
+        return tuple(self.items.values())
+
+    def ItemByKey(self, key: Hashable) -> ComObject:
+        COM_CALLS['ItemByKey'] += 1
+        return self.items[key]
+
+    def GetMultipleAttributes(self, attributes: Sequence[str]) -> tuple:
+        COM_CALLS['GetMultipleAttributes'] += 1
+        return tuple(tuple(item.attributes[attribute] for attribute in attributes) for item in self.items.values())
+
+    def GetMultiAttValues(self, attribute: str) -> tuple:
+        COM_CALLS['GetMultiAttValues'] += 1
+        return tuple((key, item.attributes[attribute]) for key, item in self.items.items())
+
+
+class Path(ComObject):
+    """
+    This class is a dynamic assignment path, its EdgeSeq attribute is the comma separated edge numbers
+    """
+
+
+class Vehicle(ComObject):
+    """
+    This class is a vehicle in the network, its 'Path' attribute is the number of the path it is assigned to
+    """
+
+    def __init__(self, paths: Container, simulator: Optional['Vissim'] = None, **attributes):
+        super(Vehicle, self).__init__(**attributes)
+        self.paths = paths
+        self.simulator = simulator
+
+    @property
+    def Path(self) -> Path:
+        COM_CALLS['Path'] += 1
+        return self.paths.items[self.attributes['Path']]
+
+    def AssignPath(self, path: Path) -> None:
+        COM_CALLS['AssignPath'] += 1
+        if self.simulator is not None:
+            self.simulator.assign_path(self, path)
+        else:
+            self.attributes['Path'] = path.attributes['No']
+
+
+class IMatrix:
+    """
+    This class is a demand matrix, read and written cell by cell or, if bulk is set, in one call
+    """
+
+    def __init__(self, values: np.ndarray, bulk: bool = True):
+        self.values = np.array(values, dtype=float)
+        self.bulk = bulk
+
+    @property
+    def RowCount(self) -> int:
+        COM_CALLS['RowCount'] += 1
+        return self.values.shape[0]
+
+    @property
+    def ColCount(self) -> int:
+        COM_CALLS['ColCount'] += 1
+        return self.values.shape[1]
+
+    def GetValue(self, row: int, col: int) -> float:
+        COM_CALLS['GetValue'] += 1
+        return float(self.values[row - 1, col - 1])
+
+    def SetValue(self, row: int, col: int, value: float) -> None:
+        COM_CALLS['SetValue'] += 1
+        self.values[row - 1, col - 1] = value
+
+    def GetValues(self) -> Tuple[Tuple[float, ...], ...]:
+        COM_CALLS['GetValues'] += 1
+        if not self.bulk:
+            raise com_error("GetValues: member not found")
+        return tuple(map(tuple, self.values.tolist()))
+
+    def SetValues(self, values: Sequence[Sequence[float]]) -> None:
+        COM_CALLS['SetValues'] += 1
+        if not self.bulk:
+            raise com_error("SetValues: member not found")
+        self.values[:] = values
+
+
+class DynAssignDemand(ComObject):
+    """
+    This class is a dynamic assignment demand with its matrix
+    """
+
+    def __init__(self, matrix: IMatrix, **attributes):
+        super(DynAssignDemand, self).__init__(**attributes)
+        self.Matrix = matrix
+
+
+class Vehicles:
+    """
+    This class is the vehicles in the network, with the vehicles departed and arrived during the last time step
+    """
+
+    def __init__(self):
+        self.departed = Container()
+        self.arrived = Container()
+
+    def GetDeparted(self) -> Container:
+        COM_CALLS['GetDeparted'] += 1
+        return self.departed
+
+    def GetArrived(self) -> Container:
+        COM_CALLS['GetArrived'] += 1
+        return self.arrived
+
+
+class Edges(Container):
+    """
+    This class is the dynamic assignment graph edges, TravTmRaw(period) attributes are the mean edge travel time of
+    the finished evaluation periods from the simulator
+    """
+
+    def __init__(self, items: Iterable[ComObject] = (), simulator: Optional['Vissim'] = None):
+        super(Edges, self).__init__(items)
+        self.simulator = simulator
+
+    def GetMultiAttValues(self, attribute: str) -> tuple:
+        match = re.match(r'TravTmRaw\((\d+)\)', attribute)
+        if match is None or self.simulator is None:
+            return super(Edges, self).GetMultiAttValues(attribute)
+        COM_CALLS['GetMultiAttValues'] += 1
+        travel_times = self.simulator.period_travel_times.get(int(match.group(1)))
+        if travel_times is None:
+            return tuple((key, None) for key in self.items)
+        return tuple((key, None if np.isnan(time) else float(time))
+                     for key, time in zip(self.items, travel_times))
+
+
+class Paths(Container):
+    """
+    This class is the dynamic assignment paths, new paths are checked against the simulator network
+    """
+
+    def __init__(self, items: Iterable[ComObject] = (), simulator: Optional['Vissim'] = None):
+        super(Paths, self).__init__(items)
+        self.simulator = simulator
+
+    def ReadDynAssignPathFile(self) -> None:
+        COM_CALLS['ReadDynAssignPathFile'] += 1
+
+    def AddPath(self, from_lot: int, to_lot: int, nodes: Sequence[str]) -> Path:
+        """
+        This function adds a path between two parking lots through the given node numbers, raising com_error if the
+        nodes are not a path of the network
+        """
+        COM_CALLS['AddPath'] += 1
+        edges = self.simulator.edges_through_nodes(int(from_lot), int(to_lot), [int(node) for node in nodes])
+        if edges is None:
+            raise com_error("AddPath failed: the node sequence is not a path from parking lot {} to {}"
+                            .format(from_lot, to_lot))
+        return self.simulator.add_path(int(from_lot), int(to_lot), edges)
+
+
+class Simulation(ComObject):
+    """
+    This class is the simulation run control
+    """
+
+    def __init__(self, simulator: 'Vissim', **attributes):
+        super(Simulation, self).__init__(**attributes)
+        self.simulator = simulator
+
+    @property
+    def SimulationSecond(self) -> float:
+        COM_CALLS['SimulationSecond'] += 1
+        return self.simulator.simulation_second
+
+    def RunSingleStep(self) -> None:
+        COM_CALLS['RunSingleStep'] += 1
+        self.simulator.step()
+
+    def RunContinuous(self) -> None:
+        COM_CALLS['RunContinuous'] += 1
+        while self.simulator.simulation_second < self.attributes['SimPeriod']:
+            self.simulator.step()
+
+
+class INet:
+    """
+    This class is the network object holding the graph edges, parking lots, paths and vehicles
+    """
+
+    def __init__(self, simulator: Optional['Vissim'] = None):
+        self.Edges = Edges(simulator=simulator)
+        self.ParkingLots = Container()
+        self.Paths = Paths(simulator=simulator)
+        self.Vehicles = Vehicles()
+        self.DynamicAssignment = ComObject(EvalInt=600)
+        self.DynamicAssignment.DynAssignDemands = Container()
+        self.Simulation = Simulation(simulator, SimPeriod=4500, SimRes=1, RandSeed=42) \
+            if simulator is not None else None
+
+
+class NetworkWindow(ComObject):
+    pass
+
+
+class Graphics:
+    def __init__(self):
+        self.CurrentNetworkWindow = NetworkWindow(QuickMode=0)
+
+
+def load_network_graph(graph_file: str = 'network_graph.pkl.gz') -> VissimRoadNet:
+    """
+    This function loads a VissimRoadNet graph saved with Graph.save(format='picklez'), reading pandas tables pickled
+    by older pandas versions
+    :param graph_file: path to the gzipped pickle
+    :return: graph with the pickled vertex and edge attributes and the visedges table
+    """
+    with gzip.open(graph_file, 'rb') as graph_pickle:
+        return Unpickler(graph_pickle).load()
+
+
+class Vissim:
+    """
+    This class stands in for the VISSIM application object, simulating a dynamic assignment network from the shipped
+    network files with synthetic demand
+    """
+    # evaluation interval of the free flow volumes, seconds
+    EVAL_INT = 600
+    # largest travel time increase over free flow, VISSIM queues spill back instead of slowing down without bound
+    MAX_CONGESTION = 10.
+
+    def __init__(self, graph_file: str = 'network_graph.pkl.gz', edges_file: str = 'edges_attr.pkl.gz',
+                 edge_ff: str = 'edge_free_flow.pkl.gz', od_file: str = 'ODZone.pkl', demand_scale: float = 1.,
+                 demand_hours: float = 1., seed: int = 42):
+        """
+        :param graph_file: pickled network graph whose topology vehicles drive on
+        :param edges_file: edge table read through Net.Edges
+        :param edge_ff: free flow edge travel times
+        :param od_file: pickled dictionary with the zone numbers and zone demand matrices
+        :param demand_scale: factor applied to the demand matrices
+        :param demand_hours: number of hours the demand matrices are spread over
+        :param seed: random seed of the demand
+        """
+        self.Net = INet(self)
+        self.Simulation = self.Net.Simulation
+        self.Graphics = Graphics()
+        self.rng = np.random.RandomState(seed)
+
+        # network edges, the graph edges are in the same order as the edge table
+        edges = pd.read_pickle(edges_file)
+        self.graph = load_network_graph(graph_file)
+        assert self.graph.ecount() == edges.shape[0]
+        self.vertex_node = np.array([int(name.split('.')[1]) for name in self.graph.vs['name']])
+        self.edge_nos = edges.index.values
+        self.edge_source, self.edge_target = np.array(self.graph.get_edgelist()).T
+        for edge_no, edge in edges.iterrows():
+            attributes = {attribute: edge[attribute] for attribute in VissimRoadNet.VISSIM_Edge_Attributes[1:]
+                          if attribute in edges.columns}
+            attributes['Type'] = 'DYNAMICASSIGNMENT'
+            self.Net.Edges.add(ComObject(No=edge_no, **attributes))
+
+        # edge travel time grows with the vehicles on the edge, as in a BPR function, the capacity is the larger of the
+        # edge storage and twice the vehicles on the edge at the measured free flow volume
+        free_flow = pd.read_pickle(edge_ff).reindex(edges.index)
+        self.free_flow_time = free_flow['TravelTime mean'].fillna(edges['Length'] / 51.3333).values
+        free_flow_occupancy = free_flow['Volume mean'].fillna(0).values / self.EVAL_INT * self.free_flow_time
+        self.edge_capacity = np.maximum.reduce([edges['Length'].values / 25., 2. * free_flow_occupancy,
+                                                np.full(edges.shape[0], 2.)])
+        self.edge_occupancy = np.zeros(edges.shape[0], dtype=np.int64)
+        self.edge_time_sum = np.zeros(edges.shape[0])
+        self.edge_time_count = np.zeros(edges.shape[0], dtype=np.int64)
+        self.period_travel_times: Dict[int, np.ndarray] = {}
+
+        # parking lots, origins on edges without entering edges and destinations on edges without exiting edges
+        with open(od_file, 'rb') as od_pickle:
+            od_zones = pickle.load(od_pickle)
+        zones = od_zones['zones_NOs']
+        for demand_no, matrix in enumerate(od_zones['demand_matrices'], start=1):
+            self.Net.DynamicAssignment.DynAssignDemands.add(DynAssignDemand(IMatrix(matrix), No=demand_no))
+        origin_edges = np.flatnonzero((edges['FromEdges'] == '').values)
+        destination_edges = np.flatnonzero((edges['ToEdges'] == '').values)
+        self.lot_edge = {}
+        self.lot_vertex = {}
+        lot_zone = {}
+        for lot_no, edge in enumerate(np.r_[origin_edges, destination_edges], start=1):
+            is_origin = lot_no <= len(origin_edges)
+            self.lot_edge[lot_no] = edge
+            self.lot_vertex[lot_no] = self.edge_source[edge] if is_origin else self.edge_target[edge]
+            lot_zone[lot_no] = zones[(lot_no - 1) % len(zones)]
+            self.Net.ParkingLots.add(ComObject(No=lot_no, Zone=lot_zone[lot_no], Type='ZONECONNECTOR'))
+        origin_lots = list(range(1, len(origin_edges) + 1))
+        destination_lots = list(range(len(origin_edges) + 1, len(origin_edges) + len(destination_edges) + 1))
+
+        # lot pairs connected by the network, with the free flow paths VISSIM would start vehicles on
+        origin_vertices, origin_position = np.unique([self.lot_vertex[lot] for lot in origin_lots],
+                                                     return_inverse=True)
+        destination_vertices, destination_position = np.unique([self.lot_vertex[lot] for lot in destination_lots],
+                                                               return_inverse=True)
+        lot_distances = np.array(self.graph.shortest_paths(source=origin_vertices.tolist(),
+                                                           target=destination_vertices.tolist(),
+                                                           weights=self.free_flow_time.tolist()))
+        lot_distances = lot_distances[origin_position][:, destination_position]
+        lot_distances[lot_distances == 0] = np.inf
+        self.default_paths: Dict[Tuple[int, int], Path] = {}
+        for origin, distances in zip(origin_lots, lot_distances):
+            reachable = np.flatnonzero(np.isfinite(distances))
+            if len(reachable):
+                self.default_path(origin, destination_lots[reachable[0]])
+        for destination, distances in zip(destination_lots, lot_distances.T):
+            reachable = np.flatnonzero(np.isfinite(distances))
+            if len(reachable):
+                self.default_path(origin_lots[reachable[0]], destination)
+
+        # demand per second of every connected lot pair, zone demand is split evenly over the zone lot pairs
+        demand = sum(np.asarray(matrix, dtype=float) for matrix in od_zones['demand_matrices'])
+        demand *= demand_scale / (demand_hours * 3600.)
+        zone_position = {zone: position for position, zone in enumerate(zones)}
+        pair_rates = []
+        self.lot_pairs = []
+        for (origin_position, origin), (destination_position, destination) in \
+                ((o, d) for o in enumerate(origin_lots) for d in enumerate(destination_lots)):
+            if np.isfinite(lot_distances[origin_position, destination_position]):
+                self.lot_pairs.append((origin, destination))
+                pair_rates.append(demand[zone_position[lot_zone[origin]], zone_position[lot_zone[destination]]])
+        pair_rates = np.array(pair_rates)
+        zone_pairs = Counter((lot_zone[origin], lot_zone[destination]) for origin, destination in self.lot_pairs)
+        pair_rates /= [zone_pairs[(lot_zone[origin], lot_zone[destination])] for origin, destination in self.lot_pairs]
+        self.demand_rate = pair_rates.sum()
+        self.pair_cdf = np.cumsum(pair_rates) / self.demand_rate
+
+        # vehicles in the network and when they arrive, by simulation step
+        self.simulation_step = 0
+        self.next_vehicle_no = 1
+        self.vehicles: Dict[int, Vehicle] = {}
+        self.starting: List[Vehicle] = []
+        self.arrivals: Dict[int, List[int]] = defaultdict(list)
+        # edges entered and left, with the time spent on them, by simulation step
+        self.edge_entries: Dict[int, List[int]] = defaultdict(list)
+        self.edge_exits: Dict[int, List[Tuple[int, float]]] = defaultdict(list)
+        # planned path of every vehicle driving, as edges, start step, exit seconds after the start, entry and exit
+        # steps and travel times of every edge
+        self.schedules: Dict[int, tuple] = {}
+        # entries and exits of the paths vehicles were moved off, by simulation step
+        self.cancelled_entries: Dict[int, List[int]] = defaultdict(list)
+        self.cancelled_exits: Dict[int, Counter] = defaultdict(Counter)
+        self._travel_times_step = None
+        self._travel_times = None
+
+    def AttValue(self, attribute: str):
+        COM_CALLS['AttValue'] += 1
+        return {'WorkingFolder': '.'}[attribute]
+
+    def LoadNet(self, *args) -> None:
+        pass
+
+    def SuspendUpdateGUI(self) -> None:
+        pass
+
+    def ResumeUpdateGUI(self) -> None:
+        pass
+
+    def Exit(self) -> None:
+        pass
+
+    @property
+    def step_length(self) -> float:
+        return 1. / self.Simulation.attributes['SimRes']
+
+    @property
+    def simulation_second(self) -> float:
+        return self.simulation_step * self.step_length
+
+    def edge_travel_times(self) -> np.ndarray:
+        """
+        :return: current travel time of every edge from the number of vehicles on it, computed once per step as the
+            occupancy only changes when a step is run
+        """
+        if self._travel_times_step != self.simulation_step:
+            congestion = np.minimum(0.15 * (self.edge_occupancy / self.edge_capacity) ** 4, self.MAX_CONGESTION)
+            self._travel_times = self.free_flow_time * (1. + congestion)
+            self._travel_times_step = self.simulation_step
+        return self._travel_times
+
+    def add_path(self, from_lot: int, to_lot: int, edges: Sequence[int]) -> Path:
+        """
+        This function adds a path through the given edge positions to Net.Paths
+        :return: new path
+        """
+        path = Path(No=len(self.Net.Paths) + 1, FromParkLot=from_lot, ToParkLot=to_lot,
+                    EdgeSeq=','.join(str(self.edge_nos[edge]) for edge in edges))
+        path.edges = np.asarray(edges, dtype=np.int64)
+        return self.Net.Paths.add(path)
+
+    def write_path_file(self, file_path: str) -> None:
+        """
+        This function writes Net.Paths to a dynamic assignment path file with one row per path
+        """
+        with open(file_path, 'w') as path_file:
+            path_file.write("$VISION\n* File: {}\n*\n* Table: Paths\n$PATH:NO;FROMPARKLOT;TOPARKLOT;EDGESEQ\n"
+                            .format(file_path))
+            for path in self.Net.Paths:
+                path_file.write("{};{};{};{}\n".format(path.attributes['No'], path.attributes['FromParkLot'],
+                                                        path.attributes['ToParkLot'], path.attributes['EdgeSeq']))
+
+    def default_path(self, from_lot: int, to_lot: int) -> Path:
+        """
+        This function returns the free flow shortest path between the lots, adding it to the paths the first time
+        """
+        path = self.default_paths.get((from_lot, to_lot))
+        if path is None:
+            edges = self.graph.get_shortest_paths(self.lot_vertex[from_lot], self.lot_vertex[to_lot],
+                                                  weights=self.free_flow_time.tolist(), output='epath')[0]
+            path = self.add_path(from_lot, to_lot, edges)
+            self.default_paths[(from_lot, to_lot)] = path
+        return path
+
+    def edges_through_nodes(self, from_lot: int, to_lot: int, nodes: Sequence[int]) -> Optional[list]:
+        """
+        This function finds the edges of a path between two parking lots that passes through the node numbers in order,
+        the node of the final vertex is not part of the sequence
+        :return: list of edge positions or None if there is no such path
+        """
+        start, end = self.lot_vertex[from_lot], self.lot_vertex[to_lot]
+        parents = {(start, 0): None}
+        queue = deque([(start, 0)])
+        while queue:
+            vertex, matched = queue.popleft()
+            for edge in self.graph.incident(vertex, mode='out'):
+                target = self.edge_target[edge]
+                if target == end and matched == len(nodes):
+                    edges = [edge]
+                    state = (vertex, matched)
+                    while parents[state] is not None:
+                        state, state_edge = parents[state]
+                        edges.append(state_edge)
+                    return edges[::-1]
+                node = self.vertex_node[target]
+                if matched < len(nodes) and node == nodes[matched]:
+                    next_state = (target, matched + 1)
+                elif matched and node == nodes[matched - 1]:
+                    next_state = (target, matched)
+                else:
+                    continue
+                if next_state not in parents:
+                    parents[next_state] = ((vertex, matched), edge)
+                    queue.append(next_state)
+        return None
+
+    def _schedule(self, vehicle: Vehicle, edges: np.ndarray, start_step: int, first: Optional[tuple] = None) -> None:
+        """
+        This function plans when the vehicle enters and leaves every edge of its path from the current travel times
+        :param edges: edge positions of the path
+        :param start_step: simulation step the vehicle starts on the path in
+        :param first: schedule of the first edge kept when a vehicle is moved to a new path on its first edge, as
+            (exit seconds after start_step, entry step, exit step, travel time)
+        """
+        travel_times = self.edge_travel_times()[edges]
+        if first is not None:
+            travel_times[0] = first[3]
+        exit_times = np.cumsum(travel_times)
+        entry_steps = start_step + np.ceil((exit_times - travel_times) / self.step_length).astype(int)
+        exit_steps = np.maximum(start_step + np.ceil(exit_times / self.step_length).astype(int), entry_steps + 1)
+        if first is not None:
+            entry_steps[0], exit_steps[0] = first[1], first[2]
+        planned = slice(0 if first is None else 1, None)
+        for edge, entry_step, exit_step, travel_time in zip(edges[planned].tolist(), entry_steps[planned].tolist(),
+                                                            exit_steps[planned].tolist(),
+                                                            travel_times[planned].tolist()):
+            self.edge_entries[entry_step].append(edge)
+            self.edge_exits[exit_step].append((edge, travel_time))
+        self.arrivals[exit_steps[-1]].append(vehicle.attributes['No'])
+        self.schedules[vehicle.attributes['No']] = (edges, start_step, exit_times, entry_steps, exit_steps,
+                                                    travel_times)
+
+    def assign_path(self, vehicle: Vehicle, path: Path) -> None:
+        """
+        This function moves a vehicle to a new path. Vehicles assigned in their departure step drive on the new path
+        from the start, vehicles already driving can only be moved while on the first edge of their path, to a path
+        starting on that edge.
+        """
+        if path.attributes['FromParkLot'] != vehicle.attributes['OrigParkLot'] \
+                or path.attributes['ToParkLot'] != vehicle.attributes['DestParkLot']:
+            raise com_error("AssignPath failed: path {} does not connect the vehicle parking lots"
+                            .format(path.attributes['No']))
+        schedule = self.schedules.get(vehicle.attributes['No'])
+        if schedule is not None:
+            edges, start_step, exit_times, entry_steps, exit_steps, travel_times = schedule
+            if path.edges[0] != edges[0] or (len(edges) > 1 and self.simulation_step >= entry_steps[1]):
+                raise com_error("AssignPath failed: vehicle {} has left the first edge of path {}"
+                                .format(vehicle.attributes['No'], path.attributes['No']))
+            # cancel the plans of the old path after the first edge, the arrival is dropped as it no longer matches
+            # the schedule
+            for edge, entry_step, exit_step, travel_time in zip(edges[1:].tolist(), entry_steps[1:].tolist(),
+                                                                exit_steps[1:].tolist(), travel_times[1:].tolist()):
+                self.cancelled_entries[entry_step].append(edge)
+                self.cancelled_exits[exit_step][(edge, travel_time)] += 1
+            self._schedule(vehicle, path.edges, start_step, (exit_times[0], entry_steps[0], exit_steps[0],
+                                                              travel_times[0]))
+        vehicle.attributes['Path'] = path.attributes['No']
+
+    def step(self) -> None:
+        """
+        This function runs one simulation time step, moving vehicles over the edges, recording edge travel times and
+        departing and arriving vehicles
+        """
+        # vehicles departed in the last step start on the paths assigned to them
+        for vehicle in self.starting:
+            self._schedule(vehicle, self.Net.Paths.items[vehicle.attributes['Path']].edges, self.simulation_step)
+        self.starting = []
+        self.simulation_step += 1
+
+        # edges entered and left in this step, travel times are recorded when vehicles leave an edge
+        entries = self.edge_entries.pop(self.simulation_step, [])
+        np.add.at(self.edge_occupancy, entries, 1)
+        np.subtract.at(self.edge_occupancy, self.cancelled_entries.pop(self.simulation_step, []), 1)
+        exits = self.edge_exits.pop(self.simulation_step, [])
+        cancelled = self.cancelled_exits.pop(self.simulation_step, None)
+        if cancelled:
+            kept = []
+            for edge_exit in exits:
+                if cancelled[edge_exit]:
+                    cancelled[edge_exit] -= 1
+                else:
+                    kept.append(edge_exit)
+            exits = kept
+        if exits:
+            exit_edges, exit_times = np.array(exits).T
+            exit_edges = exit_edges.astype(np.int64)
+            np.subtract.at(self.edge_occupancy, exit_edges, 1)
+            np.add.at(self.edge_time_sum, exit_edges, exit_times)
+            np.add.at(self.edge_time_count, exit_edges, 1)
+
+        # close the evaluation period when it is over
+        eval_int = self.Net.DynamicAssignment.attributes['EvalInt']
+        if self.simulation_second % eval_int < self.step_length / 2:
+            with np.errstate(invalid='ignore'):
+                period_times = self.edge_time_sum / self.edge_time_count
+            self.period_travel_times[int(round(self.simulation_second / eval_int))] = period_times
+            self.edge_time_sum[:] = 0
+            self.edge_time_count[:] = 0
+
+        # arrivals
+        arrived = [self.vehicles.pop(veh_no) for veh_no in sorted(set(self.arrivals.pop(self.simulation_step, ())))
+                   if veh_no in self.schedules and self.schedules[veh_no][4][-1] == self.simulation_step]
+        for vehicle in arrived:
+            del self.schedules[vehicle.attributes['No']]
+        self.Net.Vehicles.arrived = Container(arrived)
+
+        # departures
+        departures = self.rng.poisson(self.demand_rate * self.step_length)
+        departed = []
+        for pair in np.searchsorted(self.pair_cdf, self.rng.random_sample(departures), side='right'):
+            from_lot, to_lot = self.lot_pairs[min(pair, len(self.lot_pairs) - 1)]
+            vehicle = Vehicle(self.Net.Paths, self, No=self.next_vehicle_no, OrigParkLot=from_lot,
+                              DestParkLot=to_lot, Path=self.default_path(from_lot, to_lot).attributes['No'])
+            self.next_vehicle_no += 1
+            self.vehicles[vehicle.attributes['No']] = vehicle
+            departed.append(vehicle)
+        self.starting = departed
+        self.Net.Vehicles.departed = Container(departed)
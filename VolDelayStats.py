@@ -0,0 +1,266 @@
+"""
+Streaming statistics of edge volumes and travel times over many dynamic assignment runs
+
+VolDelayStats takes timevol_table outputs with ITR and Demand columns one table at a time, such as the partitions of a
+dataset written by EdgeRouteParser.ingest_edge_vol_delay, and keeps running statistics for every edge, period, vehicle
+type and demand level in flat arrays with one entry per cell. The memory used depends on the number of cells, not on
+the number of runs added. Convergence metrics between successive iterations of every demand level are kept alongside.
+
+Summarize a dataset from the command line with:
+
+    python VolDelayStats.py DATASET_DIR [--summary FILE] [--convergence FILE]
+"""
+import argparse
+from typing import Iterable, List
+
+import numpy as np
+import pandas as pd
+
+from EdgeRouteParser import iter_dataset
+
+COLUMNS = ['NO', 'Period', 'VehType', 'TRAVTMNEW', 'VOLNEW', 'ITR', 'Demand']
+# state arrays kept per cell with the value of a new cell
+CELL_STATE = (('tt_count', np.int64, 0), ('tt_mean', float, 0.), ('tt_m2', float, 0.), ('tt_min', float, np.inf),
+              ('tt_max', float, -np.inf), ('vol_count', np.int64, 0), ('vol_mean', float, 0.), ('vol_m2', float, 0.),
+              ('last_itr', np.int32, -1), ('last_tt', float, np.nan))
+# sums kept per demand level and iteration: compared cells, absolute and squared travel time change, volume weighted
+# absolute change, volume weighted previous travel time and cells within the converged change
+ITERATION_SUMS = 6
+
+
+def _group_moments(groups: np.ndarray, values: np.ndarray, size: int):
+    # count, mean and sum of squared deviations of the values of every group
+    count = np.bincount(groups, minlength=size)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.bincount(groups, weights=values, minlength=size) / count
+    m2 = np.bincount(groups, weights=(values - mean[groups]) ** 2, minlength=size)
+    return count, np.where(count > 0, mean, 0.), m2
+
+
+def _combine_moments(count, mean, m2, new_count, new_mean, new_m2):
+    # Chan et al. update of the running moments with the moments of a new batch
+    total = count + new_count
+    with np.errstate(invalid='ignore', divide='ignore'):
+        delta = new_mean - mean
+        combined_mean = np.where(total > 0, mean + delta * new_count / total, 0.)
+        combined_m2 = m2 + new_m2 + np.where(total > 0, delta ** 2 * count * new_count / total, 0.)
+    return total, combined_mean, combined_m2
+
+
+class VolDelayStats:
+    """
+    This class aggregates edge travel times and volumes of dynamic assignment runs table by table
+
+    Every (edge, period, vehicle type, demand) cell keeps the count, mean and variance of TRAVTMNEW and VOLNEW, updated
+    with the Welford and Chan et al. formulas so no run is kept in memory, and the minimum and maximum travel time. For
+    every cell the travel time of the last iteration added is kept to measure the change to the next iteration, summed
+    per demand level and iteration. Iterations of a demand level must be added in increasing order, a run may be split
+    over several tables.
+    """
+
+    def __init__(self, converged_change: float = 0.15):
+        """
+        :param converged_change: largest relative travel time change of a cell between successive iterations for the
+            cell to count as converged
+        """
+        self.converged_change = converged_change
+        # sorted cell keys NO << 32 | Period << 16 | vehicle type code << 8 | demand code
+        self.keys = np.empty(0, dtype=np.int64)
+        for name, dtype, fill in CELL_STATE:
+            setattr(self, name, np.empty(0, dtype=dtype))
+        self.veh_types: List[str] = []
+        self.demands: List[float] = []
+        self.iteration_sums = {}
+        self.tables = 0
+        self.rows = 0
+
+    def _codes(self, known: list, values) -> np.ndarray:
+        # code of every value in known, adding new values at the end
+        codes = []
+        for value in values:
+            if value not in known:
+                if len(known) == 255:
+                    raise ValueError("More than 255 vehicle types or demand levels")
+                known.append(value)
+            codes.append(known.index(value))
+        return np.array(codes, dtype=np.int64)
+
+    def _cells(self, keys: np.ndarray) -> np.ndarray:
+        # position of every key in the cell arrays, adding the new cells
+        positions = np.searchsorted(self.keys, keys)
+        found = positions < len(self.keys)
+        found[found] = self.keys[positions[found]] == keys[found]
+        if not found.all():
+            new_keys = np.unique(keys[~found])
+            insert_at = np.searchsorted(self.keys, new_keys)
+            self.keys = np.insert(self.keys, insert_at, new_keys)
+            for name, dtype, fill in CELL_STATE:
+                setattr(self, name, np.insert(getattr(self, name), insert_at, fill))
+            positions = np.searchsorted(self.keys, keys)
+        return positions
+
+    def add(self, table: pd.DataFrame) -> 'VolDelayStats':
+        """
+        This function adds the rows of a table to the statistics
+        :param table: dataframe with NO, Period, VehType, TRAVTMNEW, VOLNEW, ITR and Demand columns, such as a
+            partition from iter_dataset or the output of read_edge_vol_delay
+        :return: these statistics
+        """
+        missing = [col for col in COLUMNS if col not in table.columns]
+        if missing:
+            raise ValueError("Table has no {} columns".format(missing))
+        if table.shape[0] == 0:
+            return self
+
+        veh_types = table['VehType'].astype('category')
+        veh_codes = self._codes(self.veh_types, [str(veh) for veh in veh_types.cat.categories])
+        veh_codes = veh_codes[veh_types.cat.codes.to_numpy()]
+        demands, demand_rows = np.unique(table['Demand'].to_numpy(), return_inverse=True)
+        demand_codes = self._codes(self.demands, [round(float(demand), 6) for demand in demands])[demand_rows]
+        keys = table['NO'].to_numpy().astype(np.int64) << 32 | table['Period'].to_numpy().astype(np.int64) << 16 \
+            | veh_codes << 8 | demand_codes
+        cells = self._cells(keys)
+        travel_time = table['TRAVTMNEW'].to_numpy().astype(float)
+        volume = table['VOLNEW'].to_numpy().astype(float)
+        itr = table['ITR'].to_numpy().astype(np.int64)
+        self._add_moments(cells, travel_time, volume)
+
+        # runs are compared to the previous iteration one (demand, iteration) at a time
+        runs, run_rows = np.unique(demand_codes << 32 | itr, return_inverse=True)
+        if len(runs) == 1:
+            self._add_iteration(int(runs[0]), cells, travel_time, volume)
+        else:
+            order = np.argsort(run_rows, kind='stable')
+            bounds = np.searchsorted(run_rows[order], np.arange(len(runs) + 1))
+            for run, start, end in zip(runs.tolist(), bounds[:-1], bounds[1:]):
+                rows = order[start:end]
+                self._add_iteration(run, cells[rows], travel_time[rows], volume[rows])
+        self.tables += 1
+        self.rows += table.shape[0]
+        return self
+
+    def _add_moments(self, cells: np.ndarray, travel_time: np.ndarray, volume: np.ndarray) -> None:
+        # combine the moments of the rows of every cell with the running moments
+        unique_cells, groups = np.unique(cells, return_inverse=True)
+        size = len(unique_cells)
+        timed = np.isfinite(travel_time)
+        count, mean, m2 = _group_moments(groups[timed], travel_time[timed], size)
+        self.tt_count[unique_cells], self.tt_mean[unique_cells], self.tt_m2[unique_cells] = _combine_moments(
+            self.tt_count[unique_cells], self.tt_mean[unique_cells], self.tt_m2[unique_cells], count, mean, m2)
+        np.minimum.at(self.tt_min, cells[timed], travel_time[timed])
+        np.maximum.at(self.tt_max, cells[timed], travel_time[timed])
+
+        counted = np.isfinite(volume)
+        count, mean, m2 = _group_moments(groups[counted], volume[counted], size)
+        self.vol_count[unique_cells], self.vol_mean[unique_cells], self.vol_m2[unique_cells] = _combine_moments(
+            self.vol_count[unique_cells], self.vol_mean[unique_cells], self.vol_m2[unique_cells], count, mean, m2)
+
+    def _add_iteration(self, run: int, cells: np.ndarray, travel_time: np.ndarray, volume: np.ndarray) -> None:
+        # sum the travel time change of the cells of one demand level and iteration since their last iteration
+        demand_code, itr = run >> 32, run & 0xFFFFFFFF
+        last_itr = self.last_itr[cells]
+        if (last_itr > itr).any():
+            raise ValueError("Iteration {} of demand {} is added after iteration {}"
+                             .format(itr, self.demands[demand_code], int(last_itr.max())))
+        last_tt = self.last_tt[cells]
+        compared = (last_itr >= 0) & (last_itr < itr) & np.isfinite(travel_time) & np.isfinite(last_tt)
+        change = np.abs(travel_time[compared] - last_tt[compared])
+        weight = np.where(np.isfinite(volume[compared]), volume[compared], 0.)
+        sums = np.array([compared.sum(), change.sum(), (change ** 2).sum(), (weight * change).sum(),
+                         (weight * last_tt[compared]).sum(),
+                         (change <= self.converged_change * last_tt[compared]).sum()])
+        key = (int(demand_code), int(itr))
+        self.iteration_sums[key] = self.iteration_sums.get(key, np.zeros(ITERATION_SUMS)) + sums
+        self.last_itr[cells] = itr
+        self.last_tt[cells] = travel_time
+
+    def add_tables(self, tables: Iterable[pd.DataFrame]) -> 'VolDelayStats':
+        """
+        This function adds tables one at a time, so only one is in memory if tables is a generator
+        :param tables: iterable of dataframes as taken by add
+        :return: these statistics
+        """
+        for table in tables:
+            self.add(table)
+        return self
+
+    @classmethod
+    def from_dataset(cls, dataset_dir: str, converged_change: float = 0.15) -> 'VolDelayStats':
+        """
+        This function aggregates every partition of a dataset written by ingest_edge_vol_delay
+        :param dataset_dir: dataset folder
+        :param converged_change: largest relative travel time change of a converged cell
+        :return: statistics of the dataset
+        """
+        return cls(converged_change).add_tables(iter_dataset(dataset_dir))
+
+    def summary(self) -> pd.DataFrame:
+        """
+        :return: dataframe with NO, Period, VehType and Demand columns and the number of periods with a travel time,
+            mean, sample variance, minimum and maximum travel time and number of periods, mean and sample variance of
+            the volume of every cell, ordered by NO, Period, VehType and Demand
+        """
+        veh_types = sorted(self.veh_types)
+        veh_rank = np.array([veh_types.index(veh) for veh in self.veh_types], dtype=np.int64)
+        demands = np.array(self.demands, dtype=float)
+        veh_codes = (self.keys >> 8) & 0xFF
+        demand_codes = self.keys & 0xFF
+        with np.errstate(invalid='ignore', divide='ignore'):
+            frame = pd.DataFrame({
+                'NO': (self.keys >> 32).astype(np.int64),
+                'Period': ((self.keys >> 16) & 0xFFFF).astype(np.int64),
+                'VehType': pd.Categorical.from_codes(veh_rank[veh_codes], veh_types),
+                'Demand': demands[demand_codes],
+                'TravelTimeCount': self.tt_count,
+                'TravelTimeMean': np.where(self.tt_count > 0, self.tt_mean, np.nan),
+                'TravelTimeVar': np.where(self.tt_count > 1, self.tt_m2 / (self.tt_count - 1), np.nan),
+                'TravelTimeMin': np.where(self.tt_count > 0, self.tt_min, np.nan),
+                'TravelTimeMax': np.where(self.tt_count > 0, self.tt_max, np.nan),
+                'VolumeCount': self.vol_count,
+                'VolumeMean': np.where(self.vol_count > 0, self.vol_mean, np.nan),
+                'VolumeVar': np.where(self.vol_count > 1, self.vol_m2 / (self.vol_count - 1), np.nan),
+            })
+        return frame.sort_values(['NO', 'Period', 'VehType', 'Demand'], kind='stable').reset_index(drop=True)
+
+    def convergence(self) -> pd.DataFrame:
+        """
+        This function computes the change of every iteration from the previous iteration of its demand level, over the
+        cells with a travel time in both. The relative gap is the volume weighted absolute travel time change over the
+        volume weighted previous travel time, and the converged share is the share of cells whose travel time changed
+        by at most converged_change of the previous travel time.
+        :return: dataframe indexed by Demand and ITR with the number of cells compared, mean absolute and root mean
+            square travel time change, relative gap and converged share, one row per iteration following another
+        """
+        keys = sorted((self.demands[demand_code], itr) for demand_code, itr in self.iteration_sums)
+        sums = np.array([self.iteration_sums[(self.demands.index(demand), itr)] for demand, itr in keys]) \
+            .reshape(-1, ITERATION_SUMS)
+        cells = sums[:, 0]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            frame = pd.DataFrame({
+                'Cells': cells.astype(np.int64),
+                'MeanAbsChange': sums[:, 1] / cells,
+                'RMSChange': np.sqrt(sums[:, 2] / cells),
+                'RelativeGap': sums[:, 3] / sums[:, 4],
+                'ConvergedShare': sums[:, 5] / cells,
+            }, index=pd.MultiIndex.from_tuples(keys, names=['Demand', 'ITR']) if keys
+                else pd.MultiIndex.from_arrays([[], []], names=['Demand', 'ITR']))
+        return frame[frame['Cells'] > 0]
+
+    def memory_footprint(self) -> int:
+        """
+        :return: bytes held by the cell arrays
+        """
+        return self.keys.nbytes + sum(getattr(self, name).nbytes for name, dtype, fill in CELL_STATE)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Summarize the edge volumes and travel times of a dataset")
+    parser.add_argument('dataset_dir')
+    parser.add_argument('--summary', default='vol_delay_summary.csv')
+    parser.add_argument('--convergence', default='vol_delay_convergence.csv')
+    args = parser.parse_args()
+
+    stats = VolDelayStats.from_dataset(args.dataset_dir)
+    stats.summary().to_csv(args.summary, index=False)
+    stats.convergence().to_csv(args.convergence)
+    print("{} tables, {} rows, {} cells".format(stats.tables, stats.rows, len(stats.keys)))
@@ -0,0 +1,1131 @@
+"""
+Benchmarks for the offline parts of the routing thesis code base.
+
+Run all benchmarks with ``python benchmarks.py`` or pick some by name, e.g. ``python benchmarks.py graph_build``
+"""
+import gzip
+import itertools
+import os
+import pickle
+import sys
+import tempfile
+import time
+import tracemalloc
+from timeit import default_timer as timer
+from collections import Counter
+from contextlib import contextmanager
+from typing import Callable, Dict, Sequence
+
+import numpy as np
+import pandas as pd
+
+import VissimStandIn
+from DynFileFuncs import dynamic_assignment_file_read, tonumeric, colu_to_type, timevol_table
+from VISSIM_helpers import VissimRoadNet, VehiclePathRegistry, StepProfiler, IMatrix_to_numpy, \
+    set_IMatrix_from_numpy, remove_loops, remove_loops_batch, TravelTimeStore, graph_distances
+from SO_sim_runner import run_so, run_so_pipelined
+from MaginalCostModel import NetworkModel
+from EdgeRouteParser import iter_files_by_ext, ingest_edge_vol_delay, read_edge_vol_delay, read_dataset
+from VolDelayStats import VolDelayStats
+
+
+def best_time(func: Callable, repeat: int = 5) -> float:
+    """
+    This function runs func repeat times and returns the fastest wall time in seconds
+    :param func: callable without arguments
+    :param repeat: number of runs
+    :return: fastest run time in seconds
+    """
+    times = []
+    for _ in range(repeat):
+        start = timer()
+        func()
+        times.append(timer() - start)
+    return min(times)
+
+
+def legacy_vissim_net_to_igraph(graph: VissimRoadNet) -> pd.DataFrame:
+    """
+    Row by row graph builder that VissimRoadNet.vissim_net_to_igraph used before the bulk builder, kept as reference
+    """
+    all_edges = graph.visedges
+    for index in all_edges.index:
+        if not all_edges.loc[index].OriginVertex:
+            vertex_name = 'visnode.' + str(all_edges.loc[index].FromNode) + '.' + str(index)
+            graph.add_vertex(name=vertex_name, node=all_edges.loc[index].FromNode)
+            vertex_enter_edges = all_edges.loc[index].FromEdges
+            if vertex_enter_edges:
+                vertex_enter_edges = [int(ed) for ed in vertex_enter_edges.split(',')]
+                all_edges.loc[vertex_enter_edges, 'DestinVertex'] = vertex_name
+                vertex_exit_edges = [ed.split(',') for ed in all_edges.loc[vertex_enter_edges].ToEdges]
+                vertex_exit_edges = [int(ed) for ed in itertools.chain.from_iterable(vertex_exit_edges) if ed]
+                all_edges.loc[vertex_exit_edges, 'OriginVertex'] = vertex_name
+            else:
+                all_edges.loc[index, 'OriginVertex'] = vertex_name
+
+        if not all_edges.loc[index].DestinVertex:
+            vertex_name = 'visnode.' + str(all_edges.loc[index].ToNode) + '.' + str(index)
+            graph.add_vertex(name=vertex_name, node=all_edges.loc[index].ToNode)
+            vertex_exit_edges = all_edges.loc[index].ToEdges
+            if vertex_exit_edges:
+                vertex_exit_edges = [int(ed) for ed in vertex_exit_edges.split(',')]
+                all_edges.loc[vertex_exit_edges, 'OriginVertex'] = vertex_name
+                vertex_enter_edges = [ed.split(',') for ed in all_edges.loc[vertex_exit_edges].FromEdges]
+                vertex_enter_edges = [int(ed) for ed in itertools.chain.from_iterable(vertex_enter_edges) if ed]
+                all_edges.loc[vertex_enter_edges, 'DestinVertex'] = vertex_name
+            else:
+                all_edges.loc[index, 'DestinVertex'] = vertex_name
+
+        graph.add_edge(all_edges.loc[index, 'OriginVertex'],
+                       all_edges.loc[index, 'DestinVertex'],
+                       name="visedge." + str(index))
+    return all_edges
+
+
+def bench_graph_build(edges_file: str = 'edges_attr.pkl.gz') -> Dict[str, float]:
+    """
+    Builds the graph from the shipped edge table with the bulk and the legacy builders, checks that both give the
+    same OriginVertex/DestinVertex and graph, and reports their run times and the agreement with the shipped table
+    """
+    reference = pd.read_pickle(edges_file)
+    blank_edges = reference.copy()
+    blank_edges['OriginVertex'] = ""
+    blank_edges['DestinVertex'] = ""
+
+    def build(builder):
+        graph = VissimRoadNet()
+        graph.visedges = blank_edges.copy()
+        builder(graph)
+        return graph
+
+    bulk_graph = build(VissimRoadNet.vissim_net_to_igraph)
+    legacy_graph = build(legacy_vissim_net_to_igraph)
+    vertex_columns = ['OriginVertex', 'DestinVertex']
+    assert (bulk_graph.visedges[vertex_columns] == legacy_graph.visedges[vertex_columns]).all().all()
+    assert bulk_graph.vs['name'] == legacy_graph.vs['name']
+    assert bulk_graph.vs['node'] == [int(node) for node in legacy_graph.vs['node']]
+    assert bulk_graph.get_edgelist() == legacy_graph.get_edgelist()
+
+    # the shipped table also merges dead end edge ends by VISSIM node, which neither builder does
+    differing = (bulk_graph.visedges[vertex_columns] != reference[vertex_columns]).any(axis=1)
+    results = {
+        'vertices': bulk_graph.vcount(),
+        'shipped_vertices': len(set(reference.OriginVertex) | set(reference.DestinVertex)),
+        'edges_differing_from_shipped': int(differing.sum()),
+        'bulk_s': best_time(lambda: build(VissimRoadNet.vissim_net_to_igraph)),
+        'legacy_s': best_time(lambda: build(legacy_vissim_net_to_igraph), repeat=1),
+    }
+    results['speedup'] = results['legacy_s'] / results['bulk_s']
+    return results
+
+
+def write_synthetic_cost_file(file_path: str, edges: int, periods: int, veh_types: Sequence[str] = ('10', '20'),
+                              seed: int = 0) -> None:
+    """
+    This function writes a VISSIM style .bew cost file with random edge volumes and travel times
+    :param file_path: path of the file to write
+    :param edges: number of edges in the EdgeAttr and VolTime tables
+    :param periods: number of evaluation periods in the VolTime table
+    :param veh_types: vehicle types of the VolTime columns
+    :param seed: random seed
+    """
+    rng = np.random.RandomState(seed)
+    time_cols = ['TRAVTMNEW({},{})'.format(period, veh) for period in range(1, periods + 1) for veh in veh_types]
+    vol_cols = ['VOLNEW({},{})'.format(period, veh) for period in range(1, periods + 1) for veh in veh_types]
+    with open(file_path, 'w') as out:
+        out.write("$VISION\n* File: synthetic\n\n")
+        out.write("* Table: Dynamic assignment attributes\n$DYNAMICASSIGNMENT:CURITERIDX;NUMCONVSIMRUNS;EVALINT\n")
+        out.write("5;0;600\n\n")
+        out.write("* Table: Edge attributes\n$EDGE:NO;FROMNODE;TONODE;TYPE\n")
+        for edge in range(1, edges + 1):
+            out.write("{};{};{};DYNAMICASSIGNMENT\n".format(edge, edge * 2, edge * 2 + 1))
+        out.write("\n* Table: Edge volumes and travel times\n$EDGEVOLTIME:NO;" + ';'.join(time_cols + vol_cols) + "\n")
+        for edge in range(1, edges + 1):
+            times = np.round(rng.uniform(1, 120, len(time_cols)), 3)
+            volumes = rng.randint(0, 400, len(vol_cols))
+            out.write(str(edge) + ';' + ';'.join(map(str, times)) + ';' + ';'.join(map(str, volumes)) + '\n')
+
+
+def legacy_dynamic_assignment_file_read(file_path: str) -> Dict[str, pd.DataFrame]:
+    """
+    Row by row reader that dynamic_assignment_file_read used before the streaming reader, kept as reference
+    """
+    tablenames = ["DynAsnAttr", "EdgeAttr", "VolTime"]
+    output_dict = {}
+    current_table = ""
+    attributes = []
+    with open(file_path, 'r') as fileIO:
+        for line in fileIO.readlines():
+            if line[:8] == "* Table:":
+                current_table = tablenames[0]
+                tablenames = tablenames[1:]
+            elif line[0] == '$' and current_table:
+                if current_table not in output_dict:
+                    attributes = line.strip().strip('\n').split(':')[1].split(';')
+                    output_dict[current_table] = pd.DataFrame(columns=attributes)
+            split_line = line.strip().strip('\n').split(';')
+            if str.isdigit(split_line[0]) and current_table in output_dict:
+                split_line = [tonumeric(value) for value in split_line]
+                output_dict[current_table] = output_dict[current_table] \
+                    .append(dict(zip(attributes, split_line)), ignore_index=True)
+
+    for frame in output_dict.values():
+        for col in frame.columns.values:
+            coltype = colu_to_type(col)
+            if coltype is int:
+                frame[col] = frame[col].fillna(0)
+            frame[col] = frame[col].astype(coltype)
+    return output_dict
+
+
+def bench_cost_file_read(edges: int = 20000, periods: int = 8) -> Dict[str, float]:
+    """
+    Parses a generated cost file with tens of thousands of edges, reading all tables and just the VolTime table. The
+    previous row by row reader is timed on a small file when the installed pandas still has DataFrame.append.
+    """
+    results = {}
+    with tempfile.TemporaryDirectory() as folder:
+        big_file = os.path.join(folder, 'big.bew')
+        write_synthetic_cost_file(big_file, edges, periods)
+        results['file_MB'] = os.path.getsize(big_file) / 1e6
+        results['all_tables_s'] = best_time(lambda: dynamic_assignment_file_read(big_file), repeat=3)
+        results['voltime_only_s'] = best_time(lambda: dynamic_assignment_file_read(big_file, ['VolTime']), repeat=3)
+        results['rows_per_s'] = 2 * edges / results['all_tables_s']
+
+        if hasattr(pd.DataFrame, 'append'):
+            small_file = os.path.join(folder, 'small.bew')
+            write_synthetic_cost_file(small_file, 1000, periods)
+            new_tables = dynamic_assignment_file_read(small_file)
+            old_tables = legacy_dynamic_assignment_file_read(small_file)
+            for name, frame in old_tables.items():
+                pd.testing.assert_frame_equal(new_tables[name], frame, check_dtype=False)
+            results['small_s'] = best_time(lambda: dynamic_assignment_file_read(small_file))
+            results['small_legacy_s'] = best_time(lambda: legacy_dynamic_assignment_file_read(small_file), repeat=1)
+    return results
+
+
+def shipped_graph(edges_file: str = 'edges_attr.pkl.gz', edge_ff: str = 'edge_free_flow.pkl.gz') -> VissimRoadNet:
+    """
+    This function builds a VissimRoadNet from the shipped edge table without VISSIM. Free flow travel times are used
+    as weights, origin parking lots are put on edges without FromEdges and destination lots on edges without ToEdges.
+    """
+    graph = VissimRoadNet()
+    graph.visedges = pd.read_pickle(edges_file)
+    graph.visedges['OriginVertex'] = ""
+    graph.visedges['DestinVertex'] = ""
+    graph.vissim_net_to_igraph()
+    graph._edge_volume = np.zeros(graph.ecount(), dtype=np.int64)
+    graph._period_flow = np.zeros(graph.ecount(), dtype=np.int64)
+    graph.veh_paths = VehiclePathRegistry()
+    graph.path_edges = {}
+
+    travel_time = pd.read_pickle(edge_ff)['TravelTime mean'].reindex(graph.visedges.index)
+    travel_time = travel_time.fillna(graph.visedges['Length'] / 51.3333)
+    graph.travel_time = travel_time
+    graph._traveltimeperiod = 1
+    graph._closed_positions = np.flatnonzero(graph.visedges['Closed'].values)
+    graph.set_weights(graph._travel_time)
+
+    origins = graph.visedges[graph.visedges.FromEdges == '']
+    destinations = graph.visedges[graph.visedges.ToEdges == '']
+    graph.parking_lots = pd.DataFrame({
+        'Zone': 0,
+        'Type': ['origin'] * len(origins) + ['destination'] * len(destinations),
+        'Node': np.r_[origins.FromNode.values, destinations.ToNode.values],
+        'VertexName': np.r_[origins.OriginVertex.values, destinations.DestinVertex.values],
+    }, index=pd.Index(np.arange(1, len(origins) + len(destinations) + 1), name='No'))
+    return graph
+
+
+def legacy_update_volume(graph: VissimRoadNet, vis_net) -> None:
+    """
+    Vehicle by vehicle VissimRoadNet.update_volume from before the bulk reads, kept as reference
+    """
+    for veh in vis_net.Vehicles.GetDeparted().GetAll():
+        new_path = [int(edge) for edge in veh.Path.AttValue('EdgeSeq').split(',')]
+        graph.veh_paths[veh.AttValue('No')] = new_path
+        graph.add_volume(new_path)
+    for veh in vis_net.Vehicles.GetArrived().GetAll():
+        graph.remove_volume(graph.veh_paths.pop(veh.AttValue('No')))
+
+
+def bench_update_volume(steps: int = 100, departures: int = 200, trip_steps: int = 20,
+                        seed: int = 0) -> Dict[str, float]:
+    """
+    Replays random departures and arrivals through stand-in COM vehicle containers, updating the edge volumes with
+    the bulk update_volume and the vehicle by vehicle version. Checks both give the same volumes and reports their run
+    times, COM calls per step and the final size of the vehicle path registry.
+    """
+    rng = np.random.RandomState(seed)
+    graph = shipped_graph()
+    lots = graph.parking_lots
+    origin_lots = lots.index[lots.Type == 'origin']
+    destination_lots = lots.index[lots.Type == 'destination']
+    lot_pairs = list(zip(rng.choice(origin_lots, 300), rng.choice(destination_lots, 300)))
+    node_seqs, edge_seqs = graph.parking_lot_routes_batch(lot_pairs)
+    path_nos = [index + 1 for index, edge_seq in enumerate(edge_seqs) if len(edge_seq)]
+
+    vis_net = VissimStandIn.INet()
+    for path_no in path_nos:
+        vis_net.Paths.add(VissimStandIn.Path(No=path_no, EdgeSeq=','.join(map(str, edge_seqs[path_no - 1]))))
+    step_vehicles = [[VissimStandIn.Vehicle(vis_net.Paths, No=step * departures + veh + 1,
+                                            Path=int(rng.choice(path_nos)))
+                      for veh in range(departures)] for step in range(steps)]
+
+    def replay(update, target):
+        VissimStandIn.COM_CALLS.clear()
+        target._edge_volume[:] = 0
+        target._period_flow[:] = 0
+        target.veh_paths = VehiclePathRegistry()
+        target.path_edges = {}
+        start = timer()
+        for step in range(steps):
+            vis_net.Vehicles.departed = VissimStandIn.Container(step_vehicles[step])
+            vis_net.Vehicles.arrived = VissimStandIn.Container(step_vehicles[step - trip_steps]
+                                                               if step >= trip_steps else [])
+            update(target, vis_net)
+        return timer() - start, sum(VissimStandIn.COM_CALLS.values()) / steps, target.edge_volume.copy()
+
+    bulk_s, bulk_calls, bulk_volume = replay(VissimRoadNet.update_volume, graph)
+    registry = graph.veh_paths.memory_footprint()
+    legacy_s, legacy_calls, legacy_volume = replay(legacy_update_volume, graph)
+    assert (bulk_volume == legacy_volume).all()
+    return {
+        'live_vehicles': registry['live_vehicles'],
+        'registry_bytes': registry['total_bytes'],
+        'bulk_s': bulk_s,
+        'legacy_s': legacy_s,
+        'speedup': legacy_s / bulk_s,
+        'bulk_com_calls_per_step': bulk_calls,
+        'legacy_com_calls_per_step': legacy_calls,
+    }
+
+
+@contextmanager
+def timed_methods(timings: Counter, targets: Dict[str, tuple]):
+    """
+    This context manager replaces methods with wrappers adding their run time to timings
+    :param timings: counter of seconds by timing name
+    :param targets: dictionary of timing name to (object or class, method name)
+    """
+    originals = []
+    for name, (owner, method_name) in targets.items():
+        method = getattr(owner, method_name)
+
+        def timed(*args, _method=method, _name=name, **kwargs):
+            start = timer()
+            try:
+                return _method(*args, **kwargs)
+            finally:
+                timings[_name] += timer() - start
+
+        originals.append((owner, method_name, owner.__dict__.get(method_name)))
+        setattr(owner, method_name, timed)
+    try:
+        yield timings
+    finally:
+        for owner, method_name, original in originals:
+            if original is None:
+                delattr(owner, method_name)
+            else:
+                setattr(owner, method_name, original)
+
+
+def bench_so_loop(end_second: int = 1800, seed: int = 42) -> Dict[str, float]:
+    """
+    Runs the SO control loop of SO_sim_runner on the offline VISSIM stand-in and reports the simulated steps per
+    second and the time spent in every phase of the loop. The stand-in simulation itself is timed as run_single_step.
+    """
+    vissim = VissimStandIn.Vissim(seed=seed)
+    graph = VissimRoadNet(vissim.Net)
+    timings = Counter()
+    phases = {
+        'update_weights': (graph, 'update_weights'),
+        'routes_batch': (graph, 'parking_lot_routes_batch'),
+        'add_path': (vissim.Net.Paths, 'AddPath'),
+        'assign_path': (VissimStandIn.Vehicle, 'AssignPath'),
+        'update_volume': (graph, 'update_volume'),
+        'run_single_step': (vissim.Simulation, 'RunSingleStep'),
+    }
+    VissimStandIn.COM_CALLS.clear()
+    with timed_methods(timings, phases):
+        start = timer()
+        bad_paths = run_so(vissim, graph, end_second=end_second)
+        total_s = timer() - start
+    steps = vissim.simulation_step
+    result = {
+        'steps': steps,
+        'steps_per_s': steps / total_s,
+        'total_s': total_s,
+        'bad_paths': len(bad_paths),
+        'com_calls_per_step': sum(VissimStandIn.COM_CALLS.values()) / steps,
+        'route_cache_hit_rate': graph.route_cache.stats()['hit_rate'],
+    }
+    result.update((name + '_s', timings[name]) for name in phases)
+    result['other_s'] = total_s - sum(timings.values())
+    return result
+
+
+def bench_step_profiler(end_second: int = 1200, seed: int = 42) -> Dict[str, float]:
+    """
+    Runs the SO control loop on the offline VISSIM stand-in with and without a StepProfiler, and reports the run
+    times, the size of the written time series and the share of the profiled step time covered by the phases.
+    """
+    def run(profiler):
+        vissim = VissimStandIn.Vissim(seed=seed)
+        graph = VissimRoadNet(vissim.Net)
+        start = timer()
+        run_so(vissim, graph, end_second=end_second, profiler=profiler)
+        return timer() - start
+
+    plain_s = run(None)
+    with tempfile.TemporaryDirectory() as folder:
+        profiler = StepProfiler(file_path=os.path.join(folder, 'steps.npz'))
+        profiled_s = run(profiler)
+        file_bytes = os.path.getsize(profiler.file_path)
+        steps = StepProfiler.load(profiler.file_path)
+    phase_s = steps[[phase + ' time' for phase in profiler.phases]].values.sum()
+    return {
+        'steps': len(steps),
+        'plain_s': plain_s,
+        'profiled_s': profiled_s,
+        'overhead': profiled_s / plain_s - 1,
+        'file_bytes': file_bytes,
+        'phase_coverage': phase_s / steps['WallTime'].sum(),
+    }
+
+
+def synthetic_timevol(edges: pd.DataFrame, periods: int = 8, iterations: int = 3, seed: int = 0):
+    """
+    This function builds a timevol_table like dataframe of two vehicle types whose edge travel times follow known
+    volume delay curves with 1 % noise
+    :return: dataframe, free flow times, scales and powers of the curves
+    """
+    rng = np.random.RandomState(seed)
+    free_flow = edges['Length'].values / 51.3333 + 1
+    power = rng.choice([2., 4.], edges.shape[0])
+    # BPR curves with alpha 0.15 and capacities between 300 and 800 vehicles per period
+    scale = free_flow * 0.15 / rng.uniform(300, 800, edges.shape[0]) ** power
+    frames = []
+    for itr, period in itertools.product(range(iterations), range(1, periods + 1)):
+        volume = rng.uniform(0, 600, edges.shape[0])
+        travel_time = (free_flow + scale * volume ** power) * (1 + 0.01 * rng.randn(edges.shape[0]))
+        share = rng.uniform(0.6, 0.9, edges.shape[0])
+        for veh_type, type_share in (('10', share), ('20', 1 - share)):
+            frames.append(pd.DataFrame({'NO': edges.index, 'VehType': veh_type, 'Period': period,
+                                        'TRAVTMNEW': travel_time, 'VOLNEW': volume * type_share, 'ITR': itr}))
+    return pd.concat(frames, ignore_index=True), free_flow, scale, power
+
+
+def bench_cost_model(edges_file: str = 'edges_attr.pkl.gz') -> Dict[str, float]:
+    """
+    Fits the network marginal cost model to synthetic edge volumes and travel times, once for all edges and edge by
+    edge with numpy least squares, and reports the fit and evaluation times and the errors of the fitted curves.
+    """
+    edges = pd.read_pickle(edges_file)
+    timevol, free_flow, scale, power = synthetic_timevol(edges)
+    model = NetworkModel(edges)
+    fit_s = best_time(lambda: model.fit(timevol), repeat=3)
+
+    def per_edge_fit():
+        periods = timevol.groupby(['NO', 'ITR', 'Period']).agg({'TRAVTMNEW': 'mean', 'VOLNEW': 'sum'})
+        for edge_no, edge_periods in periods.groupby(level='NO'):
+            volume, travel_time = edge_periods['VOLNEW'].values, edge_periods['TRAVTMNEW'].values
+            for edge_power in (1., 2., 3., 4., 5., 6.):
+                np.linalg.lstsq(np.c_[np.ones_like(volume), volume ** edge_power], travel_time, rcond=None)
+
+    per_edge_s = best_time(per_edge_fit, repeat=1)
+    volume = np.random.RandomState(1).uniform(0, 600, edges.shape[0])
+    evaluate_s = best_time(lambda: model.evaluate(volume), repeat=100)
+    return {
+        'edges': edges.shape[0],
+        'fit_s': fit_s,
+        'per_edge_fit_s': per_edge_s,
+        'speedup': per_edge_s / fit_s,
+        'evaluate_s': evaluate_s,
+        'median_free_flow_error': np.median(np.abs(model.free_flow_time / free_flow - 1)),
+        'median_travel_time_error': np.median(np.abs(model.travel_time(volume) / (free_flow + scale * volume ** power)
+                                                     - 1)),
+    }
+
+
+def bench_weight_update(changed_share: float = 0.1, pairs: int = 400, seed: int = 0) -> Dict[str, float]:
+    """
+    Writes new weights for a share of the edges of the shipped graph, once by writing every weight to the graph and
+    once through the incremental set_weights, and reports the write times and the cached routes kept when all the
+    changed weights increased.
+    """
+    rng = np.random.RandomState(seed)
+    graph = shipped_graph()
+    base = graph._weights.copy()
+    changed = rng.choice(len(base), int(len(base) * changed_share), replace=False)
+    weights = [base.copy(), base.copy()]
+    weights[1][changed] *= 1.5
+
+    def full_write():
+        for edge_weights in weights:
+            graph.es['weight'] = edge_weights.tolist()
+
+    def incremental_write():
+        for edge_weights in weights:
+            graph.set_weights(edge_weights)
+
+    full_s = best_time(full_write)
+    incremental_s = best_time(incremental_write)
+
+    lots = graph.parking_lots
+    lot_pairs = list(zip(rng.choice(lots.index[lots.Type == 'origin'], pairs),
+                         rng.choice(lots.index[lots.Type == 'destination'], pairs)))
+    graph.set_weights(weights[0])
+    graph.parking_lot_routes_batch(lot_pairs)
+    cached = len(graph.route_cache.routes)
+    graph.set_weights(weights[1])
+    return {
+        'changed_edges': len(graph.changed_edges),
+        'full_s': full_s,
+        'incremental_s': incremental_s,
+        'speedup': full_s / incremental_s,
+        'routes_kept': len(graph.route_cache.routes) / cached,
+    }
+
+
+def bench_matrix_transfer(zones: int = 300, seed: int = 0) -> Dict[str, float]:
+    """
+    Reads and writes a synthetic demand matrix of a stand-in VISSIM matrix in bulk and cell by cell, checks both give
+    the same values and reports their run times and COM calls.
+    """
+    demand = np.random.RandomState(seed).poisson(3., (zones, zones)).astype(float)
+    result = {'zones': zones}
+    values = {}
+    for mode, bulk in (('bulk', True), ('cell', False)):
+        matrix = VissimStandIn.IMatrix(np.zeros((zones, zones)), bulk=bulk)
+        VissimStandIn.COM_CALLS.clear()
+        start = timer()
+        set_IMatrix_from_numpy(matrix, demand)
+        values[mode] = IMatrix_to_numpy(matrix)
+        result[mode + '_s'] = timer() - start
+        result[mode + '_com_calls'] = sum(VissimStandIn.COM_CALLS.values())
+    assert (values['bulk'] == demand).all() and (values['cell'] == demand).all()
+    result['speedup'] = result['cell_s'] / result['bulk_s']
+    return result
+
+
+def legacy_remove_loops(sequence):
+    """
+    This function is the quadratic loop removal remove_loops replaced
+    """
+    sequence = [item for item in sequence]
+
+    item_set = set(sequence)
+    if len(sequence) != len(item_set):
+        for item in item_set:
+            if sequence.count(item) > 1:
+                last_index = sequence[::-1].index(item)
+                first_index = sequence.index(item)
+                del sequence[first_index + 1:last_index * -1]
+
+    return sequence
+
+
+def bench_remove_loops(routes: int = 2000, sequences: int = 2000, length: int = 200, items: int = 150,
+                       seed: int = 0) -> Dict[str, float]:
+    """
+    Removes the loops of the node and edge sequences of routes between random parking lots of the shipped graph, and
+    of long random integer sequences, with the quadratic legacy function, the linear remove_loops applied to each
+    sequence and remove_loops_batch. Checks the linear and batch results agree and reports the run times.
+    """
+    rng = np.random.RandomState(seed)
+    graph = shipped_graph()
+    lots = graph.parking_lots
+    node_seqs, edge_seqs = graph.parking_lot_routes_batch(
+        list(zip(rng.choice(lots.index[lots.Type == 'origin'], routes),
+                 rng.choice(lots.index[lots.Type == 'destination'], routes))))
+    batches = {
+        'route_nodes': node_seqs,
+        'route_edges': [np.asarray(edge_seq) for edge_seq in edge_seqs],
+        'random': [rng.randint(0, items, length).tolist() for _ in range(sequences)],
+    }
+    result = {}
+    for name, paths in batches.items():
+        legacy_s = best_time(lambda: [legacy_remove_loops(path) for path in paths], repeat=3)
+        linear_s = best_time(lambda: [remove_loops(path) for path in paths], repeat=3)
+        batch_s = best_time(lambda: remove_loops_batch(paths), repeat=3)
+        assert all(np.array_equal(batch, remove_loops(path)) for batch, path in zip(remove_loops_batch(paths), paths))
+        result.update({name + '_legacy_s': legacy_s, name + '_linear_s': linear_s, name + '_batch_s': batch_s})
+    return result
+
+
+def legacy_timevol_table(frame: pd.DataFrame) -> pd.DataFrame:
+    """
+    Melt based timevol_table that parsed the column names of every row, kept as reference
+    """
+    def pick_no_and_cols_melt(data, col_name_start):
+        columns = [col for col in frame.columns.values if col.startswith(col_name_start)]
+        data = data[['NO'] + columns]
+        columns = dict(zip(columns, [col.split('(')[-1].strip(')') for col in columns]))
+        data = data.rename(index=str, columns=columns)
+        data = data.melt(id_vars=['NO'], var_name='TEMP', value_name=col_name_start)
+        new_columns = data['TEMP'].str.split(',', n=1, expand=True)
+        data.drop(columns=['TEMP'], inplace=True)
+        data['Period'] = new_columns[0].astype(int)
+        data['VehType'] = new_columns[1]
+        data.sort_values(by=['NO', 'VehType', 'Period'], inplace=True)
+        return data
+
+    out_frame = pick_no_and_cols_melt(frame, 'TRAVTMNEW')
+    out_frame['VOLNEW'] = pick_no_and_cols_melt(frame, 'VOLNEW')['VOLNEW']
+    return out_frame[['NO', 'VehType', 'Period', 'TRAVTMNEW', 'VOLNEW']]
+
+
+def peak_memory(func: Callable):
+    """
+    This function runs func under tracemalloc
+    :return: result of func, run time and peak traced memory in bytes
+    """
+    tracemalloc.start()
+    start = timer()
+    result = func()
+    seconds = timer() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, seconds, peak
+
+
+def bench_timevol_table(edges: int = 20000, periods: int = 8, veh_types: Sequence[str] = ('10', '20', '30')
+                        ) -> Dict[str, float]:
+    """
+    Reshapes the VolTime table of a synthetic cost file with the array based timevol_table and the melt based version,
+    checks both give the same rows and reports their run times, peak memory and result sizes.
+    """
+    with tempfile.TemporaryDirectory() as folder:
+        cost_file = os.path.join(folder, 'costs.bew')
+        write_synthetic_cost_file(cost_file, edges, periods, veh_types)
+        voltime = dynamic_assignment_file_read(cost_file, ['VolTime'])['VolTime']
+
+    new, new_s, new_peak = peak_memory(lambda: timevol_table(voltime))
+    legacy, legacy_s, legacy_peak = peak_memory(lambda: legacy_timevol_table(voltime))
+    legacy = legacy.reset_index(drop=True)
+    assert (new['NO'].values == legacy['NO'].values).all() and (new['Period'].values == legacy['Period'].values).all()
+    assert (new['VehType'].astype(str).values == legacy['VehType'].values).all()
+    assert (new['VOLNEW'].values == legacy['VOLNEW'].values).all()
+    assert np.allclose(new['TRAVTMNEW'].values, legacy['TRAVTMNEW'].values, rtol=1e-6)
+    return {
+        'rows': new.shape[0],
+        'new_s': new_s,
+        'legacy_s': legacy_s,
+        'speedup': legacy_s / new_s,
+        'new_peak_bytes': new_peak,
+        'legacy_peak_bytes': legacy_peak,
+        'new_result_bytes': new.memory_usage(deep=True).sum(),
+        'legacy_result_bytes': legacy.memory_usage(deep=True).sum(),
+    }
+
+
+def write_scenario_tree(folder: str, demands: Sequence[int], iterations: int, edges: int, periods: int) -> str:
+    """
+    This function writes synthetic cost files named costs_<iteration>.bew in one Vol<percent>per folder per demand level
+    :return: the scenario folder
+    """
+    for demand, itr in itertools.product(demands, range(1, iterations + 1)):
+        scenario = os.path.join(folder, 'Vol{}per'.format(demand))
+        os.makedirs(scenario, exist_ok=True)
+        write_synthetic_cost_file(os.path.join(scenario, 'costs_{:03d}.bew'.format(itr)), edges, periods,
+                                  seed=demand + itr)
+    return folder
+
+
+def bench_ingest(demands: Sequence[int] = (50, 100, 150), iterations: int = 4, edges: int = 5000,
+                 periods: int = 8) -> Dict[str, float]:
+    """
+    Writes a scenario tree of synthetic cost files, one Vol<percent>per folder per demand level, and reads it with the
+    in memory read_edge_vol_delay and the streaming ingest_edge_vol_delay. Checks both give the same rows and reports
+    their run times and the peak memory traced in the parent process, then the time of a repeat ingest which finds
+    every partition up to date.
+    """
+    with tempfile.TemporaryDirectory() as folder:
+        scenarios = write_scenario_tree(os.path.join(folder, 'scenarios'), demands, iterations, edges, periods)
+        dataset = os.path.join(folder, 'dataset')
+
+        in_memory, in_memory_s, in_memory_peak = peak_memory(
+            lambda: read_edge_vol_delay(sorted(iter_files_by_ext(scenarios, 'bew'))))
+        written, streaming_s, streaming_peak = peak_memory(
+            lambda: ingest_edge_vol_delay(iter_files_by_ext(scenarios, 'bew'), dataset))
+        repeat_s = best_time(lambda: ingest_edge_vol_delay(iter_files_by_ext(scenarios, 'bew'), dataset), repeat=1)
+        streamed = read_dataset(dataset)
+
+    # every file has the same compact column types, which concatenating keeps
+    assert in_memory.dtypes.equals(streamed.dtypes) and isinstance(streamed['VehType'].dtype, pd.CategoricalDtype)
+    assert streamed['NO'].dtype == np.int32 and streamed['VOLNEW'].dtype == np.int32
+    columns = ['Demand', 'ITR', 'NO', 'VehType', 'Period']
+    in_memory = in_memory.sort_values(columns).reset_index(drop=True)
+    streamed = streamed.sort_values(columns).reset_index(drop=True)
+    assert (in_memory['VOLNEW'].values == streamed['VOLNEW'].values).all()
+    assert np.allclose(in_memory['TRAVTMNEW'].values, streamed['TRAVTMNEW'].values, rtol=1e-6)
+    assert np.allclose(in_memory['Demand'].values, streamed['Demand'].values)
+    return {
+        'files': len(written),
+        'rows': streamed.shape[0],
+        'in_memory_s': in_memory_s,
+        'streaming_s': streaming_s,
+        'repeat_s': repeat_s,
+        'in_memory_peak_bytes': in_memory_peak,
+        'streaming_peak_bytes': streaming_peak,
+    }
+
+
+def bench_vol_delay_stats(demands: Sequence[int] = (50, 100, 150), iterations: int = 6, edges: int = 5000,
+                          periods: int = 8) -> Dict[str, float]:
+    """
+    Ingests a scenario tree of synthetic cost files and computes the cell statistics and iteration changes with
+    pandas on the whole dataset in memory, and with VolDelayStats one partition at a time. Checks both agree and
+    reports their run times, peak memory traced and the size of the VolDelayStats cell arrays.
+    """
+    keys = ['NO', 'Period', 'VehType', 'Demand']
+
+    def in_memory(dataset):
+        frame = read_dataset(dataset)
+        frame['Demand'] = frame['Demand'].astype(float).round(6)
+        frame['VehType'] = frame['VehType'].astype(str)
+        frame['TRAVTMNEW'] = frame['TRAVTMNEW'].astype(float)
+        summary = frame.groupby(keys)['TRAVTMNEW'].agg(['mean', 'var', 'min', 'max']).reset_index()
+        times = frame.pivot_table(index=['Demand', 'NO', 'Period', 'VehType'], columns='ITR', values='TRAVTMNEW')
+        changes = times.diff(axis=1).abs().groupby(level='Demand').mean()
+        return summary, changes
+
+    with tempfile.TemporaryDirectory() as folder:
+        scenarios = write_scenario_tree(os.path.join(folder, 'scenarios'), demands, iterations, edges, periods)
+        dataset = os.path.join(folder, 'dataset')
+        ingest_edge_vol_delay(iter_files_by_ext(scenarios, 'bew'), dataset)
+        (summary, changes), in_memory_s, in_memory_peak = peak_memory(lambda: in_memory(dataset))
+        stats, streaming_s, streaming_peak = peak_memory(lambda: VolDelayStats.from_dataset(dataset))
+
+    streamed = stats.summary()
+    assert (streamed['NO'].values == summary['NO'].values).all()
+    for column, name in (('TravelTimeMean', 'mean'), ('TravelTimeVar', 'var'), ('TravelTimeMin', 'min'),
+                         ('TravelTimeMax', 'max')):
+        assert np.allclose(streamed[column].values, summary[name].values, rtol=1e-6, equal_nan=True)
+    convergence = stats.convergence()['MeanAbsChange']
+    expected = changes.stack().reindex(convergence.index)
+    assert np.allclose(convergence.values, expected.values, rtol=1e-6)
+    return {
+        'rows': stats.rows,
+        'cells': len(stats.keys),
+        'in_memory_s': in_memory_s,
+        'streaming_s': streaming_s,
+        'in_memory_peak_bytes': in_memory_peak,
+        'streaming_peak_bytes': streaming_peak,
+        'cell_bytes': stats.memory_footprint(),
+    }
+
+
+def bench_snapshot(pairs: int = 500, seed: int = 0) -> Dict[str, float]:
+    """
+    Saves the shipped graph as a snapshot, as a gzipped igraph pickle and as a gzipped pickle of a dictionary of the
+    graph, its tables and travel times. Checks every load gives back the graph topology, and the snapshot graph finds
+    the same routes as the original, then reports how long each takes to load and its size on disk.
+    """
+    rng = np.random.RandomState(seed)
+    graph = shipped_graph()
+    lots = graph.parking_lots
+    lot_pairs = list(zip(rng.choice(lots.index[lots.Type == 'origin'], pairs),
+                         rng.choice(lots.index[lots.Type == 'destination'], pairs)))
+
+    def load_pickle(file_path):
+        with gzip.open(file_path, 'rb') as state_file:
+            state = pickle.load(state_file)
+        loaded = state['graph']
+        loaded.visedges, loaded.parking_lots = state['visedges'], state['parking_lots']
+        loaded.travel_time = state['travel_time']
+        return loaded
+
+    with tempfile.TemporaryDirectory() as folder:
+        snapshot = os.path.join(folder, 'snapshot')
+        picklez = os.path.join(folder, 'graph.pkl.gz')
+        state_pickle = os.path.join(folder, 'state.pkl.gz')
+        graph.save_snapshot(snapshot)
+        graph.write_picklez(picklez)
+        with gzip.open(state_pickle, 'wb') as state_file:
+            pickle.dump({'graph': graph, 'visedges': graph.visedges, 'parking_lots': graph.parking_lots,
+                         'travel_time': graph._travel_time}, state_file)
+        for loaded in (VissimRoadNet.from_snapshot(snapshot), VissimRoadNet.Read_Picklez(picklez),
+                       load_pickle(state_pickle)):
+            assert loaded.vcount() == graph.vcount() and loaded.get_edgelist() == graph.get_edgelist()
+            assert np.array_equal(loaded._travel_time, graph._travel_time)
+        result = {
+            'snapshot_load_s': best_time(lambda: VissimRoadNet.from_snapshot(snapshot)),
+            'picklez_load_s': best_time(lambda: VissimRoadNet.Read_Picklez(picklez)),
+            'state_pickle_load_s': best_time(lambda: load_pickle(state_pickle)),
+            'snapshot_bytes': sum(os.path.getsize(os.path.join(snapshot, name)) for name in os.listdir(snapshot)),
+            'picklez_bytes': os.path.getsize(picklez),
+            'state_pickle_bytes': os.path.getsize(state_pickle),
+        }
+        loaded = VissimRoadNet.from_snapshot(snapshot)
+        assert loaded.get_edgelist() == graph.get_edgelist() and loaded.vs['name'] == graph.vs['name']
+        assert loaded.visedges.equals(graph.visedges.astype(loaded.visedges.dtypes.to_dict()))
+        assert [list(edges) for edges in loaded.parking_lot_routes_batch(lot_pairs)[1]] == \
+            [list(edges) for edges in graph.parking_lot_routes_batch(lot_pairs)[1]]
+    return result
+
+
+def legacy_read_parking_lot(graph: VissimRoadNet, vissim_net) -> pd.DataFrame:
+    """
+    Path by path VissimRoadNet.read_parking_lot from before the vectorized lookups, kept as reference
+    """
+    parking_lots = vissim_net.ParkingLots.GetMultipleAttributes(["No", "Zone", "Type"])
+    parking_lots = pd.DataFrame([list(pk) for pk in parking_lots], columns=["No", "Zone", "Type"])
+    parking_lots = parking_lots[parking_lots["Type"] == 'ZONECONNECTOR']
+    parking_lots["Type"] = ""
+    parking_lots = parking_lots.set_index('No')
+    parking_lots["Zone"] = parking_lots["Zone"].astype(int)
+    parking_lots["Node"] = 0
+    parking_lots["VertexName"] = ''
+
+    vissim_net.Paths.ReadDynAssignPathFile()
+    paths = vissim_net.Paths.GetMultipleAttributes(['FromParkLot', 'ToParkLot', 'EdgeSeq'])
+    paths = pd.DataFrame([list(p) for p in paths], columns=['FromParkLot', 'ToParkLot', 'EdgeSeq'])
+    paths[['FromParkLot', 'ToParkLot']] = paths[['FromParkLot', 'ToParkLot']].astype(int, copy=False)
+    for index, path in paths.drop_duplicates(subset=['FromParkLot']).iterrows():
+        first_edge = int(path.EdgeSeq.split(',')[0])
+        parking_lots.loc[path.FromParkLot, 'Node'] = graph.visedges.loc[first_edge, 'FromNode']
+        parking_lots.loc[path.FromParkLot, 'VertexName'] = graph.visedges.loc[first_edge, 'OriginVertex']
+        parking_lots.loc[path.FromParkLot, 'Type'] = 'origin'
+    for index, path in paths.drop_duplicates(subset=['ToParkLot']).iterrows():
+        last_edge = int(path.EdgeSeq.split(',')[-1])
+        parking_lots.loc[path.ToParkLot, 'Node'] = graph.visedges.loc[last_edge, 'ToNode']
+        parking_lots.loc[path.ToParkLot, 'VertexName'] = graph.visedges.loc[last_edge, 'DestinVertex']
+        parking_lots.loc[path.ToParkLot, 'Type'] = 'destination'
+    return parking_lots
+
+
+def bench_parking_lots(paths_per_pair: int = 250) -> Dict[str, float]:
+    """
+    Fills a stand-in VISSIM network with many stored paths per lot pair, as a path file of a converged assignment
+    holds, and places the parking lots from the paths pulled over COM path by path, pulled over COM with vectorized
+    lookups, and streamed from the written .weg file. Checks all give the same table and reports their run times.
+    """
+    vissim = VissimStandIn.Vissim()
+    paths = list(vissim.Net.Paths)
+    for copy in range(1, paths_per_pair):
+        for path in paths:
+            vissim.Net.Paths.add(VissimStandIn.Path(No=copy * len(paths) + path.attributes['No'],
+                                                    **{key: value for key, value in path.attributes.items()
+                                                       if key != 'No'}))
+    graph = VissimRoadNet(vissim.Net)
+    result = {'paths': len(vissim.Net.Paths), 'lots': graph.parking_lots.shape[0]}
+    with tempfile.TemporaryDirectory() as folder:
+        path_file = os.path.join(folder, 'paths.weg')
+        vissim.write_path_file(path_file)
+        legacy = legacy_read_parking_lot(graph, vissim.Net)
+        assert legacy.astype({'Node': np.int64}).equals(graph.read_parking_lot(vissim.Net).astype({'Node': np.int64}))
+        assert graph.read_parking_lot(vissim.Net).equals(graph.read_parking_lot(vissim.Net, path_file))
+        assert len(graph.path_index) == len(paths) and graph.path_index.path_count == result['paths']
+        result['legacy_s'] = best_time(lambda: legacy_read_parking_lot(graph, vissim.Net), repeat=1)
+        result['com_s'] = best_time(lambda: graph.read_parking_lot(vissim.Net))
+        result['path_file_s'] = best_time(lambda: graph.read_parking_lot(vissim.Net, path_file))
+    result['com_speedup'] = result['legacy_s'] / result['com_s']
+    result['path_file_speedup'] = result['legacy_s'] / result['path_file_s']
+    return result
+
+
+def bench_lot_costs(pairs: int = 1000, seed: int = 0) -> Dict[str, float]:
+    """
+    Answers random parking lot cost and route questions on the shipped graph with one shortest path search per
+    question, and from a lot cost matrix computed once. Checks the matrix costs and routes match the searches and
+    reports the time of the matrix update and of the questions both ways.
+    """
+    rng = np.random.RandomState(seed)
+    graph = shipped_graph()
+    lots = graph.parking_lots
+    lot_pairs = list(zip(rng.choice(lots.index[lots.Type == 'origin'], pairs).tolist(),
+                         rng.choice(lots.index[lots.Type == 'destination'], pairs).tolist()))
+    vertex = lots['VertexName']
+    weights = np.array(graph.es['weight'])
+
+    def search_routes():
+        return [graph.get_shortest_paths(vertex[origin], vertex[destination], weights='weight', output='epath')[0]
+                for origin, destination in lot_pairs]
+
+    def search_costs():
+        return [weights[edge_ind_seq].sum() for edge_ind_seq in search_routes()]
+
+    graph.update_lot_costs()
+    costs = search_costs()
+    assert np.allclose(costs, [graph.lot_cost(origin, destination) for origin, destination in lot_pairs])
+    assert np.allclose(costs, [weights[graph.edge_positions(graph.lot_route(*lot_pair)[1])].sum()
+                               for lot_pair in lot_pairs])
+    result = {
+        'origins': len(graph.lot_costs.origin_lots),
+        'destinations': len(graph.lot_costs.destination_lots),
+        'update_s': best_time(graph.update_lot_costs),
+        'search_cost_s': best_time(search_costs, repeat=1),
+        'matrix_cost_s': best_time(lambda: [graph.lot_cost(*lot_pair) for lot_pair in lot_pairs]),
+        'search_route_s': best_time(search_routes, repeat=1),
+        'matrix_route_s': best_time(lambda: [graph.lot_route(*lot_pair) for lot_pair in lot_pairs]),
+    }
+    result['cost_speedup'] = result['search_cost_s'] / (result['update_s'] + result['matrix_cost_s'])
+    result['route_speedup'] = result['search_route_s'] / (result['update_s'] + result['matrix_route_s'])
+    return result
+
+
+def bench_landmarks(pairs: int = 1000, count: int = 16, seed: int = 0) -> Dict[str, float]:
+    """
+    Searches random parking lot pairs of the shipped graph with Dijkstra and with landmark A*, on the free flow
+    weights the landmarks were built on and on congested weights between 0.8 and 3 times free flow. Checks both find
+    the same paths and reports their run times, the vertices they settle and the heuristic calls of A*. Dijkstra
+    stops once the target is settled, so it settles the vertices not farther than the target, and A* settles the
+    vertices whose distance plus estimate is not above the distance of the target.
+    """
+    rng = np.random.RandomState(seed)
+    graph = shipped_graph()
+    lots = graph.parking_lots
+    vertex_ids = {name: vertex for vertex, name in enumerate(graph.vs['name'])}
+    vertex_pairs = [(vertex_ids[lots.VertexName[origin]], vertex_ids[lots.VertexName[destination]])
+                    for origin, destination in zip(rng.choice(lots.index[lots.Type == 'origin'], pairs),
+                                                   rng.choice(lots.index[lots.Type == 'destination'], pairs))]
+    start = timer()
+    landmarks = graph.build_landmarks(count)
+    result = {'landmarks': len(landmarks.landmarks), 'build_s': timer() - start}
+
+    free_flow = graph._weights.copy()
+    for name, weights in (('free_flow', free_flow), ('congested', free_flow * rng.uniform(0.8, 3., len(free_flow)))):
+        graph.set_weights(weights)
+        dijkstra_paths = [graph.get_shortest_paths(origin, destination, weights='weight', output='epath')[0]
+                          for origin, destination in vertex_pairs]
+        landmarks.heuristic_calls = 0
+        astar_paths = [landmarks.edge_path(origin, destination) for origin, destination in vertex_pairs]
+        assert all(np.isclose(weights[astar].sum(), weights[dijkstra].sum())
+                   for astar, dijkstra in zip(astar_paths, dijkstra_paths))
+
+        dijkstra_settled = astar_settled = 0
+        for (origin, destination), distance in zip(vertex_pairs, graph_distances(
+                graph, [origin for origin, _ in vertex_pairs], graph._weights.tolist())):
+            distance = np.array(distance)
+            dijkstra_settled += (distance <= distance[destination]).sum()
+            astar_settled += (distance + landmarks.estimates(destination) <= distance[destination]).sum()
+
+        result[name + '_scale'] = landmarks.scale
+        result[name + '_same_paths'] = np.mean([astar == dijkstra for astar, dijkstra
+                                                in zip(astar_paths, dijkstra_paths)])
+        result[name + '_dijkstra_settled'] = dijkstra_settled / pairs
+        result[name + '_astar_settled'] = astar_settled / pairs
+        result[name + '_astar_heuristic_calls'] = landmarks.heuristic_calls / pairs
+        result[name + '_dijkstra_s'] = best_time(lambda: [graph.get_shortest_paths(
+            origin, destination, weights='weight', output='epath') for origin, destination in vertex_pairs], repeat=3)
+        result[name + '_astar_s'] = best_time(lambda: [landmarks.edge_path(origin, destination)
+                                                       for origin, destination in vertex_pairs], repeat=3)
+    return result
+
+
+def bench_travel_time_store(periods: int = 8, lookups: int = 20, edges: int = 20000, seed: int = 0
+                            ) -> Dict[str, float]:
+    """
+    Reads the travel times of past periods from stand-in VISSIM edges over COM, as update_weights did for every
+    weight vector, and from the travel time store filled once. Checks both give the same values and the store returns
+    views. Also reports how long a synthetic cost file takes to pre-load into a store.
+    """
+    rng = np.random.RandomState(seed)
+    vissim = VissimStandIn.Vissim(seed=seed)
+    graph = VissimRoadNet(vissim.Net)
+    for period in range(1, periods + 1):
+        times = rng.uniform(1., 120., graph.ecount())
+        times[rng.rand(graph.ecount()) < 0.1] = np.nan
+        vissim.period_travel_times[period] = times
+
+    def com_period(period):
+        travel_times = np.full(graph.ecount(), np.nan)
+        values = [edge for edge in vissim.Net.Edges.GetMultiAttValues('TravTmRaw({})'.format(period)) if edge[1]]
+        index, values = zip(*values)
+        travel_times[graph.edge_positions(index)] = values
+        return travel_times
+
+    for period in range(1, periods + 1):
+        graph.travel_times.record(period, com_period(period))
+    requested = rng.randint(1, periods + 1, lookups).tolist()
+    for period in requested:
+        view = graph.travel_times.period(period)
+        assert np.shares_memory(view, graph.travel_times.times)
+        assert np.allclose(view, com_period(period), equal_nan=True)
+
+    VissimStandIn.COM_CALLS.clear()
+    result = {
+        'com_s': best_time(lambda: [com_period(period) for period in requested], repeat=3),
+        'com_calls': sum(VissimStandIn.COM_CALLS.values()) / 3,
+        'store_s': best_time(lambda: [graph.travel_times.period(period) for period in requested]),
+    }
+    result['speedup'] = result['com_s'] / result['store_s']
+    with tempfile.TemporaryDirectory() as folder:
+        cost_file = os.path.join(folder, 'costs_001.bew')
+        write_synthetic_cost_file(cost_file, edges, periods)
+        store = TravelTimeStore(np.arange(1, edges + 1))
+        result['preload_edges'] = edges
+        result['preload_s'] = best_time(lambda: store.load_cost_file(cost_file), repeat=1)
+    return result
+
+
+def bench_path_registry(end_second: int = 1800, seed: int = 42) -> Dict[str, float]:
+    """
+    Runs the SO control loop on the offline VISSIM stand-in adding a path for every departed vehicle, and reusing
+    paths through the VISSIM path registry. Checks the registry adds every path once and reports the AddPath calls per
+    step, the rejected paths, the registry hit rate and the run times.
+    """
+    result = {}
+    for name, reuse_paths in (('every_vehicle', False), ('registry', True)):
+        vissim = VissimStandIn.Vissim(seed=seed)
+        graph = VissimRoadNet(vissim.Net)
+        VissimStandIn.COM_CALLS.clear()
+        start = timer()
+        bad_paths = run_so(vissim, graph, end_second=end_second, reuse_paths=reuse_paths)
+        result[name + '_s'] = timer() - start
+        result[name + '_add_path_per_step'] = VissimStandIn.COM_CALLS['AddPath'] / vissim.simulation_step
+        result[name + '_bad_paths'] = len(bad_paths)
+    stats = graph.vissim_paths.stats()
+    # every path is added once, rejected sequences included
+    assert VissimStandIn.COM_CALLS['AddPath'] == stats['adds']
+    result['registry_hit_rate'] = stats['hit_rate']
+    result['registry_paths'] = stats['paths']
+    result['rejected_sequences'] = stats['rejected_sequences']
+    result['rejected_hits'] = stats['rejected_hits']
+    return result
+
+
+def bench_vehicle_classes(classes: int = 3, steps: int = 120, pairs: int = 30, update_every: int = 30,
+                          seed: int = 0) -> Dict[str, float]:
+    """
+    Routes the lot pairs of several vehicle classes every step on the shipped graph, by rewriting the one weight
+    attribute before every class as a single weight graph has to, and with a weight set per class served by
+    class_routes_batch. The class weights change every update_every steps. Checks both give the same routes and
+    reports the run times and the memory added by every vehicle class per edge.
+    """
+    rng = np.random.RandomState(seed)
+    graph = shipped_graph()
+    lots = graph.parking_lots
+    origins = lots.index[lots.Type == 'origin']
+    destinations = lots.index[lots.Type == 'destination']
+    names = [VissimRoadNet.DEFAULT_CLASS] + ['class_{}'.format(index) for index in range(1, classes)]
+    free_flow = graph._weights.copy()
+    updates = [[free_flow * rng.uniform(1., 3., len(free_flow)) for _ in names]
+               for _ in range(steps // update_every + 1)]
+    # lot pairs repeat within a class as vehicles of a fleet share origins and destinations
+    class_pairs = {name: list(zip(rng.choice(origins, 20).tolist(), rng.choice(destinations, 20).tolist()))
+                   for name in names}
+    requests = [{name: [class_pairs[name][index] for index in rng.randint(0, 20, pairs)] for name in names}
+                for _ in range(steps)]
+
+    def single_weights():
+        routes = []
+        for step, step_requests in enumerate(requests):
+            for name, weights in zip(names, updates[step // update_every]):
+                graph.set_weights(weights)
+                routes.append(graph.parking_lot_routes_batch(step_requests[name])[1])
+        return routes
+
+    def weight_sets():
+        routes = []
+        for step, step_requests in enumerate(requests):
+            if step % update_every == 0:
+                for name, weights in zip(names, updates[step // update_every]):
+                    graph.set_weights(weights, name)
+            step_routes = graph.class_routes_batch(step_requests)
+            routes.extend(step_routes[name][1] for name in names)
+        return routes
+
+    start = timer()
+    single_routes = single_weights()
+    single_s = timer() - start
+    _, _, class_bytes = peak_memory(lambda: [graph.add_vehicle_class(name) for name in names[1:]])
+    start = timer()
+    class_routes = weight_sets()
+    class_s = timer() - start
+    assert all(np.array_equal(single, routed) for single_step, class_step in zip(single_routes, class_routes)
+               for single, routed in zip(single_step, class_step))
+    return {
+        'classes': classes,
+        'single_weights_s': single_s,
+        'weight_sets_s': class_s,
+        'speedup': single_s / class_s,
+        'edges': graph.ecount(),
+        'class_bytes_per_edge': class_bytes / (classes - 1) / graph.ecount(),
+    }
+
+
+def bench_pipelined(end_second: int = 1800, seed: int = 42, lookaheads: Sequence[int] = (0, 1, 2),
+                    step_latency: float = 0.003) -> Dict[str, float]:
+    """
+    Runs the SO control loop on the offline VISSIM stand-in synchronously and pipelined with every lookahead and reports
+    the simulated steps per second, the loop time per step outside the stand-in, the paths VISSIM rejected and the
+    vehicles whose route was ready too late. The runs are repeated with step_latency seconds of waiting added to every step, standing in for the time
+    an out of process VISSIM takes to simulate a step. Lookahead 0 must give the volumes and paths of the synchronous
+    loop, every run must keep the edge volumes equal to the paths of the vehicles in the network and the added
+    latency must not change the result of any run.
+    """
+    result = {}
+    runs = {}
+    for latency in (0., step_latency):
+        suffix = '_latency' if latency else ''
+        for lookahead in (None,) + tuple(lookaheads):
+            vissim = VissimStandIn.Vissim(seed=seed)
+            graph = VissimRoadNet(vissim.Net)
+            if latency:
+                def delayed_step(run_single_step=vissim.Simulation.RunSingleStep):
+                    time.sleep(latency)
+                    run_single_step()
+                vissim.Simulation.RunSingleStep = delayed_step
+            name = ('sync' if lookahead is None else 'lookahead_{}'.format(lookahead)) + suffix
+            timings = Counter()
+            with timed_methods(timings, {'run_single_step': (vissim.Simulation, 'RunSingleStep'),
+                                         'assign_path': (VissimStandIn.Vehicle, 'AssignPath')}):
+                start = timer()
+                if lookahead is None:
+                    bad_paths, late_vehicles = run_so(vissim, graph, end_second=end_second), []
+                else:
+                    bad_paths, late_vehicles = run_so_pipelined(vissim, graph, end_second=end_second,
+                                                                lookahead=lookahead)
+                total_s = timer() - start
+            steps = vissim.simulation_step
+            result[name + '_steps_per_s'] = steps / total_s
+            result[name + '_loop_ms_per_step'] = 1000 * (total_s - sum(timings.values())) / steps
+            result[name + '_bad_paths'] = len(bad_paths)
+            result[name + '_late_vehicles'] = len(late_vehicles)
+
+            volume = np.zeros_like(graph._edge_volume)
+            for veh_no in graph.veh_paths.vehicles().tolist():
+                np.add.at(volume, graph.edge_positions(graph.veh_paths[veh_no]), 1)
+            assert np.array_equal(volume, graph._edge_volume)
+            veh_paths = {veh_no: tuple(graph.veh_paths[veh_no]) for veh_no in graph.veh_paths.vehicles().tolist()}
+            run = (graph._edge_volume.tolist(), veh_paths, len(bad_paths), len(late_vehicles))
+            if latency:
+                assert run == runs[lookahead]
+            else:
+                runs[lookahead] = run
+    assert runs[0] == runs[None]
+    return result
+
+
+BENCHMARKS = {
+    'graph_build': bench_graph_build,
+    'cost_file_read': bench_cost_file_read,
+    'update_volume': bench_update_volume,
+    'so_loop': bench_so_loop,
+    'step_profiler': bench_step_profiler,
+    'cost_model': bench_cost_model,
+    'weight_update': bench_weight_update,
+    'matrix_transfer': bench_matrix_transfer,
+    'remove_loops': bench_remove_loops,
+    'timevol_table': bench_timevol_table,
+    'ingest': bench_ingest,
+    'vol_delay_stats': bench_vol_delay_stats,
+    'snapshot': bench_snapshot,
+    'parking_lots': bench_parking_lots,
+    'lot_costs': bench_lot_costs,
+    'landmarks': bench_landmarks,
+    'travel_time_store': bench_travel_time_store,
+    'path_registry': bench_path_registry,
+    'pipelined': bench_pipelined,
+    'vehicle_classes': bench_vehicle_classes,
+}
+
+
+if __name__ == "__main__":
+    for name in sys.argv[1:] or BENCHMARKS.keys():
+        result = BENCHMARKS[name]()
+        print(name + ': ' + ', '.join('{} = {:.4g}'.format(key, value) for key, value in result.items()))
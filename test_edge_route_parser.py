@@ -0,0 +1,19 @@
+"""
+Checks of the cost file ingestion, run with pytest
+"""
+import logging
+import os
+
+from EdgeRouteParser import ingest_edge_vol_delay, iter_files_by_ext, read_dataset
+from benchmarks import write_scenario_tree, write_synthetic_cost_file
+
+
+def test_ingest_skips_files_not_named_by_scenario(tmp_path, caplog):
+    scenarios = write_scenario_tree(str(tmp_path / 'scenarios'), [50], 2, 50, 2)
+    reference = os.path.join(scenarios, 'Vol50per', 'ref_tsm.bew')
+    write_synthetic_cost_file(reference, 50, 2)
+    with caplog.at_level(logging.WARNING, logger='EdgeRouteParser'):
+        written = ingest_edge_vol_delay(iter_files_by_ext(scenarios, 'bew'), str(tmp_path / 'dataset'), processes=1)
+    assert len(written) == 2
+    assert sorted(read_dataset(str(tmp_path / 'dataset'))['ITR'].unique()) == [1, 2]
+    assert 'ref_tsm.bew' in caplog.text
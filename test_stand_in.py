@@ -0,0 +1,153 @@
+"""
+Checks of the SO loop against the offline VISSIM stand-in, run with pytest
+"""
+import numpy as np
+import pytest
+
+import VissimStandIn
+from SO_sim_runner import run_so, run_so_pipelined
+from VISSIM_helpers import VissimRoadNet, VehiclePathRegistry, StepProfiler
+from benchmarks import shipped_graph, legacy_update_volume, write_synthetic_cost_file
+
+END_SECOND = 700
+
+
+def run_result(graph: VissimRoadNet, bad_paths: list, late_vehicles: list = ()) -> tuple:
+    """
+    :return: edge volumes, path of every vehicle in the network, number of rejected paths and vehicles routed too late
+        of a run
+    """
+    veh_paths = {veh_no: tuple(graph.veh_paths[veh_no]) for veh_no in graph.veh_paths.vehicles().tolist()}
+    return graph._edge_volume.tolist(), veh_paths, len(bad_paths), len(late_vehicles)
+
+
+def test_update_volume_matches_vehicle_by_vehicle():
+    rng = np.random.RandomState(0)
+    graph = shipped_graph()
+    lots = graph.parking_lots
+    lot_pairs = list(zip(rng.choice(lots.index[lots.Type == 'origin'], 50),
+                         rng.choice(lots.index[lots.Type == 'destination'], 50)))
+    _, edge_seqs = graph.parking_lot_routes_batch(lot_pairs)
+    path_nos = [index + 1 for index, edge_seq in enumerate(edge_seqs) if len(edge_seq)]
+
+    vis_net = VissimStandIn.INet()
+    for path_no in path_nos:
+        vis_net.Paths.add(VissimStandIn.Path(No=path_no, EdgeSeq=','.join(map(str, edge_seqs[path_no - 1]))))
+    step_vehicles = [[VissimStandIn.Vehicle(vis_net.Paths, No=step * 20 + veh + 1, Path=int(rng.choice(path_nos)))
+                      for veh in range(20)] for step in range(15)]
+
+    volumes = []
+    for update in (VissimRoadNet.update_volume, legacy_update_volume):
+        graph._edge_volume[:] = 0
+        graph.veh_paths = VehiclePathRegistry()
+        graph.path_edges = {}
+        for step, vehicles in enumerate(step_vehicles):
+            vis_net.Vehicles.departed = VissimStandIn.Container(vehicles)
+            vis_net.Vehicles.arrived = VissimStandIn.Container(step_vehicles[step - 5] if step >= 5 else [])
+            update(graph, vis_net)
+        volumes.append(graph._edge_volume.copy())
+    assert volumes[0].sum() > 0
+    assert np.array_equal(volumes[0], volumes[1])
+
+
+class CollidingPathRegistry(VehiclePathRegistry):
+    @staticmethod
+    def _path_key(edge_seq: np.ndarray) -> int:
+        return 0
+
+
+@pytest.mark.parametrize('registry_class', [VehiclePathRegistry, CollidingPathRegistry])
+def test_vehicle_path_registry_stores_paths_once(registry_class):
+    registry = registry_class()
+    registry[1] = [1, 2, 3]
+    registry[2] = [1, 2, 3]
+    registry[3] = [3, 2, 1]
+    assert registry[1] is registry[2]
+    assert registry.memory_footprint()['paths'] == 2
+    assert registry[3].tolist() == [3, 2, 1]
+
+    registry.pop(1)
+    registry.pop(2)
+    registry[4] = [4]
+    assert registry.memory_footprint()['paths'] == 2
+    assert registry[3].tolist() == [3, 2, 1] and registry[4].tolist() == [4]
+    registry.pop(3)
+    registry.pop(4)
+    assert not registry.path_ids
+
+
+def test_pipelined_without_lookahead_matches_run_so():
+    vissim = VissimStandIn.Vissim(seed=7)
+    graph = VissimRoadNet(vissim.Net)
+    expected = run_result(graph, run_so(vissim, graph, end_second=END_SECOND))
+
+    vissim = VissimStandIn.Vissim(seed=7)
+    graph = VissimRoadNet(vissim.Net)
+    profiler = StepProfiler()
+    bad_paths, late_vehicles = run_so_pipelined(vissim, graph, end_second=END_SECOND, lookahead=0, profiler=profiler)
+    assert run_result(graph, bad_paths, late_vehicles) == expected
+    assert not late_vehicles
+    assert profiler.step + 1 == vissim.simulation_step
+    assert (profiler.to_frame()['add_path calls'] > 0).any()
+
+
+@pytest.mark.parametrize('lookahead', [1, 2])
+def test_pipelined_runs_are_deterministic(lookahead):
+    results = []
+    for _ in range(2):
+        vissim = VissimStandIn.Vissim(seed=7)
+        graph = VissimRoadNet(vissim.Net)
+        bad_paths, late_vehicles = run_so_pipelined(vissim, graph, end_second=END_SECOND, lookahead=lookahead)
+        results.append(run_result(graph, bad_paths, late_vehicles))
+        assert late_vehicles
+
+        # the edge volumes are the paths VISSIM has for the vehicles in the network
+        volume = np.zeros_like(graph._edge_volume)
+        for veh in vissim.vehicles.values():
+            np.add.at(volume, graph.edge_positions(graph.path_edge_seq(vissim.Net, veh.attributes['Path'])), 1)
+        assert np.array_equal(volume, graph._edge_volume)
+    assert results[0] == results[1]
+
+
+def test_run_so_drops_path_edges_of_earlier_runs():
+    vissim = VissimStandIn.Vissim(seed=7)
+    graph = VissimRoadNet(vissim.Net)
+    # path numbers of another simulation, pointing at the wrong edges
+    stale_edge = np.array([graph.visedges.index[0]], dtype=np.int32)
+    graph.path_edges = {path_no: stale_edge for path_no in range(1, 5000)}
+    run_so(vissim, graph, end_second=END_SECOND)
+
+    volume = np.zeros_like(graph._edge_volume)
+    for veh in vissim.vehicles.values():
+        edge_seq = vissim.Net.Paths.ItemByKey(veh.attributes['Path']).AttValue('EdgeSeq')
+        np.add.at(volume, graph.edge_positions([int(edge) for edge in edge_seq.split(',')]), 1)
+    assert np.array_equal(volume, graph._edge_volume)
+
+
+def test_snapshot_tables_round_trip(tmp_path):
+    vissim = VissimStandIn.Vissim(seed=7)
+    graph = VissimRoadNet(vissim.Net)
+    graph.visedges.loc[graph.visedges.index[0], 'LinkSeq'] = None
+    graph.save_snapshot(str(tmp_path / 'snapshot'))
+    loaded = VissimRoadNet.from_snapshot(str(tmp_path / 'snapshot'))
+    for table, expected in ((loaded.visedges, graph.visedges), (loaded.parking_lots, graph.parking_lots)):
+        assert table.index.tolist() == expected.index.tolist() and list(table.columns) == list(expected.columns)
+        for name in expected.columns:
+            assert table[name].isna().tolist() == expected[name].isna().tolist()
+            assert table[name].dropna().tolist() == expected[name].dropna().tolist()
+        assert (table.dtypes == 'category').tolist() == (expected.dtypes == 'category').tolist()
+
+
+def test_cost_file_loads_into_snapshot_travel_times(tmp_path):
+    vissim = VissimStandIn.Vissim(seed=7)
+    graph = VissimRoadNet(vissim.Net)
+    graph.travel_times.record(1, graph._travel_time)
+    graph.save_snapshot(str(tmp_path / 'snapshot'))
+    loaded = VissimRoadNet.from_snapshot(str(tmp_path / 'snapshot'))
+    assert not loaded.travel_times.times.flags.writeable
+
+    cost_file = str(tmp_path / 'costs.bew')
+    write_synthetic_cost_file(cost_file, int(graph.visedges.index.max()), 3)
+    assert loaded.travel_times.load_cost_file(cost_file) == [1, 2, 3]
+    assert loaded.travel_times.filled[:3].all()
+    assert np.isfinite(loaded.travel_times.period(2)).any()
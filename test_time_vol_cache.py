@@ -0,0 +1,125 @@
+"""
+Checks of the parsed cost file cache, run with pytest
+"""
+import os
+import shutil
+import subprocess
+import sys
+import threading
+import time
+from collections import Counter
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import TimeVolCache
+from TimeVolCache import TimeVolCache as Cache, file_hash
+
+
+class CountingParser:
+    """
+    Parser building a small table from the number written in a file, counting the files it parsed
+    """
+
+    def __init__(self):
+        self.calls = Counter()
+
+    def __call__(self, file_path: str) -> pd.DataFrame:
+        self.calls[os.path.basename(file_path)] += 1
+        with open(file_path) as file:
+            offset = int(file.read())
+        return pd.DataFrame({'NO': np.arange(100) + offset, 'VEHTYPE': ['10', '20'] * 50})
+
+
+@pytest.fixture
+def files(tmp_path):
+    folder = tmp_path / 'files'
+    folder.mkdir()
+    file_paths = {}
+    for name, offset in (('a', 0), ('b', 1000), ('c', 2000)):
+        file_paths[name] = str(folder / (name + '.bew'))
+        with open(file_paths[name], 'w') as file:
+            file.write(str(offset))
+    return file_paths
+
+
+def test_touched_and_copied_files_reuse_the_cached_table(tmp_path, files):
+    parser = CountingParser()
+    cache = Cache(str(tmp_path / 'cache'), parser=parser)
+    table = cache.get(files['a'])
+
+    stat = os.stat(files['a'])
+    os.utime(files['a'], (stat.st_atime + 10, stat.st_mtime + 10))
+    copy = str(tmp_path / 'copy.bew')
+    shutil.copy(files['a'], copy)
+    for file_path in (files['a'], copy):
+        pd.testing.assert_frame_equal(cache.get(file_path), table)
+    assert parser.calls == {'a.bew': 1}
+    assert cache.info()['files'] == 2 and cache.info()['tables'] == 1
+
+    # another process sharing the folder finds the table too
+    other = Cache(str(tmp_path / 'cache'), parser=parser)
+    assert other.lookup(copy) == file_hash(files['a'])
+
+
+def test_changes_are_made_holding_the_lock_file(tmp_path, files):
+    cache = Cache(str(tmp_path / 'cache'), parser=CountingParser())
+    with cache._locked():
+        assert os.path.exists(cache.lock_path)
+        with cache._locked():
+            pass
+        assert os.path.exists(cache.lock_path)
+    assert not os.path.exists(cache.lock_path)
+
+    # a lock held by another process delays the next change until it is released
+    open(cache.lock_path, 'w').close()
+    worker = threading.Thread(target=cache.get, args=(files['a'],))
+    worker.start()
+    worker.join(0.2)
+    assert worker.is_alive()
+    os.remove(cache.lock_path)
+    worker.join(5)
+    assert not worker.is_alive()
+    assert cache.info()['tables'] == 1
+
+
+def test_stale_lock_file_is_removed(tmp_path, files):
+    parser = CountingParser()
+    cache = Cache(str(tmp_path / 'cache'), parser=parser)
+    open(cache.lock_path, 'w').close()
+    stale = time.time() - TimeVolCache.LOCK_TIMEOUT - 1
+    os.utime(cache.lock_path, (stale, stale))
+    cache.get(files['a'])
+    assert parser.calls == {'a.bew': 1}
+    assert not os.path.exists(cache.lock_path)
+
+
+def test_least_recently_used_tables_are_evicted(tmp_path, files):
+    parser = CountingParser()
+    cache = Cache(str(tmp_path / 'cache'), parser=parser)
+    for name in ('a', 'b', 'c', 'a'):
+        cache.get(files[name])
+        time.sleep(0.01)
+    tables = cache.index['tables']
+    hashes = {name: file_hash(file_path) for name, file_path in files.items()}
+
+    # a cache hit trims a cache over its size limit, b was used least recently
+    cache.max_bytes = tables[hashes['a']]['bytes'] + tables[hashes['c']]['bytes']
+    cache.get(files['c'])
+    assert set(cache.index['tables']) == {hashes['a'], hashes['c']}
+    assert not os.path.exists(cache._table_path(hashes['b']))
+    assert files['b'] not in cache.index['files']
+    cache.get(files['b'])
+    assert parser.calls == {'a.bew': 1, 'b.bew': 2, 'c.bew': 1}
+    assert cache.info()['bytes'] <= cache.max_bytes
+
+
+def test_trim_command_evicts_tables_over_max_bytes(tmp_path, files):
+    cache = Cache(str(tmp_path / 'cache'), parser=CountingParser())
+    for file_path in files.values():
+        cache.get(file_path)
+    subprocess.run([sys.executable, TimeVolCache.__file__, 'trim', '--cache-dir', cache.cache_dir,
+                    '--max-bytes', '0'], check=True, stdout=subprocess.DEVNULL)
+    assert cache.info()['tables'] == 0
+    assert not [name for name in os.listdir(cache.cache_dir) if name.endswith('.npz')]